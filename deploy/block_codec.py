@@ -0,0 +1,194 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+##
+# @file:   block_codec.py
+# @brief:  压缩的分块bin文件, 以及按块解压的读取器
+
+# 说明:
+#   1 文件格式, 整数都是小端:
+#       文件头      magic "XBLK", 版本号 uint32, 压缩方式 uint32, 压缩级别 uint32, 块大小 uint32, 保留 uint32
+#       块          每块 (压缩后的长度 uint32, 原始长度 uint32, 压缩的数据)
+#       索引        块数个 (块在文件中的偏移 uint64, 块在原始数据中的偏移 uint64)
+#       文件尾      索引的偏移 uint64, 块数 uint32, magic "XBLK"
+#   2 原始数据就是<sheet>_array序列化的结果, 分块时只在items之间切分,
+#     每块单独解压后也是一个完整的<sheet>_array, 超过块大小的单个items独占一块
+#   3 只用标准库的压缩, python2没有lzma
+#
+#   用法:
+#       blocks = block_codec.BlockFile("build_out/bin/example.bin")
+#       items = example_pb2.example_array.FromString(blocks.ReadBlock(0))
+#       data = block_codec.ReadData("build_out/bin/example.bin")    # 压缩和未压缩的bin都可以
+##
+
+import bz2
+import collections
+import struct
+import zlib
+
+try :
+    import lzma
+except ImportError :
+    lzma = None
+
+BLOCK_MAGIC = b"XBLK"
+BLOCK_VERSION = 1
+
+_HEADER = struct.Struct("<4sIIIII")
+_BLOCK_HEADER = struct.Struct("<II")
+_INDEX_ENTRY = struct.Struct("<QQ")
+_TRAILER = struct.Struct("<QI4s")
+
+DEFAULT_BLOCK_SIZE = 256 * 1024
+
+# 压缩方式名: (编号, 默认级别, 压缩, 解压)
+CODECS = collections.OrderedDict([
+    ("zlib", (1, 6, lambda data, level: zlib.compress(data, level), zlib.decompress)),
+    ("bz2", (2, 9, lambda data, level: bz2.compress(data, level), bz2.decompress)),
+])
+if lzma is not None :
+    CODECS["lzma"] = (3, 6, lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+
+_CODEC_NAMES = dict((codec[0], name) for name, codec in CODECS.items())
+
+def DefaultLevel(codec) :
+    return CODECS[codec][1]
+
+class BlockWriter:
+    """写入原始数据, 凑满一块后压缩写到out_file, 最后必须调用Finish写完剩下的块和索引
+
+    level 为None时使用压缩方式的默认级别
+    """
+    def __init__(self, out_file, codec, level=None, block_size=DEFAULT_BLOCK_SIZE):
+        codec_id, default_level, self._compress, decompress = CODECS[codec]
+        self._level = default_level if level is None else level
+        self._out_file = out_file
+        self._block_size = block_size
+        self._buffer = bytearray()
+        # 缓冲中已经确认的最后一个items的结尾
+        self._scan = 0
+        self._index = []
+        self._file_offset = _HEADER.size
+        self._raw_offset = 0
+        out_file.write(_HEADER.pack(BLOCK_MAGIC, BLOCK_VERSION, codec_id, self._level, block_size, 0))
+
+    def write(self, data) :
+        self._buffer.extend(data)
+        start = 0
+        while True :
+            record_end = self._RecordEnd(self._scan)
+            if record_end is None :
+                break
+            if record_end - start > self._block_size and self._scan > start :
+                self._WriteBlock(start, self._scan)
+                start = self._scan
+                continue
+            self._scan = record_end
+        # 每次写入只移动一次缓冲, 一次写入大量数据时不会反复拷贝
+        if start > 0 :
+            del self._buffer[:start]
+            self._scan -= start
+
+    def _RecordEnd(self, pos) :
+        """pos处的items的结尾, 数据不完整时返回None"""
+        end = len(self._buffer)
+        if pos >= end :
+            return None
+        if self._buffer[pos] != 0x0a :
+            raise ValueError("unexpected tag %d" % self._buffer[pos])
+        length = 0
+        shift = 0
+        pos += 1
+        while True :
+            if pos >= end :
+                return None
+            byte = self._buffer[pos]
+            pos += 1
+            length |= (byte & 0x7f) << shift
+            if not (byte & 0x80) :
+                break
+            shift += 7
+        if pos + length > end :
+            return None
+        return pos + length
+
+    def _WriteBlock(self, start, end) :
+        raw = bytes(self._buffer[start:end])
+        compressed = self._compress(raw, self._level)
+        self._out_file.write(_BLOCK_HEADER.pack(len(compressed), len(raw)))
+        self._out_file.write(compressed)
+        self._index.append(_INDEX_ENTRY.pack(self._file_offset, self._raw_offset))
+        self._file_offset += _BLOCK_HEADER.size + len(compressed)
+        self._raw_offset += len(raw)
+
+    def Finish(self) :
+        if len(self._buffer) > 0 :
+            if self._scan != len(self._buffer) :
+                raise ValueError("incomplete items at the end of data")
+            self._WriteBlock(0, len(self._buffer))
+            self._buffer = bytearray()
+            self._scan = 0
+        self._out_file.write(b"".join(self._index))
+        self._out_file.write(_TRAILER.pack(self._file_offset, len(self._index), BLOCK_MAGIC))
+
+def IsBlockFile(file_name) :
+    block_file = open(file_name, "rb")
+    magic = block_file.read(len(BLOCK_MAGIC))
+    block_file.close()
+    return magic == BLOCK_MAGIC
+
+class BlockFile:
+    """按块读取压缩的bin文件"""
+    def __init__(self, file_name):
+        self._file = open(file_name, "rb")
+        header = self._file.read(_HEADER.size)
+        if len(header) < _HEADER.size :
+            self._file.close()
+            raise ValueError("%s is not a block file" % file_name)
+        magic, version, codec_id, self.level, self.block_size, reserved = _HEADER.unpack(header)
+        if magic != BLOCK_MAGIC or version != BLOCK_VERSION or codec_id not in _CODEC_NAMES :
+            self._file.close()
+            raise ValueError("%s is not a block file of version %d" % (file_name, BLOCK_VERSION))
+        self.codec = _CODEC_NAMES[codec_id]
+        self._decompress = CODECS[self.codec][3]
+
+        self._file.seek(-_TRAILER.size, 2)
+        index_offset, block_count, magic = _TRAILER.unpack(self._file.read(_TRAILER.size))
+        if magic != BLOCK_MAGIC :
+            self._file.close()
+            raise ValueError("%s is truncated" % file_name)
+        self._file.seek(index_offset)
+        index_data = self._file.read(_INDEX_ENTRY.size * block_count)
+        # (块在文件中的偏移, 块在原始数据中的偏移)
+        self.blocks = [_INDEX_ENTRY.unpack_from(index_data, _INDEX_ENTRY.size * i) for i in range(block_count)]
+
+    def __len__(self) :
+        return len(self.blocks)
+
+    def ReadBlock(self, i) :
+        """解压第i块, 结果是一个完整的<sheet>_array序列化的数据"""
+        self._file.seek(self.blocks[i][0])
+        compressed_length, raw_length = _BLOCK_HEADER.unpack(self._file.read(_BLOCK_HEADER.size))
+        raw = self._decompress(self._file.read(compressed_length))
+        if len(raw) != raw_length :
+            raise ValueError("block %d is broken" % i)
+        return raw
+
+    def Read(self) :
+        """解压所有块, 返回原始数据"""
+        return b"".join([self.ReadBlock(i) for i in range(len(self.blocks))])
+
+    def Close(self) :
+        self._file.close()
+
+def ReadData(file_name) :
+    """bin文件的原始数据, 压缩的先解压"""
+    if IsBlockFile(file_name) :
+        block_file = BlockFile(file_name)
+        data = block_file.Read()
+        block_file.Close()
+        return data
+    data_file = open(file_name, "rb")
+    data = data_file.read()
+    data_file.close()
+    return data
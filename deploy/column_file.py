@@ -0,0 +1,328 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+##
+# @file:   column_file.py
+# @brief:  按列保存的配置文件, 以及返回NumPy数组的加载器
+
+# 说明:
+#   1 文件格式, 整数都是小端:
+#       文件头      magic "XCOL", 版本号 uint32, 目录长度 uint32, 保留 uint32
+#       目录        utf-8的json, 行数和每一列的类型以及各数组的 [偏移, 元素个数]
+#       数组        每个数组按8字节对齐, 可以直接mmap为NumPy数组
+#   2 每个属性一列, 列的类型由<sheet>的PB定义决定:
+#       数值        values 每行一个值, 没有设值时为0
+#       字符串      string_offsets 行数+1个uint64, blob 所有字符串的utf-8拼接
+#       数值数组    offsets 行数+1个uint64, values 所有行的值依次排列
+#       字符串数组  offsets 行数+1个uint64, 每行字符串的下标; 字符串的 string_offsets 和 blob 同字符串列
+#   3 导出时只依赖标准库, 由bin文件直接按wire格式解码, 和protobuf的实现无关;
+#     加载器需要NumPy, 所有数组都是mmap上的只读视图, 不拷贝数据
+#
+#   用法:
+#       columns = column_file.ColumnFile("build_out/col/example.col")
+#       ids = columns.Column("id")                     # numpy数组
+#       offsets, values = columns.Column("relation")   # 第i行为 values[offsets[i]:offsets[i + 1]]
+#       names = columns.Strings("make")                # 字符串列解码为unicode的列表
+##
+
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+COLUMN_MAGIC = b"XCOL"
+COLUMN_VERSION = 1
+
+_HEADER = struct.Struct("<4sIII")
+_ALIGN = 8
+
+# FieldDescriptorProto中的类型编号
+TYPE_DOUBLE = 1
+TYPE_FLOAT = 2
+TYPE_INT64 = 3
+TYPE_UINT64 = 4
+TYPE_INT32 = 5
+TYPE_FIXED64 = 6
+TYPE_FIXED32 = 7
+TYPE_BOOL = 8
+TYPE_STRING = 9
+TYPE_BYTES = 12
+TYPE_UINT32 = 13
+TYPE_ENUM = 14
+TYPE_SFIXED32 = 15
+TYPE_SFIXED64 = 16
+TYPE_SINT32 = 17
+TYPE_SINT64 = 18
+
+# 数值类型: (NumPy的dtype, struct的格式)
+_NUMERIC_TYPES = {
+    TYPE_DOUBLE : ("<f8", "d"), TYPE_FLOAT : ("<f4", "f"),
+    TYPE_INT64 : ("<i8", "q"), TYPE_UINT64 : ("<u8", "Q"),
+    TYPE_INT32 : ("<i4", "i"), TYPE_UINT32 : ("<u4", "I"),
+    TYPE_FIXED64 : ("<u8", "Q"), TYPE_FIXED32 : ("<u4", "I"),
+    TYPE_SFIXED64 : ("<i8", "q"), TYPE_SFIXED32 : ("<i4", "i"),
+    TYPE_SINT64 : ("<i8", "q"), TYPE_SINT32 : ("<i4", "i"),
+    TYPE_BOOL : ("<u1", "B"), TYPE_ENUM : ("<i4", "i"),
+}
+_STRING_TYPES = (TYPE_STRING, TYPE_BYTES)
+
+_FIXED32_FORMATS = {TYPE_FIXED32 : "<I", TYPE_SFIXED32 : "<i", TYPE_FLOAT : "<f"}
+_FIXED64_FORMATS = {TYPE_FIXED64 : "<Q", TYPE_SFIXED64 : "<q", TYPE_DOUBLE : "<d"}
+
+def _ReadVarint(buf, pos) :
+    result = 0
+    shift = 0
+    while True :
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not (byte & 0x80) :
+            return result, pos
+        shift += 7
+
+def _VarintValue(value, field_type) :
+    if field_type == TYPE_SINT32 or field_type == TYPE_SINT64 :
+        return (value >> 1) ^ -(value & 1)
+    if field_type == TYPE_INT32 or field_type == TYPE_INT64 or field_type == TYPE_ENUM :
+        return value - (1 << 64) if value >= (1 << 63) else value
+    if field_type == TYPE_BOOL :
+        return 1 if value else 0
+    return value
+
+def _NewValues(fmt) :
+    """定长数值的数组, python2的array没有64位整数时用list"""
+    try :
+        return array.array(fmt)
+    except ValueError :
+        return []
+
+def _PackValues(values, fmt) :
+    if isinstance(values, list) :
+        return struct.pack("<%d%s" % (len(values), fmt), *values)
+    if values.itemsize != struct.calcsize(fmt) :
+        return struct.pack("<%d%s" % (len(values), fmt), *values)
+    if sys.byteorder != "little" :
+        values = array.array(fmt, values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+class _Column:
+    """导出时一列的数据"""
+    def __init__(self, name, number, field_type, repeated):
+        self.name = name
+        self.number = number
+        self.field_type = field_type
+        self.repeated = repeated
+        self.is_string = field_type in _STRING_TYPES
+        if not self.is_string :
+            self.dtype, self.fmt = _NUMERIC_TYPES[field_type]
+            self.values = _NewValues(self.fmt)
+        else :
+            self.string_offsets = _NewValues("Q")
+            self.string_offsets.append(0)
+            self.blob = bytearray()
+        if repeated :
+            self.offsets = _NewValues("Q")
+            self.offsets.append(0)
+
+    def AddString(self, value) :
+        self.blob.extend(value)
+        self.string_offsets.append(len(self.blob))
+
+    def AddRow(self, value) :
+        """value 为这一行的值, 数组时为值的列表, 没有设值时为None"""
+        if self.repeated :
+            count = 0
+            for item in value or () :
+                if self.is_string :
+                    self.AddString(item)
+                else :
+                    self.values.append(item)
+                count += 1
+            self.offsets.append(self.offsets[-1] + count)
+        elif self.is_string :
+            self.AddString(value if value is not None else b"")
+        else :
+            self.values.append(value if value is not None else 0)
+
+    def Arrays(self) :
+        """[(数组名, dtype, 数据, 元素个数)]"""
+        arrays = []
+        if self.repeated :
+            arrays.append(("offsets", "<u8", _PackValues(self.offsets, "Q"), len(self.offsets)))
+        if self.is_string :
+            arrays.append(("string_offsets", "<u8", _PackValues(self.string_offsets, "Q"), len(self.string_offsets)))
+            arrays.append(("blob", "<u1", bytes(self.blob), len(self.blob)))
+        else :
+            arrays.append(("values", self.dtype, _PackValues(self.values, self.fmt), len(self.values)))
+        return arrays
+
+def _DecodeRecord(buf, columns, row) :
+    """解码一个记录, row 为 {属性编号: 值}, 数组属性为值的列表"""
+    pos = 0
+    end = len(buf)
+    while pos < end :
+        tag, pos = _ReadVarint(buf, pos)
+        number = tag >> 3
+        wire_type = tag & 0x7
+        column = columns.get(number)
+
+        if wire_type == 0 :
+            value, pos = _ReadVarint(buf, pos)
+            if column is not None :
+                value = _VarintValue(value, column.field_type)
+        elif wire_type == 5 :
+            if column is not None :
+                value = struct.unpack_from(_FIXED32_FORMATS[column.field_type], buf, pos)[0]
+            pos += 4
+        elif wire_type == 1 :
+            if column is not None :
+                value = struct.unpack_from(_FIXED64_FORMATS[column.field_type], buf, pos)[0]
+            pos += 8
+        elif wire_type == 2 :
+            length, pos = _ReadVarint(buf, pos)
+            if column is not None and not column.is_string :
+                # 打包的数值数组
+                row.setdefault(number, []).extend(_DecodePacked(buf, pos, pos + length, column.field_type))
+                column = None
+            elif column is not None :
+                value = bytes(buf[pos:pos + length])
+            pos += length
+        else :
+            raise ValueError("unsupported wire type %d" % wire_type)
+
+        if column is None :
+            continue
+        if column.repeated :
+            row.setdefault(number, []).append(value)
+        else :
+            row[number] = value
+
+def _DecodePacked(buf, pos, end, field_type) :
+    fixed_format = _FIXED32_FORMATS.get(field_type) or _FIXED64_FORMATS.get(field_type)
+    if fixed_format is not None :
+        count = (end - pos) // struct.calcsize(fixed_format)
+        return list(struct.unpack_from("<%d%s" % (count, fixed_format[1]), buf, pos))
+    values = []
+    while pos < end :
+        value, pos = _ReadVarint(buf, pos)
+        values.append(_VarintValue(value, field_type))
+    return values
+
+def WriteColumnFile(records, fields, out_file) :
+    """将记录按列写到out_file
+
+    records 为每个记录序列化的数据, fields 为 [(属性名, 属性编号, 类型, 是否数组)],
+    不支持的类型(message)不输出. 返回行数
+    """
+    columns = []
+    for name, number, field_type, repeated in fields :
+        if field_type in _NUMERIC_TYPES or field_type in _STRING_TYPES :
+            columns.append(_Column(name, number, field_type, repeated))
+    column_map = dict((column.number, column) for column in columns)
+
+    row_count = 0
+    for record in records :
+        row = {}
+        _DecodeRecord(bytearray(record), column_map, row)
+        for column in columns :
+            column.AddRow(row.get(column.number))
+        row_count += 1
+
+    arrays = []
+    directory = {"rows" : row_count, "columns" : []}
+    for column in columns :
+        column_info = {"name" : column.name, "type" : column.field_type, "repeated" : column.repeated,
+                "string" : column.is_string, "arrays" : {}}
+        for array_name, dtype, data, count in column.Arrays() :
+            column_info["arrays"][array_name] = {"dtype" : dtype, "offset" : 0, "count" : count}
+            arrays.append((column_info["arrays"][array_name], data))
+        directory["columns"].append(column_info)
+
+    # 数组的位置由目录的长度决定, 目录中又有数组的位置, 重复计算直到目录的长度不再变化
+    directory_data = b""
+    while True :
+        offset = _HEADER.size + len(directory_data)
+        for array_info, data in arrays :
+            offset += (-offset) % _ALIGN
+            array_info["offset"] = offset
+            offset += len(data)
+        new_directory_data = json.dumps(directory, sort_keys=True).encode("utf-8")
+        if len(new_directory_data) == len(directory_data) :
+            directory_data = new_directory_data
+            break
+        directory_data = new_directory_data
+
+    out_file.write(_HEADER.pack(COLUMN_MAGIC, COLUMN_VERSION, len(directory_data), 0))
+    out_file.write(directory_data)
+    offset = _HEADER.size + len(directory_data)
+    for array_info, data in arrays :
+        padding = (-offset) % _ALIGN
+        out_file.write(b"\0" * padding)
+        out_file.write(data)
+        offset += padding + len(data)
+    return row_count
+
+class ColumnFile:
+    """按列读取, 返回的NumPy数组都是mmap上的只读视图, 关闭前不能释放"""
+    def __init__(self, file_name):
+        import numpy
+        self._numpy = numpy
+
+        self._file = open(file_name, "rb")
+        if os.path.getsize(file_name) < _HEADER.size :
+            self._file.close()
+            raise ValueError("%s is not a column file" % file_name)
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, directory_size, reserved = _HEADER.unpack_from(self._data, 0)
+        if magic != COLUMN_MAGIC or version != COLUMN_VERSION :
+            self.Close()
+            raise ValueError("%s is not a column file of version %d" % (file_name, COLUMN_VERSION))
+        directory = json.loads(self._data[_HEADER.size:_HEADER.size + directory_size].decode("utf-8"))
+        self.rows = directory["rows"]
+        self._columns = dict((column["name"], column) for column in directory["columns"])
+        self.names = [column["name"] for column in directory["columns"]]
+
+    def __len__(self) :
+        return self.rows
+
+    def _Array(self, column, array_name) :
+        array_info = column["arrays"][array_name]
+        return self._numpy.frombuffer(self._data, dtype=array_info["dtype"], count=array_info["count"],
+                offset=array_info["offset"])
+
+    def Column(self, name) :
+        """数值列返回数组; 数值数组列返回 (offsets, values);
+        字符串列返回 (string_offsets, blob); 字符串数组列返回 (offsets, string_offsets, blob)
+        """
+        column = self._columns[name]
+        arrays = []
+        if column["repeated"] :
+            arrays.append(self._Array(column, "offsets"))
+        if column["string"] :
+            arrays += [self._Array(column, "string_offsets"), self._Array(column, "blob")]
+        else :
+            arrays.append(self._Array(column, "values"))
+        return arrays[0] if len(arrays) == 1 else tuple(arrays)
+
+    def Strings(self, name) :
+        """字符串列解码为unicode的列表, 字符串数组列每行为一个列表"""
+        column = self._columns[name]
+        string_offsets = self._Array(column, "string_offsets").tolist()
+        blob = self._Array(column, "blob").tobytes()
+        strings = [blob[string_offsets[i]:string_offsets[i + 1]].decode("utf-8")
+                for i in range(len(string_offsets) - 1)]
+        if not column["repeated"] :
+            return strings
+        offsets = self._Array(column, "offsets").tolist()
+        return [strings[offsets[i]:offsets[i + 1]] for i in range(self.rows)]
+
+    def Close(self) :
+        # 还有NumPy数组引用mmap时不能关闭, 由垃圾回收释放
+        try :
+            self._data.close()
+        except BufferError :
+            pass
+        self._file.close()
@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+##
+# @file:   record_file.py
+# @brief:  按id索引的配置记录文件, 以及按需读取记录的加载器
+
+# 说明:
+#   1 文件格式, 整数都是小端:
+#       文件头      magic "XREC", 版本号 uint32, 记录数 uint32, 保留 uint32
+#       索引        记录数个 (id int64, 偏移 uint64, 长度 uint32), 按id排序
+#       记录        每个记录是一个<sheet>消息序列化的结果, 按id的顺序依次排列
+#   2 id只支持整数类型, 按int64保存, uint64和fixed64的id大于int64的最大值时抛出ValueError
+#   3 加载器只依赖标准库, mmap整个文件, 二分查找索引, 记录在访问时才解析,
+#     解析后的记录放在LRU缓存中
+#
+#   用法:
+#       records = record_file.RecordFile("build_out/rec/example.rec", example_pb2.example)
+#       item = records.Get(1001)
+##
+
+import bisect
+import collections
+import mmap
+import os
+import struct
+
+RECORD_MAGIC = b"XREC"
+RECORD_VERSION = 1
+
+_HEADER = struct.Struct("<4sIII")
+_INDEX_ENTRY = struct.Struct("<qQI")
+
+# id属性的编码方式, 由id属性的类型决定
+ID_VARINT = 0
+ID_ZIGZAG = 1
+ID_FIXED32 = 2
+ID_FIXED64 = 3
+ID_SFIXED32 = 4
+ID_SFIXED64 = 5
+ID_UVARINT = 6
+
+INT64_MAX = (1 << 63) - 1
+
+def _ReadVarint(buf, pos) :
+    result = 0
+    shift = 0
+    while True :
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not (byte & 0x80) :
+            return result, pos
+        shift += 7
+
+def _SkipField(buf, pos, wire_type) :
+    if wire_type == 0 :
+        return _ReadVarint(buf, pos)[1]
+    elif wire_type == 1 :
+        return pos + 8
+    elif wire_type == 2 :
+        length, pos = _ReadVarint(buf, pos)
+        return pos + length
+    elif wire_type == 5 :
+        return pos + 4
+    raise ValueError("unsupported wire type %d" % wire_type)
+
+def _ScanId(buf, id_field_number, id_kind) :
+    """从一个序列化的记录中取出id, 没有时为proto3的默认值0"""
+    pos = 0
+    end = len(buf)
+    record_id = 0
+    while pos < end :
+        tag, pos = _ReadVarint(buf, pos)
+        field_number = tag >> 3
+        wire_type = tag & 0x7
+        if field_number != id_field_number :
+            pos = _SkipField(buf, pos, wire_type)
+            continue
+
+        # 同一个属性出现多次时以最后一次为准, 和protobuf的解析一致
+        if id_kind == ID_VARINT or id_kind == ID_ZIGZAG or id_kind == ID_UVARINT :
+            value, pos = _ReadVarint(buf, pos)
+            if id_kind == ID_ZIGZAG :
+                record_id = (value >> 1) ^ -(value & 1)
+            elif id_kind == ID_UVARINT :
+                record_id = value
+            else :
+                record_id = value - (1 << 64) if value >= (1 << 63) else value
+        elif id_kind == ID_FIXED32 or id_kind == ID_SFIXED32 :
+            fmt = "<I" if id_kind == ID_FIXED32 else "<i"
+            record_id = struct.unpack(fmt, bytes(buf[pos:pos + 4]))[0]
+            pos += 4
+        else :
+            fmt = "<Q" if id_kind == ID_FIXED64 else "<q"
+            record_id = struct.unpack(fmt, bytes(buf[pos:pos + 8]))[0]
+            pos += 8
+    # 索引和补丁中的id都是int64, 无符号的id超出时不能按id查找和排序
+    if record_id > INT64_MAX :
+        raise ValueError("id %d is larger than int64 max, not supported" % record_id)
+    return record_id
+
+def ItemHeader(length) :
+    """<sheet>_array中一个items的tag和长度, 后面跟长度为length的记录"""
+    header = bytearray([0x0a])
+    while True :
+        byte = length & 0x7f
+        length >>= 7
+        if length :
+            header.append(byte | 0x80)
+        else :
+            header.append(byte)
+            return bytes(header)
+
+def SplitRecords(data, id_field_number, id_kind) :
+    """按表中的顺序返回<sheet>_array序列化数据中每个记录的 (id, 起始位置, 长度)"""
+    # 每个items: tag 0x0a, 长度, 记录
+    records = []
+    pos = 0
+    end = len(data)
+    while pos < end :
+        header = bytearray(data[pos:pos + 11])
+        if header[0] != 0x0a :
+            raise ValueError("unexpected tag %d at byte %d" % (header[0], pos))
+        length, header_len = _ReadVarint(header, 1)
+        start = pos + header_len
+        pos = start + length
+        record_id = _ScanId(bytearray(data[start:pos]), id_field_number, id_kind)
+        records.append((record_id, start, length))
+    return records
+
+def WriteRecordFile(data, out_file, id_field_number, id_kind) :
+    """将<sheet>_array序列化的数据转换为记录文件, 写到out_file
+
+    返回记录数和重复的id列表, 重复id的记录都会保留, 查找时返回第一个
+    """
+    records = SplitRecords(data, id_field_number, id_kind)
+    # 稳定排序, 相同id保持表中的顺序
+    records.sort(key=lambda record: record[0])
+
+    duplicated = []
+    for i in range(1, len(records)) :
+        if records[i][0] == records[i - 1][0] and (len(duplicated) == 0 or duplicated[-1] != records[i][0]) :
+            duplicated.append(records[i][0])
+
+    out_file.write(_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, len(records), 0))
+    offset = _HEADER.size + _INDEX_ENTRY.size * len(records)
+    index = []
+    for record_id, start, length in records :
+        index.append(_INDEX_ENTRY.pack(record_id, offset, length))
+        offset += length
+    out_file.write(b"".join(index))
+    for record_id, start, length in records :
+        out_file.write(data[start:start + length])
+    return len(records), duplicated
+
+class _IdSequence:
+    """索引中id的只读序列, 供bisect直接在mmap上二分查找"""
+    def __init__(self, data, count):
+        self._data = data
+        self._count = count
+
+    def __len__(self) :
+        return self._count
+
+    def __getitem__(self, i) :
+        return _INDEX_ENTRY.unpack_from(self._data, _HEADER.size + _INDEX_ENTRY.size * i)[0]
+
+class RecordFile:
+    """按需读取记录文件
+
+    message_class 为记录的消息类, 例如 example_pb2.example, 为None时Get返回序列化的数据
+    cache_size    LRU缓存的记录数
+    """
+    def __init__(self, file_name, message_class=None, cache_size=1024):
+        self._message_class = message_class
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+        self._file = open(file_name, "rb")
+        if os.path.getsize(file_name) < _HEADER.size :
+            self._file.close()
+            raise ValueError("%s is not a record file" % file_name)
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, reserved = _HEADER.unpack_from(self._data, 0)
+        if magic != RECORD_MAGIC or version != RECORD_VERSION :
+            self.Close()
+            raise ValueError("%s is not a record file of version %d" % (file_name, RECORD_VERSION))
+        self._ids = _IdSequence(self._data, self._count)
+
+    def __len__(self) :
+        return self._count
+
+    def __contains__(self, record_id) :
+        return self._Find(record_id) >= 0
+
+    def Ids(self) :
+        """按顺序返回所有id"""
+        for i in range(self._count) :
+            yield self._ids[i]
+
+    def GetData(self, record_id) :
+        """记录序列化的数据, 没有时返回None"""
+        i = self._Find(record_id)
+        if i < 0 :
+            return None
+        record_id, offset, length = _INDEX_ENTRY.unpack_from(self._data, _HEADER.size + _INDEX_ENTRY.size * i)
+        return self._data[offset:offset + length]
+
+    def Get(self, record_id) :
+        """解析后的记录, 没有时返回None"""
+        record = self._cache.get(record_id)
+        if record is not None :
+            # 移到最近使用的一端
+            del self._cache[record_id]
+            self._cache[record_id] = record
+            return record
+
+        record = self.GetData(record_id)
+        if record is None :
+            return None
+        if self._message_class is not None :
+            record = self._message_class.FromString(record)
+        self._cache[record_id] = record
+        if len(self._cache) > self._cache_size :
+            self._cache.popitem(last=False)
+        return record
+
+    def Close(self) :
+        self._cache.clear()
+        self._ids = None
+        self._data.close()
+        self._file.close()
+
+    def _Find(self, record_id) :
+        i = bisect.bisect_left(self._ids, record_id)
+        if i < self._count and self._ids[i] == record_id :
+            return i
+        return -1
@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+##
+# @file:   record_patch.py
+# @brief:  两次导出的bin文件之间按id生成的补丁, 以及应用补丁的函数
+
+# 说明:
+#   1 文件格式, 整数都是小端:
+#       文件头      magic "XPAT", 版本号 uint32, id属性的编号 uint32, id的编码方式 uint32,
+#                   旧bin的crc32 uint32, 新bin的crc32 uint32, 新bin的记录数 uint32,
+#                   新增数 uint32, 修改数 uint32, 删除数 uint32, 顺序表的长度 uint32
+#       新增        新增数个 (id int64, 长度 uint32, 记录)
+#       修改        修改数个 (id int64, 长度 uint32, 记录)
+#       删除        删除数个 id int64
+#       顺序表      新bin中所有记录的id int64, 只有记录的顺序不能由旧bin推出时才有
+#   2 没有顺序表时, 新bin的顺序为: 旧bin中保留的记录按原来的顺序, 之后是新增的记录
+#   3 id只支持整数类型, 按int64保存, 和record_file相同; 表中有重复id时不能生成补丁, 只能整表重新加载
+#
+#   用法:
+#       new_data = record_patch.ApplyPatch(old_data, open("build_out/patch/example.patch", "rb").read())
+#   或者服务器按id保存记录时:
+#       patch = record_patch.RecordPatch(patch_data)
+#       records = patch.ApplyRecords(records)
+##
+
+import collections
+import struct
+import zlib
+
+import record_file
+
+PATCH_MAGIC = b"XPAT"
+PATCH_VERSION = 1
+
+_HEADER = struct.Struct("<4sIIIIIIIIII")
+_RECORD_ENTRY = struct.Struct("<qI")
+_ID = struct.Struct("<q")
+
+def Checksum(data) :
+    """bin文件的crc32"""
+    return zlib.crc32(data) & 0xffffffff
+
+def _RecordMap(data, records) :
+    """{id: 记录}, 有重复id时返回None"""
+    record_map = collections.OrderedDict()
+    for record_id, start, length in records :
+        if record_id in record_map :
+            return None
+        record_map[record_id] = data[start:start + length]
+    return record_map
+
+def WritePatchFile(old_data, new_data, out_file, id_field_number, id_kind) :
+    """比较两次导出的bin, 补丁写到out_file
+
+    返回 (新增数, 修改数, 删除数), 有重复id不能生成补丁时返回None, 不写任何数据
+    """
+    old_records = _RecordMap(old_data, record_file.SplitRecords(old_data, id_field_number, id_kind))
+    new_records = _RecordMap(new_data, record_file.SplitRecords(new_data, id_field_number, id_kind))
+    if old_records is None or new_records is None :
+        return None
+
+    added = []
+    changed = []
+    for record_id, record in new_records.items() :
+        old_record = old_records.get(record_id)
+        if old_record is None :
+            added.append(record_id)
+        elif old_record != record :
+            changed.append(record_id)
+    removed = [record_id for record_id in old_records if record_id not in new_records]
+
+    # 新bin的顺序能由旧bin推出时不需要顺序表
+    order = [record_id for record_id in old_records if record_id in new_records] + added
+    if order == list(new_records.keys()) :
+        order = []
+    else :
+        order = list(new_records.keys())
+
+    out_file.write(_HEADER.pack(PATCH_MAGIC, PATCH_VERSION, id_field_number, id_kind, Checksum(old_data),
+        Checksum(new_data), len(new_records), len(added), len(changed), len(removed), len(order)))
+    for record_ids in (added, changed) :
+        for record_id in record_ids :
+            record = new_records[record_id]
+            out_file.write(_RECORD_ENTRY.pack(record_id, len(record)))
+            out_file.write(record)
+    out_file.write(b"".join([_ID.pack(record_id) for record_id in removed + order]))
+    return len(added), len(changed), len(removed)
+
+class RecordPatch:
+    """解析后的补丁
+
+    added, changed 为 {id: 序列化的记录}, removed 为删除的id列表,
+    order 为新bin中记录的顺序, 能由旧bin推出时为None
+    """
+    def __init__(self, data):
+        if len(data) < _HEADER.size :
+            raise ValueError("not a patch file")
+        (magic, version, self.id_field_number, self.id_kind, self.base_checksum, self.checksum, self.count,
+                added_count, changed_count, removed_count, order_count) = _HEADER.unpack_from(data, 0)
+        if magic != PATCH_MAGIC or version != PATCH_VERSION :
+            raise ValueError("not a patch file of version %d" % PATCH_VERSION)
+
+        pos = _HEADER.size
+        self.added = collections.OrderedDict()
+        self.changed = collections.OrderedDict()
+        for records, count in ((self.added, added_count), (self.changed, changed_count)) :
+            for i in range(count) :
+                record_id, length = _RECORD_ENTRY.unpack_from(data, pos)
+                pos += _RECORD_ENTRY.size
+                records[record_id] = bytes(data[pos:pos + length])
+                pos += length
+        ids = [_ID.unpack_from(data, pos + _ID.size * i)[0] for i in range(removed_count + order_count)]
+        self.removed = ids[:removed_count]
+        self.order = ids[removed_count:] if order_count > 0 else None
+
+    def IsEmpty(self) :
+        return len(self.added) == 0 and len(self.changed) == 0 and len(self.removed) == 0 and self.order is None
+
+    def ApplyRecords(self, records) :
+        """records 为旧bin中按顺序排列的 {id: 记录}, 返回应用补丁后新的OrderedDict"""
+        removed = set(self.removed)
+        new_records = collections.OrderedDict()
+        for record_id, record in records.items() :
+            if record_id in removed :
+                continue
+            new_records[record_id] = self.changed.get(record_id, record)
+        for record_id, record in self.added.items() :
+            new_records[record_id] = record
+        if len(new_records) != self.count :
+            raise ValueError("patch does not match the records, %d records after patch, expect %d" % (
+                len(new_records), self.count))
+
+        if self.order is not None :
+            new_records = collections.OrderedDict((record_id, new_records[record_id]) for record_id in self.order)
+        return new_records
+
+def ApplyPatch(base_data, patch_data) :
+    """在旧bin上应用补丁, 返回新bin的数据, 和导出的新bin完全一致
+
+    旧bin的crc32和补丁不符时抛出ValueError, 此时只能整表重新加载
+    """
+    patch = RecordPatch(patch_data)
+    if Checksum(base_data) != patch.base_checksum :
+        raise ValueError("patch is not based on this data")
+
+    records = _RecordMap(base_data, record_file.SplitRecords(base_data, patch.id_field_number, patch.id_kind))
+    if records is None :
+        raise ValueError("duplicated ids in data")
+    new_data = []
+    for record in patch.ApplyRecords(records).values() :
+        new_data.append(record_file.ItemHeader(len(record)) + bytes(record))
+    new_data = b"".join(new_data)
+    if Checksum(new_data) != patch.checksum :
+        raise ValueError("checksum mismatch after patch")
+    return new_data
@@ -0,0 +1,610 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+##
+# @file:   sheet_reader.py
+# @brief:  导表工具读取表格的接口, 屏蔽不同的文件格式
+
+# 说明:
+#   1 导表工具只通过 SheetReader 的接口访问表格:
+#       HeaderValue     表头(前三行)的单元格
+#       ColCount        列数
+#       IterRows        从某一行开始逐行返回数据, 不要求整个sheet在内存中
+#       ContentHash     sheet内容的hash, 用于增量构建
+#   2 .xls 通过xlrd读取, 整个workbook在内存中
+#   3 .xlsx 直接用zipfile和增量的xml解析读取, 数据行在遍历时才解析,
+#     内存中只保留表头和共享字符串表
+#   4 .csv/.tsv 是脚本生成的表格, utf-8编码, 表头和excel相同,
+#     一个文件就是一个sheet, sheet名是去掉扩展名的文件名, 如 droprate-gen.csv,
+#     文件通过mmap映射, 数据行在遍历时才解析, 单元格的值都是文本
+#   5 .xls 解析很慢, 每个sheet的所有单元格可以保存为快照, 见 SnapshotWorkbook
+##
+
+import csv
+import hashlib
+import marshal
+import mmap
+import os
+import re
+import sys
+import zipfile
+import zlib
+
+try :
+    from xml.etree import cElementTree as ElementTree
+except ImportError :
+    from xml.etree import ElementTree
+
+try :
+    _text_type = unicode
+except NameError :
+    _text_type = str
+
+# 表头的行数, 之后都是数据
+HEADER_ROW_NUM = 3
+
+class SheetReader:
+    """读取一个sheet的接口, 行列都从0开始"""
+    def __init__(self, name):
+        self.name = name
+
+    def RowCount(self) :
+        """行数, 不知道时返回-1"""
+        return -1
+
+    def ColCount(self) :
+        """列数"""
+        raise NotImplementedError()
+
+    def HeaderValue(self, row, col) :
+        """表头单元格的值, 超出范围时为空字符串"""
+        raise NotImplementedError()
+
+    def IterRows(self, start_row) :
+        """返回(行号, 这一行所有单元格的值), 每行至少ColCount个值, 空行可能被跳过"""
+        raise NotImplementedError()
+
+    def ContentHash(self) :
+        """sheet内容的hash"""
+        raise NotImplementedError()
+
+class HeaderSheet(SheetReader):
+    """只保留另一个sheet的表头, 可以传给其他进程编译表头, 没有数据行"""
+    def __init__(self, sheet):
+        SheetReader.__init__(self, sheet.name)
+        self._col_count = sheet.ColCount()
+        self._header = [[sheet.HeaderValue(row, col) for col in range(self._col_count)]
+                for row in range(HEADER_ROW_NUM)]
+
+    def ColCount(self) :
+        return self._col_count
+
+    def HeaderValue(self, row, col) :
+        if row >= len(self._header) or col >= len(self._header[row]) :
+            return ""
+        return self._header[row][col]
+
+    def IterRows(self, start_row) :
+        return iter([])
+
+class XlsSheet(SheetReader):
+    """xlrd读取的.xls sheet"""
+    def __init__(self, sheet):
+        SheetReader.__init__(self, sheet.name)
+        self._sheet = sheet
+
+    def RowCount(self) :
+        return self._sheet.nrows
+
+    def ColCount(self) :
+        return self._sheet.ncols
+
+    def HeaderValue(self, row, col) :
+        if row >= self._sheet.nrows or col >= self._sheet.ncols :
+            return ""
+        return self._sheet.cell_value(row, col)
+
+    def IterRows(self, start_row) :
+        for row in range(start_row, self._sheet.nrows) :
+            yield row, self._sheet.row_values(row)
+
+    def ContentHash(self) :
+        """所有单元格的类型和值的hash"""
+        sha = hashlib.sha1()
+        for row in range(self._sheet.nrows) :
+            sha.update(repr(self._sheet.row_types(row)).encode("utf-8"))
+            sha.update(repr(self._sheet.row_values(row)).encode("utf-8"))
+        return sha.hexdigest()
+
+class XlsWorkbook:
+    """xlrd打开的.xls, sheet按需加载"""
+    def __init__(self, file_name):
+        import xlrd
+        self._workbook = xlrd.open_workbook(file_name, on_demand=True)
+
+    def SheetNames(self) :
+        return self._workbook.sheet_names()
+
+    def Sheet(self, sheet_name) :
+        return XlsSheet(self._workbook.sheet_by_name(sheet_name))
+
+    def Release(self) :
+        self._workbook.release_resources()
+
+# .xlsx 中用到的xml命名空间
+XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+XLSX_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+class XlsxWorkbook:
+    """直接读取.xlsx的zip包, 打开时只读取sheet列表, 共享字符串表在第一次打开sheet时读取"""
+    def __init__(self, file_name):
+        self._zip = zipfile.ZipFile(file_name)
+        self._shared_strings = None
+
+        rels = {}
+        rels_root = ElementTree.fromstring(self._zip.read("xl/_rels/workbook.xml.rels"))
+        for rel in rels_root.iter(XLSX_PKG_REL_NS + "Relationship") :
+            target = rel.get("Target")
+            # 绝对路径从包的根开始, 否则相对于xl/
+            if target.startswith("/") :
+                target = target[1:]
+            else :
+                target = "xl/" + target
+            rels[rel.get("Id")] = target
+
+        # 保持workbook中sheet的顺序
+        self._sheet_names = []
+        self._sheet_parts = {}
+        workbook_root = ElementTree.fromstring(self._zip.read("xl/workbook.xml"))
+        for sheet in workbook_root.iter(XLSX_NS + "sheet") :
+            sheet_name = _text_type(sheet.get("name"))
+            self._sheet_names.append(sheet_name)
+            self._sheet_parts[sheet_name] = rels[sheet.get(XLSX_REL_NS + "id")]
+
+    def SheetNames(self) :
+        return list(self._sheet_names)
+
+    def Sheet(self, sheet_name) :
+        if sheet_name not in self._sheet_parts :
+            raise KeyError("no sheet named <%s>" % sheet_name)
+        return XlsxSheet(self, sheet_name, self._sheet_parts[sheet_name])
+
+    def Release(self) :
+        self._shared_strings = None
+        self._zip.close()
+
+    def SharedStrings(self) :
+        """共享字符串表, 每个字符串是所有文本片段的拼接"""
+        if self._shared_strings is None :
+            self._shared_strings = []
+            if "xl/sharedStrings.xml" in self._zip.namelist() :
+                part = self._zip.open("xl/sharedStrings.xml")
+                for event, element in ElementTree.iterparse(part) :
+                    if element.tag == XLSX_NS + "si" :
+                        self._shared_strings.append(_XlsxText(element))
+                        element.clear()
+                part.close()
+        return self._shared_strings
+
+    def OpenPart(self, part_name) :
+        return self._zip.open(part_name)
+
+    def PartHash(self, sha, part_name) :
+        """将zip包中一个文件的内容加入hash"""
+        if part_name not in self._zip.namelist() :
+            return
+        part = self._zip.open(part_name)
+        while True :
+            block = part.read(1 << 20)
+            if not block :
+                break
+            sha.update(block)
+        part.close()
+
+def _XlsxText(element) :
+    """<si>或<is>中的文本, 富文本由多个<r><t>组成, 注音<rPh>不算在内"""
+    texts = []
+    for child in element :
+        if child.tag == XLSX_NS + "t" :
+            texts.append(child.text or "")
+        elif child.tag == XLSX_NS + "r" :
+            for t in child.iter(XLSX_NS + "t") :
+                texts.append(t.text or "")
+    return _text_type("".join(texts))
+
+_CELL_REF_PATTERN = re.compile(r"([A-Z]+)(\d+)")
+
+def _ColumnIndex(letters) :
+    """列名到下标, A -> 0, AA -> 26"""
+    col = 0
+    for letter in letters :
+        col = col * 26 + ord(letter) - ord("A") + 1
+    return col - 1
+
+class XlsxSheet(SheetReader):
+    """.xlsx中的一个sheet, 每次IterRows重新流式解析sheet的xml"""
+    def __init__(self, workbook, sheet_name, part_name):
+        SheetReader.__init__(self, sheet_name)
+        self._workbook = workbook
+        self._part_name = part_name
+        self._shared_strings = workbook.SharedStrings()
+
+        # <dimension>给出的范围, 没有时由表头决定
+        self._row_count = -1
+        self._col_count = 0
+        self._header = []
+        for row, row_values in self._IterXmlRows() :
+            if row >= HEADER_ROW_NUM :
+                break
+            while len(self._header) < row :
+                self._header.append([])
+            self._header.append(row_values)
+        for row_values in self._header :
+            self._col_count = max(self._col_count, len(row_values))
+
+    def RowCount(self) :
+        return self._row_count
+
+    def ColCount(self) :
+        return self._col_count
+
+    def HeaderValue(self, row, col) :
+        if row >= len(self._header) or col >= len(self._header[row]) :
+            return ""
+        return self._header[row][col]
+
+    def IterRows(self, start_row) :
+        for row, row_values in self._IterXmlRows() :
+            if row < start_row :
+                continue
+            if len(row_values) < self._col_count :
+                row_values.extend([""] * (self._col_count - len(row_values)))
+            yield row, row_values
+
+    def ContentHash(self) :
+        """sheet的xml和共享字符串表的hash, 其他sheet改动共享字符串时也会失效"""
+        sha = hashlib.sha1()
+        self._workbook.PartHash(sha, self._part_name)
+        self._workbook.PartHash(sha, "xl/sharedStrings.xml")
+        return sha.hexdigest()
+
+    def _IterXmlRows(self) :
+        """流式解析sheet的xml, 每解析完一行返回一行, 解析过的元素随即释放"""
+        shared_strings = self._shared_strings
+        row_tag = XLSX_NS + "row"
+        cell_tag = XLSX_NS + "c"
+        value_tag = XLSX_NS + "v"
+        inline_tag = XLSX_NS + "is"
+        dimension_tag = XLSX_NS + "dimension"
+        sheet_data_tag = XLSX_NS + "sheetData"
+
+        part = self._workbook.OpenPart(self._part_name)
+        try :
+            next_row = 0
+            sheet_data = None
+            for event, element in ElementTree.iterparse(part, events=("start", "end")) :
+                if event == "start" :
+                    if element.tag == sheet_data_tag :
+                        sheet_data = element
+                    continue
+
+                if element.tag == row_tag :
+                    # 行号可以省略, 这时就是上一行的下一行
+                    row = element.get("r")
+                    row = next_row if row is None else int(row) - 1
+                    next_row = row + 1
+
+                    row_values = []
+                    for cell in element.iter(cell_tag) :
+                        ref = cell.get("r")
+                        if ref is not None :
+                            col = _ColumnIndex(_CELL_REF_PATTERN.match(ref).group(1))
+                        else :
+                            col = len(row_values)
+                        while len(row_values) < col :
+                            row_values.append("")
+                        row_values.append(self._CellValue(cell, shared_strings, value_tag, inline_tag))
+                    # 已经解析过的行从树中删除, 内存占用和行数无关
+                    sheet_data.clear()
+                    yield row, row_values
+
+                elif element.tag == dimension_tag :
+                    # 例如A1:O3002, 只有一个单元格时没有冒号
+                    match = _CELL_REF_PATTERN.match(element.get("ref", "").split(":")[-1])
+                    if match is not None :
+                        self._row_count = int(match.group(2))
+                        self._col_count = max(self._col_count, _ColumnIndex(match.group(1)) + 1)
+        finally :
+            part.close()
+
+    @staticmethod
+    def _CellValue(cell, shared_strings, value_tag, inline_tag) :
+        """和xlrd一致: 数值为float, 文本为unicode, 布尔值为int, 空为空字符串"""
+        cell_type = cell.get("t", "n")
+        if cell_type == "inlineStr" :
+            inline = cell.find(inline_tag)
+            return _XlsxText(inline) if inline is not None else ""
+
+        value = cell.find(value_tag)
+        if value is None or value.text is None :
+            return ""
+        text = value.text
+        if cell_type == "s" :
+            return shared_strings[int(text)]
+        elif cell_type == "n" :
+            return float(text)
+        elif cell_type == "b" :
+            return int(text)
+        # str 公式的结果, e 错误值, 都按文本处理
+        return _text_type(text)
+
+class CsvWorkbook:
+    """脚本生成的.csv或.tsv, 只有一个sheet"""
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._sheet_name = _text_type(os.path.splitext(os.path.basename(file_name))[0])
+        if file_name.lower().endswith(".tsv") :
+            self._dialect = csv.excel_tab
+        else :
+            self._dialect = csv.excel
+        self._file = None
+        self._data = None
+
+    def SheetNames(self) :
+        return [self._sheet_name]
+
+    def Sheet(self, sheet_name) :
+        if sheet_name != self._sheet_name :
+            raise KeyError("no sheet named <%s>" % sheet_name)
+        if self._file is None :
+            self._file = open(self._file_name, "rb")
+            # 空文件不能映射
+            if os.path.getsize(self._file_name) > 0 :
+                self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            else :
+                self._data = b""
+        return CsvSheet(self._sheet_name, self._data, self._dialect)
+
+    def Release(self) :
+        if isinstance(self._data, mmap.mmap) :
+            self._data.close()
+        self._data = None
+        if self._file is not None :
+            self._file.close()
+            self._file = None
+
+class CsvSheet(SheetReader):
+    """mmap映射的csv, 每次IterRows从头逐行解析"""
+    def __init__(self, sheet_name, data, dialect):
+        SheetReader.__init__(self, sheet_name)
+        self._data = data
+        self._dialect = dialect
+
+        self._header = []
+        for row, row_values in self._IterCsvRows() :
+            if row >= HEADER_ROW_NUM :
+                break
+            self._header.append(row_values)
+        self._col_count = max([0] + [len(row_values) for row_values in self._header])
+
+    def ColCount(self) :
+        return self._col_count
+
+    def HeaderValue(self, row, col) :
+        if row >= len(self._header) or col >= len(self._header[row]) :
+            return ""
+        return self._header[row][col]
+
+    def IterRows(self, start_row) :
+        for row, row_values in self._IterCsvRows() :
+            if row < start_row :
+                continue
+            if len(row_values) < self._col_count :
+                row_values.extend([""] * (self._col_count - len(row_values)))
+            yield row, row_values
+
+    def ContentHash(self) :
+        sha = hashlib.sha1()
+        for start in range(0, len(self._data), 1 << 20) :
+            sha.update(self._data[start:start + (1 << 20)])
+        return sha.hexdigest()
+
+    def _IterLines(self) :
+        """按行切分映射的文件, 不移动mmap的读位置, 可以同时有多个遍历"""
+        data = self._data
+        size = len(data)
+        pos = 0
+        if data[0:3] == b"\xef\xbb\xbf" :
+            pos = 3
+        while pos < size :
+            end = data.find(b"\n", pos)
+            end = size if end < 0 else end + 1
+            yield data[pos:end]
+            pos = end
+
+    def _IterCsvRows(self) :
+        """逐条解析csv记录, 引号中的换行由csv模块跨行拼接"""
+        if sys.version_info[0] < 3 :
+            for row, record in enumerate(csv.reader(self._IterLines(), self._dialect)) :
+                yield row, [field.decode("utf-8") for field in record]
+        else :
+            lines = (line.decode("utf-8") for line in self._IterLines())
+            for row, record in enumerate(csv.reader(lines, self._dialect)) :
+                yield row, record
+
+class SnapshotSheet(SheetReader):
+    """从快照读出的sheet, 所有单元格在内存中"""
+    def __init__(self, sheet_name, col_count, rows, content_hash):
+        SheetReader.__init__(self, sheet_name)
+        self._col_count = col_count
+        self._rows = rows
+        self._content_hash = content_hash
+
+    def RowCount(self) :
+        return len(self._rows)
+
+    def ColCount(self) :
+        return self._col_count
+
+    def HeaderValue(self, row, col) :
+        if row >= len(self._rows) or col >= self._col_count :
+            return ""
+        return self._rows[row][col]
+
+    def IterRows(self, start_row) :
+        for row in range(start_row, len(self._rows)) :
+            yield row, self._rows[row]
+
+    def ContentHash(self) :
+        return self._content_hash
+
+class SnapshotWorkbook:
+    """.xls的sheet名和每个sheet的单元格保存为快照, 文件没有变化时不再调用xlrd
+
+    快照在snapshot_dir下, 用marshal序列化后zlib压缩, 只能由相同大版本的python读取.
+    文件的大小和修改时间都没有变化时直接使用快照; 只有修改时间变化时比较文件内容的hash,
+    内容相同仍然使用快照. 使用时更新快照文件的修改时间, 由 TrimSnapshots 淘汰最久没有使用的
+    """
+    VERSION = 1
+
+    def __init__(self, file_name, snapshot_dir):
+        self._file_name = file_name
+        self._dir = os.path.join(snapshot_dir, "py%d" % sys.version_info[0])
+        self._key = hashlib.sha1(os.path.abspath(file_name).encode("utf-8")).hexdigest()
+        stat = os.stat(file_name)
+        self._size = stat.st_size
+        self._mtime = stat.st_mtime
+        self._file_hash = None
+        self._workbook = None
+
+    def _FileHash(self) :
+        if self._file_hash is None :
+            sha = hashlib.sha1()
+            xls_file = open(self._file_name, "rb")
+            while True :
+                block = xls_file.read(1 << 20)
+                if not block :
+                    break
+                sha.update(block)
+            xls_file.close()
+            self._file_hash = sha.hexdigest()
+        return self._file_hash
+
+    def _Workbook(self) :
+        if self._workbook is None :
+            self._workbook = XlsWorkbook(self._file_name)
+        return self._workbook
+
+    def _SnapshotFile(self, name) :
+        return os.path.join(self._dir, "%s-%s.snap" % (self._key,
+            hashlib.sha1(name.encode("utf-8")).hexdigest()[:16]))
+
+    def _Load(self, snapshot_file) :
+        """快照中的数据, 没有快照或者文件已经变化时返回None"""
+        if not os.path.exists(snapshot_file) :
+            return None
+        try :
+            snapshot = open(snapshot_file, "rb")
+            version, size, mtime, file_hash, data = marshal.loads(zlib.decompress(snapshot.read()))
+            snapshot.close()
+        except (ValueError, EOFError, TypeError, zlib.error) :
+            return None
+        if version != SnapshotWorkbook.VERSION or size != self._size :
+            return None
+        if mtime != self._mtime :
+            if file_hash != self._FileHash() :
+                return None
+            # 内容没有变化, 更新修改时间, 下次不用再计算hash
+            self._Save(snapshot_file, data)
+        else :
+            os.utime(snapshot_file, None)
+        return data
+
+    def _Save(self, snapshot_file, data) :
+        if not os.path.exists(self._dir) :
+            try :
+                os.makedirs(self._dir)
+            except OSError :
+                # 其他进程同时创建
+                pass
+        # 多个进程可能同时保存同一个快照
+        tmp_file_name = "%s.%d.tmp" % (snapshot_file, os.getpid())
+        tmp_file = open(tmp_file_name, "wb")
+        tmp_file.write(zlib.compress(marshal.dumps((SnapshotWorkbook.VERSION, self._size, self._mtime,
+            self._FileHash(), data)), 1))
+        tmp_file.close()
+        if os.path.exists(snapshot_file) :
+            os.remove(snapshot_file)
+        os.rename(tmp_file_name, snapshot_file)
+
+    def SheetNames(self) :
+        snapshot_file = self._SnapshotFile(u"")
+        sheet_names = self._Load(snapshot_file)
+        if sheet_names is None :
+            sheet_names = self._Workbook().SheetNames()
+            self._Save(snapshot_file, sheet_names)
+        return sheet_names
+
+    def Sheet(self, sheet_name) :
+        snapshot_file = self._SnapshotFile(u"sheet:" + sheet_name)
+        data = self._Load(snapshot_file)
+        if data is None :
+            sheet = self._Workbook().Sheet(sheet_name)
+            data = (sheet.ColCount(), [row_values for row, row_values in sheet.IterRows(0)], sheet.ContentHash())
+            self._Save(snapshot_file, data)
+        col_count, rows, content_hash = data
+        return SnapshotSheet(sheet_name, col_count, rows, content_hash)
+
+    def Release(self) :
+        if self._workbook is not None :
+            self._workbook.Release()
+            self._workbook = None
+
+def TrimSnapshots(snapshot_dir, max_bytes) :
+    """快照总大小超过max_bytes时, 删除最久没有使用的快照, 返回删除的文件数"""
+    snapshots = []
+    total = 0
+    for root, dirs, files in os.walk(snapshot_dir) :
+        for file_name in files :
+            file_path = os.path.join(root, file_name)
+            try :
+                stat = os.stat(file_path)
+            except OSError :
+                continue
+            snapshots.append((stat.st_mtime, stat.st_size, file_path))
+            total += stat.st_size
+
+    removed = 0
+    snapshots.sort()
+    for mtime, size, file_path in snapshots :
+        if total <= max_bytes :
+            break
+        try :
+            os.remove(file_path)
+        except OSError :
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+# 支持的表格文件扩展名
+WORKBOOK_TYPES = {
+    ".xls" : XlsWorkbook,
+    ".xlsx" : XlsxWorkbook,
+    ".csv" : CsvWorkbook,
+    ".tsv" : CsvWorkbook,
+}
+
+def IsWorkbookFile(file_name) :
+    return os.path.splitext(file_name)[1].lower() in WORKBOOK_TYPES
+
+def OpenWorkbook(file_name, snapshot_dir=None) :
+    """按扩展名打开表格文件, 不认识的扩展名按.xls处理
+
+    指定snapshot_dir时.xls使用快照, 见 SnapshotWorkbook
+    """
+    workbook_type = WORKBOOK_TYPES.get(os.path.splitext(file_name)[1].lower(), XlsWorkbook)
+    if workbook_type is XlsWorkbook and snapshot_dir is not None :
+        return SnapshotWorkbook(file_name, snapshot_dir)
+    return workbook_type(file_name)
@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+##
+# @file:   string_pool.py
+# @brief:  去重的字符串表, 字符串属性改为字符串表下标的bin, 以及按需解码的加载器
+
+# 说明:
+#   1 字符串表文件格式, 整数都是小端:
+#       文件头      magic "XSTR", 版本号 uint32, 字符串数 uint32, 保留 uint32
+#       偏移        字符串数+1个 uint32, 第i个字符串为 blob[偏移i:偏移i+1]
+#       blob        所有字符串的utf-8依次拼接
+#   2 下标0固定为空字符串, 和proto3中没有设值的uint32一致
+#   3 池化的bin和原来的bin格式相同, 只是所有string属性(包括结构中的)都改为uint32的下标,
+#     属性编号不变, 重复的string属性为不packed的uint32数组; bytes属性不变
+#   4 导出时只依赖标准库, 由bin文件直接按wire格式转换, 和protobuf的实现无关
+#
+#   用法:
+#       pool = string_pool.StringPool("build_out/pool/example.pool")
+#       item_class, array_class = string_pool.PooledClasses(example_pb2.example)
+#       items = array_class.FromString(open("build_out/pool/example.bin", "rb").read()).items
+#       make = pool.Get(items[0].make)      # 访问时才解码
+##
+
+import mmap
+import os
+import struct
+
+POOL_MAGIC = b"XSTR"
+POOL_VERSION = 1
+
+_HEADER = struct.Struct("<4sIII")
+_OFFSET = struct.Struct("<I")
+
+# FieldDescriptorProto中的类型编号
+TYPE_STRING = 9
+TYPE_MESSAGE = 11
+TYPE_UINT32 = 13
+
+def _ReadVarint(buf, pos) :
+    result = 0
+    shift = 0
+    while True :
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not (byte & 0x80) :
+            return result, pos
+        shift += 7
+
+def _WriteVarint(value) :
+    buf = bytearray()
+    while True :
+        byte = value & 0x7f
+        value >>= 7
+        if value :
+            buf.append(byte | 0x80)
+        else :
+            buf.append(byte)
+            return bytes(buf)
+
+def StringFields(message_descriptor) :
+    """消息中需要池化的属性, {属性编号: 0} 为string属性, {属性编号: {...}} 为含有string属性的结构
+
+    结果可以json序列化, 序列化后属性编号为字符串, PoolRecord 两种都接受
+    """
+    fields = {}
+    for field in message_descriptor.fields :
+        if field.type == TYPE_STRING :
+            fields[field.number] = 0
+        elif field.type == TYPE_MESSAGE :
+            sub_fields = StringFields(field.message_type)
+            if len(sub_fields) > 0 :
+                fields[field.number] = sub_fields
+    return fields
+
+class PoolBuilder:
+    """收集去重的字符串, 按第一次出现的顺序编号"""
+    def __init__(self):
+        self._index = {b"" : 0}
+        self._strings = [b""]
+
+    def __len__(self) :
+        return len(self._strings)
+
+    def Add(self, data) :
+        """utf-8的字符串, 返回下标"""
+        index = self._index.get(data)
+        if index is None :
+            index = len(self._strings)
+            self._index[data] = index
+            self._strings.append(data)
+        return index
+
+    def Write(self, out_file) :
+        offsets = [0]
+        for data in self._strings :
+            offsets.append(offsets[-1] + len(data))
+        if offsets[-1] >= (1 << 32) :
+            raise ValueError("string pool is larger than 4GB")
+        out_file.write(_HEADER.pack(POOL_MAGIC, POOL_VERSION, len(self._strings), 0))
+        out_file.write(b"".join([_OFFSET.pack(offset) for offset in offsets[1:]]))
+        out_file.write(b"".join(self._strings))
+
+def PoolRecord(buf, string_fields, builder) :
+    """一个序列化的消息中string属性改为下标, 返回新的序列化数据"""
+    pieces = []
+    pos = 0
+    end = len(buf)
+    while pos < end :
+        start = pos
+        tag, pos = _ReadVarint(buf, pos)
+        field_number = tag >> 3
+        wire_type = tag & 0x7
+        if wire_type == 0 :
+            pos = _ReadVarint(buf, pos)[1]
+        elif wire_type == 1 :
+            pos += 8
+        elif wire_type == 5 :
+            pos += 4
+        elif wire_type == 2 :
+            length, value_start = _ReadVarint(buf, pos)
+            pos = value_start + length
+            sub_fields = string_fields.get(field_number)
+            if sub_fields is None :
+                sub_fields = string_fields.get(str(field_number))
+            if sub_fields == 0 :
+                pieces.append(_WriteVarint(field_number << 3))
+                pieces.append(_WriteVarint(builder.Add(bytes(buf[value_start:pos]))))
+                continue
+            elif sub_fields is not None :
+                value = PoolRecord(buf[value_start:pos], sub_fields, builder)
+                pieces.append(_WriteVarint(tag))
+                pieces.append(_WriteVarint(len(value)))
+                pieces.append(value)
+                continue
+        else :
+            raise ValueError("unsupported wire type %d" % wire_type)
+        pieces.append(bytes(buf[start:pos]))
+    return b"".join(pieces)
+
+def WritePooledFile(data, string_fields, builder, out_file) :
+    """<sheet>_array序列化的数据池化后写到out_file, 字符串加入builder, 返回记录数"""
+    count = 0
+    buf = bytearray(data)
+    pos = 0
+    end = len(buf)
+    while pos < end :
+        if buf[pos] != 0x0a :
+            raise ValueError("unexpected tag %d at byte %d" % (buf[pos], pos))
+        length, start = _ReadVarint(buf, pos + 1)
+        pos = start + length
+        record = PoolRecord(buf[start:pos], string_fields, builder)
+        out_file.write(b"\x0a" + _WriteVarint(len(record)))
+        out_file.write(record)
+        count += 1
+    return count
+
+class StringPool:
+    """按需读取字符串表, mmap整个文件, 字符串在访问时才解码, 解码后缓存"""
+    def __init__(self, file_name):
+        self._cache = {}
+        self._file = open(file_name, "rb")
+        if os.path.getsize(file_name) < _HEADER.size :
+            self._file.close()
+            raise ValueError("%s is not a string pool" % file_name)
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, reserved = _HEADER.unpack_from(self._data, 0)
+        if magic != POOL_MAGIC or version != POOL_VERSION :
+            self.Close()
+            raise ValueError("%s is not a string pool of version %d" % (file_name, POOL_VERSION))
+        self._blob = _HEADER.size + _OFFSET.size * self._count
+
+    def __len__(self) :
+        return self._count
+
+    def GetData(self, index) :
+        """第index个字符串的utf-8"""
+        if index < 0 or index >= self._count :
+            raise IndexError("string index %d out of range" % index)
+        start = 0
+        if index > 0 :
+            start = _OFFSET.unpack_from(self._data, _HEADER.size + _OFFSET.size * (index - 1))[0]
+        end = _OFFSET.unpack_from(self._data, _HEADER.size + _OFFSET.size * index)[0]
+        return self._data[self._blob + start:self._blob + end]
+
+    def Get(self, index) :
+        """第index个字符串, unicode"""
+        value = self._cache.get(index)
+        if value is None :
+            value = self.GetData(index).decode("utf-8")
+            self._cache[index] = value
+        return value
+
+    def Close(self) :
+        self._cache.clear()
+        self._data.close()
+        self._file.close()
+
+def PooledClasses(message_class) :
+    """message_class(例如 example_pb2.example)对应的池化的 (<sheet>, <sheet>_array) 类
+
+    所有string属性改为uint32, 用来解析池化的bin, 需要protobuf
+    """
+    from google.protobuf import descriptor_pb2
+    from google.protobuf import descriptor_pool
+    from google.protobuf import message_factory
+
+    def _PoolMessage(message_proto) :
+        for field in message_proto.field :
+            if field.type == TYPE_STRING :
+                field.type = TYPE_UINT32
+        for nested_proto in message_proto.nested_type :
+            _PoolMessage(nested_proto)
+
+    file_descriptor = message_class.DESCRIPTOR.file
+    file_proto = descriptor_pb2.FileDescriptorProto()
+    file_descriptor.CopyToProto(file_proto)
+    for message_proto in file_proto.message_type :
+        _PoolMessage(message_proto)
+
+    pool = descriptor_pool.DescriptorPool()
+    for dependency in file_descriptor.dependencies :
+        pool.AddSerializedFile(dependency.serialized_pb)
+    pool.AddSerializedFile(file_proto.SerializeToString())
+    factory = message_factory.MessageFactory(pool)
+    full_name = message_class.DESCRIPTOR.full_name
+    return (factory.GetPrototype(pool.FindMessageTypeByName(full_name)),
+            factory.GetPrototype(pool.FindMessageTypeByName(full_name + "_array")))
@@ -0,0 +1,455 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+##
+# @file:   xls_bench.py
+# @brief:  导表工具的性能测试, 生成指定规模的表格, 完整导出并和基线比较
+
+# 说明:
+#   1 在工程根目录执行, 需要先生成过 build_out/py/enum_pb2.py
+#   2 生成的表格按导表工具的表头规则, 包括:
+#       普通属性        int32 float string
+#       枚举            enum-<enum.proto中的第一个枚举>
+#       分号相隔的数组  int32[]
+#       重复次数列      N[] 后面跟N列的int32
+#     工具目前的表头规则中没有结构体(required_struct/optional_struct)的写法, 所以不生成
+#   3 表格生成在 build_out/bench/xls 下, 相同参数的表格只生成一次,
+#     在 build_out/bench/work 中单独导出, 不影响正常的输出
+#   4 结果包括 行/秒, 单元格/秒, 导出进程的内存峰值和各阶段的耗时,
+#     可以保存为基线, 之后和基线比较, 变慢或者内存增长超过阈值时返回1
+#   5 不认识的参数原样传给导表工具, 如 --encoder wire, --stream
+#   6 --codec-bench 不导表, 对已经导出的bin文件比较各压缩方式和级别的大小, 压缩和解压的耗时
+#
+#   例如:
+#       python deploy/xls_bench.py --rows 100000 --fields 40 --save-baseline bench.json
+#       python deploy/xls_bench.py --rows 100000 --fields 40 --baseline bench.json --encoder wire
+#       python deploy/xls_bench.py --codec-bench build_out/bin/example.bin
+##
+
+import collections
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+import zipfile
+
+from xml.sax.saxutils import escape
+
+import block_codec
+import xls_deploy
+
+BENCH_DIR = "build_out/bench"
+
+# 生成的属性类型, 按顺序循环
+FIELD_KINDS = ["int32", "float", "string", "enum", "list", "repeated"]
+
+# 重复次数列的最大重复次数
+REPEATED_NUM = 3
+
+# 和基线比较的指标, True表示越大越好
+BENCH_METRICS = collections.OrderedDict([
+    ("rows_per_sec", True),
+    ("cells_per_sec", True),
+    ("peak_rss", False),
+])
+
+def _ColumnName(col) :
+    """下标到列名, 0 -> A, 26 -> AA"""
+    name = ""
+    col += 1
+    while col > 0 :
+        col, rest = divmod(col - 1, 26)
+        name = chr(ord("A") + rest) + name
+    return name
+
+class SyntheticSheet:
+    """按表头规则随机生成的sheet, 参数相同时内容相同"""
+    def __init__(self, row_num, field_num, enum_type_name, enum_names, seed=0):
+        self._row_num = row_num
+        self._enum_names = enum_names
+        self._seed = seed
+        # 字符串从有限的集合中选, 和实际配置一样有大量重复
+        self._strings = [u"名字%d" % i for i in range(1000)]
+
+        # 表头三行: 注释, 类型, 属性名
+        self.header = [[], [], []]
+        self._kinds = []
+        self._AddColumn("id", u"uint32", u"id")
+        for i in range(field_num) :
+            kind = FIELD_KINDS[i % len(FIELD_KINDS)]
+            field_name = u"f%d" % i
+            if kind == "enum" :
+                self._AddColumn(kind, u"enum-" + enum_type_name, field_name)
+            elif kind == "list" :
+                self._AddColumn(kind, u"int32[]", field_name)
+            elif kind == "repeated" :
+                self._AddColumn(kind, u"%d[]" % REPEATED_NUM, u"")
+                self._AddColumn("value", u"int32", field_name)
+                for j in range(1, REPEATED_NUM) :
+                    self._AddColumn("value", u"", u"")
+            else :
+                self._AddColumn(kind, _Text(kind), field_name)
+
+    def _AddColumn(self, kind, field_type, field_name) :
+        self.header[0].append(u"%s %s" % (kind, field_name) if field_name else u"")
+        self.header[1].append(field_type)
+        self.header[2].append(field_name)
+        self._kinds.append(kind)
+
+    def RowCount(self) :
+        """包括表头的行数"""
+        return len(self.header) + self._row_num
+
+    def ColCount(self) :
+        return len(self._kinds)
+
+    def IterRows(self) :
+        """先返回表头, 再返回数据行, 数值为int或float, 文本为unicode, 空单元格为空字符串"""
+        for values in self.header :
+            yield values
+
+        rand = random.Random(self._seed)
+        for row in range(self._row_num) :
+            values = []
+            repeated_left = 0
+            for kind in self._kinds :
+                if kind == "id" :
+                    values.append(row + 1)
+                elif kind == "int32" :
+                    values.append(rand.randint(-1000000, 1000000))
+                elif kind == "float" :
+                    values.append(rand.randint(0, 1000000) / 8.0)
+                elif kind == "string" :
+                    values.append(rand.choice(self._strings))
+                elif kind == "enum" :
+                    values.append(rand.choice(self._enum_names))
+                elif kind == "list" :
+                    values.append(u";".join([_Text(rand.randint(0, 9999)) for i in range(rand.randint(0, 4))]))
+                elif kind == "repeated" :
+                    repeated_left = rand.randint(0, REPEATED_NUM)
+                    values.append(repeated_left)
+                else :
+                    values.append(rand.randint(0, 9999) if repeated_left > 0 else u"")
+                    repeated_left -= 1
+            yield values
+
+def _Text(value) :
+    """单元格的值转为文本, float保留全部精度"""
+    if isinstance(value, float) :
+        return u"%r" % value
+    return u"%s" % value
+
+def WriteXlsx(file_name, sheet_name, sheet) :
+    """写一个只有一个sheet的最简.xlsx, 文本都放在共享字符串表中"""
+    shared_strings = []
+    shared_index = {}
+    col_names = [_ColumnName(col) for col in range(sheet.ColCount())]
+
+    # sheet的xml逐行写到临时文件, 内存占用和行数无关
+    sheet_tmp_name = file_name + ".sheet.tmp"
+    sheet_file = io.open(sheet_tmp_name, "w", encoding="utf-8")
+    sheet_file.write(u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            u'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            u'<dimension ref="A1:%s%d"/><sheetData>' % (col_names[-1], sheet.RowCount()))
+    for row, values in enumerate(sheet.IterRows()) :
+        cells = []
+        for col, value in enumerate(values) :
+            if value == u"" :
+                continue
+            ref = u"%s%d" % (col_names[col], row + 1)
+            if isinstance(value, (int, float)) :
+                cells.append(u'<c r="%s"><v>%s</v></c>' % (ref, _Text(value)))
+                continue
+            index = shared_index.get(value)
+            if index is None :
+                index = len(shared_strings)
+                shared_index[value] = index
+                shared_strings.append(value)
+            cells.append(u'<c r="%s" t="s"><v>%d</v></c>' % (ref, index))
+        sheet_file.write(u'<row r="%d">%s</row>' % (row + 1, u"".join(cells)))
+    sheet_file.write(u"</sheetData></worksheet>")
+    sheet_file.close()
+
+    xlsx = zipfile.ZipFile(file_name, "w", zipfile.ZIP_DEFLATED)
+    xlsx.writestr("[Content_Types].xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '<Override PartName="/xl/sharedStrings.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+            '</Types>')
+    xlsx.writestr("_rels/.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>')
+    xlsx.writestr("xl/workbook.xml", (u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            u'<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            u'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            u'<sheets><sheet name="%s" sheetId="1" r:id="rId1"/></sheets></workbook>'
+            % escape(sheet_name)).encode("utf-8"))
+    xlsx.writestr("xl/_rels/workbook.xml.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/>'
+            '<Relationship Id="rId2" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" '
+            'Target="sharedStrings.xml"/></Relationships>')
+    xlsx.write(sheet_tmp_name, "xl/worksheets/sheet1.xml")
+    xlsx.writestr("xl/sharedStrings.xml", (u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            u'<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            u'count="%d" uniqueCount="%d">%s</sst>' % (len(shared_strings), len(shared_strings),
+                u"".join([u"<si><t>%s</t></si>" % escape(value) for value in shared_strings]))).encode("utf-8"))
+    xlsx.close()
+    os.remove(sheet_tmp_name)
+
+def WriteCsv(file_name, sheet, separator) :
+    """写.csv或.tsv, 生成的文本中没有分隔符和引号, 不需要转义"""
+    csv_file = io.open(file_name, "w", encoding="utf-8", newline="\n")
+    for values in sheet.IterRows() :
+        csv_file.write(separator.join([_Text(value) for value in values]) + u"\n")
+    csv_file.close()
+
+def GenerateWorkbook(option) :
+    """生成测试用的表格, 参数相同的表格已经存在时直接使用, 返回文件名"""
+    enum_index = xls_deploy.LoadEnumIndex()
+    enum_type_name = sorted(enum_index.keys())[0]
+    enum_names = sorted(enum_index[enum_type_name].keys())
+
+    xls_dir = os.path.join(BENCH_DIR, "xls")
+    xls_deploy.CheckAndCreateDir(xls_dir)
+    file_name = os.path.join(xls_dir, "bench_r%d_f%d_s%d.%s" % (option.rows, option.fields, option.seed,
+        option.format))
+    if os.path.exists(file_name) :
+        return file_name
+
+    sheet = SyntheticSheet(option.rows, option.fields, enum_type_name, enum_names, option.seed)
+    start = time.time()
+    tmp_file_name = file_name + ".tmp"
+    if option.format == "xlsx" :
+        WriteXlsx(tmp_file_name, u"bench-synthetic", sheet)
+    else :
+        WriteCsv(tmp_file_name, sheet, u"\t" if option.format == "tsv" else u",")
+    os.rename(tmp_file_name, file_name)
+    print("generate %s, %d rows, %d cols, %.2fs" % (file_name, sheet.RowCount(), sheet.ColCount(),
+        time.time() - start))
+    return file_name
+
+def _PrepareWorkDir(work_dir, xls_file) :
+    """导出用的目录, 只放测试的表格, enum.proto和生成的enum_pb2"""
+    if os.path.exists(work_dir) :
+        shutil.rmtree(work_dir)
+    for sub_dir in ("xls", "protocol", "build_out/py") :
+        xls_deploy.CheckAndCreateDir(os.path.join(work_dir, sub_dir))
+    # csv的sheet名就是文件名
+    file_name = os.path.basename(xls_file)
+    if not file_name.endswith(".xlsx") :
+        file_name = "bench-synthetic" + os.path.splitext(file_name)[1]
+    shutil.copy(xls_file, os.path.join(work_dir, "xls", file_name))
+    shutil.copy(xls_deploy.BuildCache.ENUM_PROTO_FILE, os.path.join(work_dir, "protocol"))
+    shutil.copy(os.path.join("build_out", "py", "enum_pb2.py"), os.path.join(work_dir, "build_out", "py"))
+
+def _PeakRss() :
+    """已结束的子进程中最大的常驻内存, 不支持时为None"""
+    try :
+        import resource
+    except ImportError :
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # linux以KB为单位, mac以字节为单位
+    if sys.platform != "darwin" :
+        peak *= 1024
+    return peak
+
+def RunExport(work_dir, deploy_args) :
+    """在work_dir中完整导出一次, 返回耗时和导表工具的报告"""
+    deploy_script = os.path.splitext(os.path.abspath(xls_deploy.__file__))[0] + ".py"
+    command = [sys.executable, "-B", deploy_script, "--force", "--no-codegen", "-j", "1"] + deploy_args + ["xls"]
+    log_file = open(os.path.join(work_dir, "deploy.log"), "w")
+    start = time.time()
+    ret = subprocess.call(command, cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    log_file.close()
+    if ret != 0 :
+        raise RuntimeError("export failed(%d), see %s" % (ret, os.path.join(work_dir, "deploy.log")))
+
+    report_file = open(os.path.join(work_dir, xls_deploy.WriteReport.REPORT_FILE), "r")
+    report = json.load(report_file)
+    report_file.close()
+    return wall, report
+
+def Bench(option, deploy_args) :
+    """生成表格并导出option.repeat次, 取最快的一次"""
+    xls_file = GenerateWorkbook(option)
+    work_dir = os.path.join(BENCH_DIR, "work")
+
+    best = None
+    for i in range(option.repeat) :
+        _PrepareWorkDir(work_dir, xls_file)
+        wall, report = RunExport(work_dir, deploy_args)
+        print("run %d: %.3fs" % (i + 1, wall))
+        if best is None or wall < best[0] :
+            best = (wall, report)
+
+    wall, report = best
+    phases = collections.OrderedDict()
+    for sheet in report["sheets"] :
+        for name, phase in sheet.get("phases", {}).items() :
+            phases[name] = phases.get(name, 0.0) + phase["wall"]
+
+    return collections.OrderedDict([
+        ("config", {"rows" : option.rows, "fields" : option.fields, "seed" : option.seed,
+            "format" : option.format, "deploy_args" : deploy_args}),
+        ("wall", wall),
+        ("rows", report["rows"]),
+        ("cells", report["cells"]),
+        ("rows_per_sec", report["rows"] / wall),
+        ("cells_per_sec", report["cells"] / wall),
+        ("peak_rss", _PeakRss()),
+        ("phases", phases),
+    ])
+
+def CompareBaseline(result, baseline, tolerance) :
+    """和基线比较, 返回超过阈值的指标说明"""
+    if baseline.get("config") != result["config"] :
+        print("warning: baseline config %s differs from %s" % (baseline.get("config"), result["config"]))
+
+    regressions = []
+    for name, higher_is_better in BENCH_METRICS.items() :
+        value = result.get(name)
+        base_value = baseline.get(name)
+        if value is None or not base_value :
+            continue
+        change = (value - base_value) / float(base_value)
+        print("%-14s %14.1f  baseline %14.1f  %+.1f%%" % (name, value, base_value, change * 100))
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance) :
+            regressions.append("%s %+.1f%%" % (name, change * 100))
+    return regressions
+
+def BenchCodecs(bin_files, block_size, repeat) :
+    """每种压缩方式按级别1, 默认级别和9分块压缩所有bin文件, 返回 [(压缩方式, 级别, 大小, 压缩耗时, 解压耗时)]
+
+    耗时取repeat次中最快的一次, 第一行为不压缩的原始大小
+    """
+    codec_dir = os.path.join(BENCH_DIR, "codec")
+    xls_deploy.CheckAndCreateDir(codec_dir)
+    datas = [block_codec.ReadData(bin_file) for bin_file in bin_files]
+    results = [("none", 0, sum([len(data) for data in datas]), 0.0, 0.0)]
+
+    for codec in block_codec.CODECS :
+        for level in sorted(set([1, block_codec.DefaultLevel(codec), 9])) :
+            size = 0
+            encode = 0.0
+            decode = 0.0
+            for i, data in enumerate(datas) :
+                file_name = os.path.join(codec_dir, "%d.%s.bin" % (i, codec))
+                best_encode = None
+                best_decode = None
+                for j in range(repeat) :
+                    start = time.time()
+                    out_file = open(file_name, "wb")
+                    writer = block_codec.BlockWriter(out_file, codec, level, block_size)
+                    writer.write(data)
+                    writer.Finish()
+                    out_file.close()
+                    encoded = time.time()
+
+                    block_file = block_codec.BlockFile(file_name)
+                    if block_file.Read() != data :
+                        raise RuntimeError("%s level %d: decoded data differs from %s" % (codec, level,
+                            bin_files[i]))
+                    block_file.Close()
+                    decoded = time.time()
+                    if best_encode is None or encoded - start < best_encode :
+                        best_encode = encoded - start
+                    if best_decode is None or decoded - encoded < best_decode :
+                        best_decode = decoded - encoded
+                size += os.path.getsize(file_name)
+                encode += best_encode
+                decode += best_decode
+                os.remove(file_name)
+            results.append((codec, level, size, encode, decode))
+    return results
+
+def _PrintCodecResults(results) :
+    raw_size = results[0][2]
+    print("%-6s %5s %12s %7s %10s %10s" % ("codec", "level", "size", "ratio", "encode", "decode"))
+    for codec, level, size, encode, decode in results :
+        print("%-6s %5s %12d %7.2f %9.1fms %9.1fms" % (codec, level if codec != "none" else "-", size,
+            raw_size / float(size) if size > 0 else 1.0, encode * 1000, decode * 1000))
+
+def _PrintResult(result) :
+    print("rows %d, cells %d, wall %.3fs" % (result["rows"], result["cells"], result["wall"]))
+    print("rows/sec %.1f, cells/sec %.1f, peak rss %s" % (result["rows_per_sec"], result["cells_per_sec"],
+        "%.1fMB" % (result["peak_rss"] / 1048576.0) if result["peak_rss"] is not None else "unknown"))
+    for name, wall in result["phases"].items() :
+        print("    %-10s %.3fs" % (name, wall))
+
+def main(argv) :
+    """入口"""
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="xls 导表工具性能测试, 不认识的参数传给导表工具")
+    arg_parser.add_argument("--rows", type=int, default=10000, help="数据行数, 默认10000")
+    arg_parser.add_argument("--fields", type=int, default=30,
+            help="除id外的属性个数, 各类型循环出现, 默认30")
+    arg_parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    arg_parser.add_argument("--format", choices=["xlsx", "csv", "tsv"], default="xlsx",
+            help="生成的表格格式, 默认xlsx")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="导出次数, 取最快的一次, 默认3")
+    arg_parser.add_argument("--baseline", help="和这个基线文件比较, 超过阈值时返回1")
+    arg_parser.add_argument("--tolerance", type=float, default=0.1,
+            help="和基线比较的阈值, 默认0.1即10%%")
+    arg_parser.add_argument("--save-baseline", metavar="FILE", help="将结果保存为基线")
+    arg_parser.add_argument("--codec-bench", nargs="*", metavar="BIN",
+            help="比较压缩方式, 不导表; 不指定文件时使用build_out/bin下所有的bin")
+    arg_parser.add_argument("--codec-block-size", type=int, default=block_codec.DEFAULT_BLOCK_SIZE,
+            help="比较压缩方式时每块原始数据的大小, 默认%d" % block_codec.DEFAULT_BLOCK_SIZE)
+    option, deploy_args = arg_parser.parse_known_args(argv[1:])
+
+    if option.codec_bench is not None :
+        bin_files = option.codec_bench
+        if len(bin_files) == 0 and os.path.isdir("build_out/bin") :
+            bin_files = [os.path.join("build_out/bin", file_name) for file_name in sorted(os.listdir("build_out/bin"))
+                    if file_name.endswith(".bin")]
+        if len(bin_files) == 0 :
+            print("no bin file to compress")
+            return 2
+        _PrintCodecResults(BenchCodecs(bin_files, option.codec_block_size, option.repeat))
+        return 0
+
+    try :
+        result = Bench(option, deploy_args)
+    except RuntimeError as e :
+        print(e)
+        return 2
+    _PrintResult(result)
+
+    if option.save_baseline :
+        baseline_file = open(option.save_baseline, "w")
+        json.dump(result, baseline_file, indent=1)
+        baseline_file.close()
+        print("save baseline to %s" % option.save_baseline)
+
+    if option.baseline :
+        baseline_file = open(option.baseline, "r")
+        baseline = json.load(baseline_file)
+        baseline_file.close()
+        regressions = CompareBaseline(result, baseline, option.tolerance)
+        if len(regressions) > 0 :
+            print("REGRESSION: %s" % ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__' :
+    sys.exit(main(sys.argv))
@@ -47,14 +47,33 @@
 #
 # 依赖:
 # 1 protobuf
-# 2 xlrd
+# 2 xlrd, 只在读取.xls时需要, .xlsx由sheet_reader直接读取
 ##
 
 
-import xlrd # for read excel
 import sys
 import os
-import platform
+import hashlib
+import json
+import bisect
+import collections
+import heapq
+import marshal
+import time
+import zlib
+
+import block_codec
+import column_file
+import record_file
+import record_patch
+import sheet_reader
+import string_pool
+
+# 工具版本号, 输出格式有变化时需要修改, 使增量构建缓存失效
+TOOL_VERSION = "1.1"
+
+# 表头语法和PB定义的生成规则的版本号, 有变化时需要修改, 使已生成的PB定义失效
+LAYOUT_VERSION = 1
 
 # TAP的空格数
 TAP_BLANK_NUM = 3
@@ -65,6 +84,13 @@ FIELD_TYPE_ROW = 1
 FIELD_NAME_ROW = 2
 FIELD_COMMENT_ROW = 0
 
+# 生成的PB的package
+PROTO_PACKAGE = "cfg"
+
+# 命令行的导出模式到option, all 生成proto和data, schema 只生成proto, data 只生成data,
+# auto 表头和已生成的proto一致时只生成data, 否则都生成
+DEPLOY_MODES = collections.OrderedDict([("all", 0), ("schema", 1), ("data", 2), ("auto", 3)])
+
 class CheckAndCreateDir:
     """判断并创建目录"""
     def __init__(self, path):
@@ -72,15 +98,72 @@ class CheckAndCreateDir:
         if not os.path.exists(self._path):
             os.makedirs(self._path)
 
+class AtomicFile:
+    """先写到临时文件, Commit时再替换目标文件, 中途失败不会留下写了一半的输出"""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._tmp_file_name = file_name + ".tmp"
+        if os.path.dirname(file_name) :
+            CheckAndCreateDir(os.path.dirname(file_name))
+        self._file = open(self._tmp_file_name, "wb")
+        self.write = self._file.write
+
+    @staticmethod
+    def Bytes(data) :
+        """文本统一按utf-8写入"""
+        if not isinstance(data, bytes) :
+            data = data.encode("utf-8")
+        return data
+
+    def Commit(self) :
+        self._file.close()
+        # windows下rename不能覆盖已有文件
+        if os.path.exists(self.file_name) :
+            os.remove(self.file_name)
+        os.rename(self._tmp_file_name, self.file_name)
+
+    def Abort(self) :
+        self._file.close()
+        os.remove(self._tmp_file_name)
+
+class CompressedFile(AtomicFile):
+    """压缩的分块bin文件, 写入的是原始数据, Commit时写完最后的块和索引, 见block_codec"""
+    def __init__(self, file_name, codec, level, block_size):
+        AtomicFile.__init__(self, file_name)
+        self._writer = block_codec.BlockWriter(self._file, codec, level, block_size)
+        self.write = self._writer.write
+
+    def Commit(self) :
+        self._writer.Finish()
+        AtomicFile.Commit(self)
+
 class LogHelp :
     """日志辅助类"""
     _logger = None
     _close_imme = True
 
+    # 日志详细程度, 0 只记录警告和错误, 1 记录sheet和表头信息, 2 记录每行每个单元格
+    VERBOSE_WARN = 0
+    VERBOSE_INFO = 1
+    VERBOSE_DETAIL = 2
+    verbose = VERBOSE_INFO
+
     @staticmethod
     def set_close_flag(flag):
         LogHelp._close_imme = flag
 
+    @staticmethod
+    def set_verbose(verbose):
+        """逐行的日志需要先判断 LogHelp.verbose, 关闭时不产生任何开销"""
+        import logging
+        LogHelp.verbose = verbose
+        if verbose >= LogHelp.VERBOSE_DETAIL :
+            LogHelp.get_logger().setLevel(logging.DEBUG)
+        elif verbose >= LogHelp.VERBOSE_INFO :
+            LogHelp.get_logger().setLevel(logging.INFO)
+        else :
+            LogHelp.get_logger().setLevel(logging.WARNING)
+
     @staticmethod
     def _initlog():
         import logging
@@ -120,15 +203,149 @@ LOG_WARN=LogHelp.get_logger().warn
 LOG_ERROR=LogHelp.get_logger().error
 
 
+def _CpuTime() :
+    """进程的cpu时间(用户态+内核态)"""
+    times = os.times()
+    return times[0] + times[1]
+
+class SheetProfile:
+    """记录一个sheet导出时各阶段的耗时, 行数, 单元格数和内存峰值
+
+    阶段的wall是自身耗时, 不包括其间通过Accumulate逐行累计到其他阶段的时间,
+    cpu包括这些逐行累计的时间
+    """
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.rows = 0
+        self.cells = 0
+        # 内存峰值(字节), 没有开启时为None; memory_source 为统计方式, 见 RunSheetJob
+        self.peak_memory = None
+        self.memory_source = None
+        self._accumulated = 0.0
+
+    def Phase(self, name) :
+        """统计一段代码的耗时: with profile.Phase("parse"): ..."""
+        return _ProfilePhase(self, name)
+
+    def Accumulate(self, name, wall) :
+        """逐行累计的阶段只统计wall"""
+        phase = self._GetPhase(name)
+        phase["wall"] += wall
+        self._accumulated += wall
+
+    def _GetPhase(self, name) :
+        phase = self.phases.get(name)
+        if phase is None :
+            phase = {"wall" : 0.0, "cpu" : 0.0}
+            self.phases[name] = phase
+        return phase
+
+    def Report(self) :
+        return {"phases" : self.phases, "rows" : self.rows, "cells" : self.cells,
+                "peak_memory" : self.peak_memory, "memory_source" : self.memory_source}
+
+class _ProfilePhase:
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+
+    def __enter__(self) :
+        self._accumulated = self._profile._accumulated
+        self._cpu = _CpuTime()
+        self._wall = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        wall = time.time() - self._wall
+        cpu = _CpuTime() - self._cpu
+        phase = self._profile._GetPhase(self._name)
+        phase["wall"] += wall - (self._profile._accumulated - self._accumulated)
+        phase["cpu"] += cpu
+        return False
+
+
+# 表头中的基本类型对应的 FieldDescriptorProto.Type
+PROTO_FIELD_TYPES = {
+    "double" : 1, "float" : 2, "int64" : 3, "uint64" : 4, "int32" : 5,
+    "fixed64" : 6, "fixed32" : 7, "bool" : 8, "string" : 9, "bytes" : 12,
+    "uint32" : 13, "sfixed32" : 15, "sfixed64" : 16, "sint32" : 17, "sint64" : 18,
+}
+
+# id属性的类型到记录文件中id编码方式的映射, 只支持整数类型的id
+RECORD_ID_KINDS = {
+    PROTO_FIELD_TYPES["int32"] : record_file.ID_VARINT, PROTO_FIELD_TYPES["int64"] : record_file.ID_VARINT,
+    PROTO_FIELD_TYPES["uint32"] : record_file.ID_VARINT, PROTO_FIELD_TYPES["uint64"] : record_file.ID_UVARINT,
+    PROTO_FIELD_TYPES["sint32"] : record_file.ID_ZIGZAG, PROTO_FIELD_TYPES["sint64"] : record_file.ID_ZIGZAG,
+    PROTO_FIELD_TYPES["fixed32"] : record_file.ID_FIXED32, PROTO_FIELD_TYPES["fixed64"] : record_file.ID_FIXED64,
+    PROTO_FIELD_TYPES["sfixed32"] : record_file.ID_SFIXED32, PROTO_FIELD_TYPES["sfixed64"] : record_file.ID_SFIXED64,
+}
+
+# 每个进程只加载一次的模块和生成的message类
+_enum_module_cache = {}
+# 常驻进程中重新加载的enum描述, 和enum_pb2一样通过DESCRIPTOR访问
+_EnumModule = collections.namedtuple("_EnumModule", ["DESCRIPTOR"])
+_enum_index_cache = {}
+_message_class_cache = {}
+
+def LoadEnumModule() :
+    """加载protoc生成的enum_pb2, 每个进程只加载一次"""
+    enum_module = _enum_module_cache.get("enum_pb2")
+    if enum_module is None :
+        import importlib
+        py_path = os.path.join(os.getcwd(), "build_out", "py")
+        if py_path not in sys.path :
+            sys.path.append(py_path)
+        try:
+            enum_module = importlib.import_module("enum_pb2")
+        #except BaseException, e :
+        except Exception as e:
+            print("load module(%s) failed"%("enum_pb2"))
+            raise
+        _enum_module_cache["enum_pb2"] = enum_module
+    return enum_module
+
+def LoadEnumIndex() :
+    """enum.proto中所有枚举的 {枚举类型名: {枚举名: 值}} 索引, 每个进程只生成一次"""
+    enum_index = _enum_index_cache.get("enum_pb2")
+    if enum_index is None :
+        enum_index = {}
+        for enum_type_name, enum_type in LoadEnumModule().DESCRIPTOR.enum_types_by_name.items() :
+            enum_index[enum_type_name] = dict((value.name, value.number) for value in enum_type.values)
+        _enum_index_cache["enum_pb2"] = enum_index
+    return enum_index
+
+def LoadMessageClasses(file_descriptor, message_name) :
+    """根据SheetInterpreter生成的FileDescriptorProto在进程内构造message类
+
+    返回 (<sheet>, <sheet>_array) 两个类, 相同的描述只构造一次
+    """
+    key = file_descriptor.SerializeToString()
+    message_classes = _message_class_cache.get(key)
+    if message_classes is None :
+        from google.protobuf import descriptor_pool
+        from google.protobuf import message_factory
+
+        pool = descriptor_pool.DescriptorPool()
+        if len(file_descriptor.dependency) > 0 :
+            pool.AddSerializedFile(LoadEnumModule().DESCRIPTOR.serialized_pb)
+        pool.AddSerializedFile(key)
+        factory = message_factory.MessageFactory(pool)
+        full_name = PROTO_PACKAGE + "." + message_name
+        message_classes = (factory.GetPrototype(pool.FindMessageTypeByName(full_name)),
+                factory.GetPrototype(pool.FindMessageTypeByName(full_name + "_array")))
+        _message_class_cache[key] = message_classes
+    return message_classes
+
 class SheetInterpreter:
     """通过excel配置生成配置的protobuf定义文件"""
-    def __init__(self, sheet, sheet_name):
+    def __init__(self, sheet, sheet_name, profile=None):
         self._sheet_name = sheet_name
         self._sheet = sheet
+        self._profile = profile if profile is not None else SheetProfile()
 
-        # 行数和列数
-        self._row_count = len(self._sheet.col_values(0))
-        self._col_count = len(self._sheet.row_values(0))
+        # 行数和列数, 流式读取的sheet行数可能未知
+        self._row_count = self._sheet.RowCount()
+        self._col_count = self._sheet.ColCount()
 
         self._row = 0
         self._col = 0
@@ -146,22 +363,65 @@ class SheetInterpreter:
         self._struct_name_list = []
 
         self._pb_file_name = sheet_name + ".proto"
+        # 生成的所有文件, 用于增量构建判断输出是否被改动
+        self._output_files = []
+
+        # 和输出的PB文本同步生成的描述, 导数据时直接用它在进程内构造message
+        from google.protobuf import descriptor_pb2
+        self._file_descriptor = descriptor_pb2.FileDescriptorProto()
+        self._file_descriptor.name = self._pb_file_name
+        self._file_descriptor.package = PROTO_PACKAGE
+        self._file_descriptor.syntax = "proto3"
+        self._message_descriptor_list = []
     
     def hasEnum(self, col_idx) :
-        field_type = str(self._sheet.cell_value(FIELD_TYPE_ROW, col_idx)).strip()
+        field_type = str(self._sheet.HeaderValue(FIELD_TYPE_ROW, col_idx)).strip()
         if field_type.find('enum-') == 0 :
             return True
         return False
 
+    @staticmethod
+    def HeaderFingerprint(sheet, sheet_name) :
+        """表头, 表头语法版本和枚举索引的hash, PB定义只由它们决定"""
+        header = [[sheet.HeaderValue(row, col) for col in range(sheet.ColCount())]
+                for row in range(FIELD_NAME_ROW + 1)]
+        sha = hashlib.sha1()
+        sha.update(json.dumps([LAYOUT_VERSION, sheet_name, header]).encode("utf-8"))
+        sha.update(json.dumps(LoadEnumIndex(), sort_keys=True).encode("utf-8"))
+        return sha.hexdigest()
+
+    @staticmethod
+    def ProtoFingerprint(sheet_name) :
+        """已生成的PB定义文件中记录的表头hash, 文件不存在或者没有记录时返回None"""
+        file_name = "protocol/" + sheet_name + ".proto"
+        if not os.path.exists(file_name) :
+            return None
+        pb_file = open(file_name, "rb")
+        try :
+            # hash 在文件开头的描述中
+            for i in range(8) :
+                line = pb_file.readline().decode("utf-8")
+                if line.startswith(SheetInterpreter.FINGERPRINT_PREFIX) :
+                    return line[len(SheetInterpreter.FINGERPRINT_PREFIX):].strip()
+        finally :
+            pb_file.close()
+        return None
+
     def Interpreter(self) :
-        """对外的接口"""
+        """对外的接口, 只生成PB定义文件, C++和python代码由ProtoCodegen统一生成"""
+        with self._profile.Phase("layout") :
+            self.Layout()
+            self._Write2File()
+
+    def Layout(self) :
+        """生成PB定义的文本和描述, 不写文件也不调用protoc"""
         LOG_INFO("begin Interpreter, row_count = %d, col_count = %d", self._row_count, self._col_count)
 
         self._LayoutFileHeader()
 
         self._output.append("syntax = \"proto3\";\n")
         self._output.append("package cfg;\n")
-        for col_idx in range(self._col_count-1) :
+        for col_idx in range(self._col_count) :
             if self.hasEnum(col_idx) == True :
                 self._output.append('import "enum.proto";\n')
                 break
@@ -177,75 +437,68 @@ class SheetInterpreter:
 
         self._LayoutArray()
 
-        self._Write2File()
+    def FileDescriptor(self) :
+        """Layout之后得到的FileDescriptorProto"""
+        return self._file_descriptor
 
-        CheckAndCreateDir('build_out/cpp')
-        if platform.system() == "Windows" :
-            command = "%cd%\deploy\proto\protoc -I=%cd%\protocol\ --cpp_out=build_out\\cpp %cd%\protocol\\"+ self._pb_file_name
-        else :
-            command = "$(cd `dirname $0`;pwd)/deploy/proto/protoc -I=./protocol/ --cpp_out=build_out/cpp ./protocol/"+ self._pb_file_name
-        os.system(command)
-
-        LogHelp.close()
-        # 将PB转换成py格式
-        try :
-            CheckAndCreateDir('build_out/py')
-            if platform.system() == "Windows" :
-                command = "%cd%\deploy\proto\protoc -I=%cd%\protocol\ --python_out=build_out/py %cd%\protocol\\" + self._pb_file_name
-            else :
-                command = "$(cd `dirname $0`;pwd)/deploy/proto/protoc -I=./protocol/ --python_out=build_out/py ./protocol/" + self._pb_file_name
-            os.system(command)
-        #except BaseException, e :
-        except Exception as e:
-            print("protoc failed!")
-            raise
+    def OutputFiles(self) :
+        """生成的文件列表"""
+        return self._output_files
 
     def _FieldDefine(self, repeated_num) :
         LOG_INFO("row=%d, col=%d, repeated_num=%d", self._row, self._col, repeated_num)
-        field_rule = str(self._sheet.cell_value(FIELD_RULE_ROW, self._col))
+        field_rule = str(self._sheet.HeaderValue(FIELD_RULE_ROW, self._col))
         if len(field_rule) > 0 and field_rule.find('[]') == -1 :
-            field_type = str(self._sheet.cell_value(FIELD_TYPE_ROW, self._col)).strip()
-            if field_type.find('enum-') == 0 :
+            field_type = str(self._sheet.HeaderValue(FIELD_TYPE_ROW, self._col)).strip()
+            is_enum = field_type.find('enum-') == 0
+            if is_enum :
                 field_type = field_type[len('enum-'):len(field_type)]
-            field_name = str(self._sheet.cell_value(FIELD_NAME_ROW, self._col)).strip()
-            field_comment = unicode(self._sheet.cell_value(FIELD_COMMENT_ROW, self._col))
+            field_name = str(self._sheet.HeaderValue(FIELD_NAME_ROW, self._col)).strip()
+            field_comment = unicode(self._sheet.HeaderValue(FIELD_COMMENT_ROW, self._col))
 
             LOG_INFO("%s|%s|%s|%s", field_rule, field_type, field_name, field_comment)
 
             comment = field_comment.encode("utf-8")
             self._LayoutComment(comment)
 
+            # 重复次数列后面的属性, 值分布在之后的repeated_num列中
             if repeated_num >= 1:
                 field_rule = "repeated"
+            else :
+                field_rule = ''
 
-            self._LayoutOneField('', field_type, field_name)
+            self._LayoutOneField(field_rule, field_type, field_name, is_enum)
 
             actual_repeated_num = 1 if (repeated_num == 0) else repeated_num
             self._col += actual_repeated_num
 
         elif len(field_rule) > 0 and field_rule.find('[]') != -1 :
             # 若repeated第二行是类型定义，则表示当前字段是repeated，并且数据在单列用分好相隔
-            second_row = str(self._sheet.cell_value(FIELD_TYPE_ROW, self._col)).strip()
+            second_row = str(self._sheet.HeaderValue(FIELD_TYPE_ROW, self._col)).strip()
             LOG_DEBUG("repeated|%s", second_row);
+            repeated_count = second_row[0: len(second_row) - 2]
             # exel有可能有小数点
-            if second_row.isdigit() or second_row.find(".") != -1 :
+            if repeated_count.isdigit() or repeated_count.find(".") != -1 :
                 # 这里后面一般会是一个结构体
-                repeated_num = int(float(second_row))
+                repeated_num = int(float(repeated_count))
                 LOG_INFO("%s|%d", field_rule, repeated_num)
                 self._col += 1
                 self._FieldDefine(repeated_num)
             else :
                 # 一般是简单的单字段，数值用分号相隔
                 field_type = second_row
-                field_name = str(self._sheet.cell_value(FIELD_NAME_ROW, self._col)).strip()
+                field_name = str(self._sheet.HeaderValue(FIELD_NAME_ROW, self._col)).strip()
                 field_type = field_type[0: len(field_type) - 2]
-                field_comment = unicode(self._sheet.cell_value(FIELD_COMMENT_ROW, self._col))
+                is_enum = field_type.find('enum-') == 0
+                if is_enum :
+                    field_type = field_type[len('enum-'):]
+                field_comment = unicode(self._sheet.HeaderValue(FIELD_COMMENT_ROW, self._col))
                 LOG_INFO("%s|%s|%s|%s", field_rule, field_type, field_name, field_comment)
 
                 comment = field_comment.encode("utf-8")
                 self._LayoutComment(comment)
 
-                self._LayoutOneField('repeated', field_type, field_name)
+                self._LayoutOneField('repeated', field_type, field_name, is_enum)
 
                 self._col += 1
         else :
@@ -279,6 +532,8 @@ class SheetInterpreter:
         self._output.append("/**\n")
         self._output.append("* @file:   " + self._pb_file_name + "\n")
         self._output.append("* @brief:  文件通过工具自动生成，不建议手动修改\n")
+        self._output.append(SheetInterpreter.FINGERPRINT_PREFIX + " "
+                + SheetInterpreter.HeaderFingerprint(self._sheet, self._sheet_name) + "\n")
         self._output.append("*/\n")
         self._output.append("\n")
 
@@ -286,6 +541,12 @@ class SheetInterpreter:
         """生成结构头"""
         if not self._is_layout :
             return
+        if len(self._message_descriptor_list) == 0 :
+            message_descriptor = self._file_descriptor.message_type.add()
+        else :
+            message_descriptor = self._message_descriptor_list[-1].nested_type.add()
+        message_descriptor.name = struct_name
+        self._message_descriptor_list.append(message_descriptor)
         self._output.append("\n")
         self._output.append(" "*self._indentation + "message " + struct_name + " {\n")
 
@@ -293,6 +554,7 @@ class SheetInterpreter:
         """生成结构尾"""
         if not self._is_layout :
             return
+        self._message_descriptor_list.pop()
         self._output.append(" "*self._indentation + "}\n")
         self._output.append("\n")
 
@@ -309,20 +571,23 @@ class SheetInterpreter:
         else :
             self._output.append(" "*self._indentation + "/** " + comment + " */\n")
 
-    def _LayoutOneField(self, field_rule, field_type, field_name) :
+    def _LayoutOneField(self, field_rule, field_type, field_name, is_enum=False) :
         """输出一行定义"""
         if not self._is_layout :
             return
+        field_index = self._GetAndAddFieldIndex()
+        self._DescribeField(field_rule, field_type, field_name, field_index, is_enum)
+
         if field_name.find('=') > 0 :
             name_and_value = field_name.split('=')
             self._output.append(" "*self._indentation + field_rule + " " + field_type \
-                    + " " + str(name_and_value[0]).strip() + " = " + self._GetAndAddFieldIndex()\
+                    + " " + str(name_and_value[0]).strip() + " = " + field_index\
                     + " [default = " + str(name_and_value[1]).strip() + "]" + ";\n")
             return
 
         if (field_rule == "repeated") :
             self._output.append(" "*self._indentation + field_rule + " " + field_type \
-                    + " " + field_name + " = " + self._GetAndAddFieldIndex() + ";\n")
+                    + " " + field_name + " = " + field_index + ";\n")
             return
 
         if field_type == "int32" or field_type == "int64"\
@@ -332,17 +597,46 @@ class SheetInterpreter:
                 or field_type == "sfixed32" or field_type == "sfixed64" \
                 or field_type == "double" or field_type == "float" :
                     self._output.append(" "*self._indentation + field_type \
-                            + " " + field_name + " = " + self._GetAndAddFieldIndex()\
+                            + " " + field_name + " = " + field_index\
                             + ";\n")
         elif field_type == "string" or field_type == "bytes" :
             self._output.append(" "*self._indentation + field_type \
-                    + " " + field_name + " = " + self._GetAndAddFieldIndex()\
+                    + " " + field_name + " = " + field_index\
                     + ";\n")
         else :
             self._output.append(" "*self._indentation + field_type \
-                    + " " + field_name + " = " + self._GetAndAddFieldIndex() + ";\n")
+                    + " " + field_name + " = " + field_index + ";\n")
         return
 
+    def _DescribeField(self, field_rule, field_type, field_name, field_index, is_enum) :
+        """在描述中增加一个属性, 和输出的文本一致"""
+        from google.protobuf import descriptor_pb2
+
+        field = self._message_descriptor_list[-1].field.add()
+        if field_name.find('=') > 0 :
+            # proto3 不支持默认值
+            field_name = str(field_name.split('=')[0]).strip()
+        field.name = field_name
+        field.number = int(field_index)
+        if field_rule == "repeated" :
+            field.label = descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED
+        else :
+            field.label = descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+
+        if field_type.find('enum-') == 0 :
+            is_enum = True
+            field_type = field_type[len('enum-'):]
+        if field_type in PROTO_FIELD_TYPES :
+            field.type = PROTO_FIELD_TYPES[field_type]
+        elif is_enum :
+            field.type = descriptor_pb2.FieldDescriptorProto.TYPE_ENUM
+            field.type_name = "." + PROTO_PACKAGE + "." + field_type
+            if "enum.proto" not in self._file_descriptor.dependency :
+                self._file_descriptor.dependency.append("enum.proto")
+        else :
+            field.type = descriptor_pb2.FieldDescriptorProto.TYPE_MESSAGE
+            field.type_name = "." + PROTO_PACKAGE + "." + field_type
+
     def _IncreaseIndentation(self) :
         """增加缩进"""
         self._indentation += TAP_BLANK_NUM
@@ -362,325 +656,2578 @@ class SheetInterpreter:
         self._output.append("message " + self._sheet_name + "_array {\n")
         self._output.append("    repeated " + self._sheet_name + " items = 1;\n}\n")
 
+        from google.protobuf import descriptor_pb2
+        message_descriptor = self._file_descriptor.message_type.add()
+        message_descriptor.name = self._sheet_name + "_array"
+        field = message_descriptor.field.add()
+        field.name = "items"
+        field.number = 1
+        field.label = descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED
+        field.type = descriptor_pb2.FieldDescriptorProto.TYPE_MESSAGE
+        field.type_name = "." + PROTO_PACKAGE + "." + self._sheet_name
+
     def _Write2File(self) :
-        """输出到文件"""
+        """输出到文件, 内容没有变化时不写, 保持文件的修改时间"""
         CheckAndCreateDir('protocol')
-        pb_file = open("protocol/" + self._pb_file_name, "w+")
-        pb_file.writelines(self._output)
+        file_name = "protocol/" + self._pb_file_name
+        self._output_files.append(file_name)
+        content = b"".join([AtomicFile.Bytes(piece) for piece in self._output])
+        if os.path.exists(file_name) :
+            pb_file = open(file_name, "rb")
+            old_content = pb_file.read()
+            pb_file.close()
+            if old_content == content :
+                return
+        pb_file = open(file_name, "wb+")
+        pb_file.write(content)
         pb_file.close()
 
+# PB定义文件中记录表头hash的行
+SheetInterpreter.FINGERPRINT_PREFIX = "* @schema:"
+
+# 工具源码的hash, 每个进程只计算一次, 见 DataParser._ParseCached
+_source_hash_cache = {}
+
+def _ConvertInt(field_value) :
+    if len(str(field_value).strip()) <=0 :
+        return None
+    return int(field_value)
+
+def _ConvertFloat(field_value) :
+    if len(str(field_value).strip()) <=0 :
+        return None
+    return float(field_value)
+
+def _ConvertString(field_value) :
+    if len(field_value) <= 0 :
+        return None
+    return field_value
+
+def _ConvertBytes(field_value) :
+    field_value = str(field_value).encode('utf-8')
+    if len(field_value) <= 0 :
+        return None
+    return field_value
+
+def _ConvertListString(field_value) :
+    return field_value.encode("utf8")
+
+def _ConvertListInt(field_value) :
+    return int(float(field_value))
+
+# pb类型到python类型的转换函数
+FIELD_CONVERTERS = {
+    "int32" : _ConvertInt, "int64" : _ConvertInt,
+    "uint32" : _ConvertInt, "uint64" : _ConvertInt,
+    "sint32" : _ConvertInt, "sint64" : _ConvertInt,
+    "fixed32" : _ConvertInt, "fixed64" : _ConvertInt,
+    "sfixed32" : _ConvertInt, "sfixed64" : _ConvertInt,
+    "double" : _ConvertFloat, "float" : _ConvertFloat,
+    "string" : _ConvertString,
+    "bytes" : _ConvertBytes,
+}
+
+def _EnumConverter(plan, col, enum_type_name, enum_values) :
+    """枚举名到值的转换, 不认识的枚举名不设值, 记录到plan中统一报告"""
+    def _ConvertEnum(field_value) :
+        number = enum_values.get(field_value)
+        if number is None and field_value != "" :
+            plan.AddUnknownEnum(col, enum_type_name, field_value)
+        return number
+    return _ConvertEnum
+
+# 一列的解析动作
+# kind              动作类型, ColumnPlan.SCALAR/REPEATED/LIST
+# col               第一个值所在的列
+# field_name        pb中的属性名
+# field_type        表头中的属性类型
+# convert           单元格到pb值的转换函数, 为None时不取值
+# count_col         REPEATED时记录重复次数的列
+# max_repeated_num  REPEATED时值的最大个数, 即占用的列数
+# slot              属性值在ReadRow结果中的下标
+ColumnAction = collections.namedtuple("ColumnAction",
+        ["kind", "col", "field_name", "field_type", "convert", "count_col", "max_repeated_num", "slot"])
+
+class ColumnPlan:
+    """将sheet的表头编译成解析计划
+
+    表头只解释一次, 得到按列顺序排列的动作列表, 每个数据行按动作取值,
+    不用再逐行重复读取和解释表头
+    """
+    # 单列单值
+    SCALAR = 0
+    # 一列重复次数, 后面跟最多max_repeated_num列的值
+    REPEATED = 1
+    # 单列, 多个值用分号相隔
+    LIST = 2
+
+    def __init__(self, sheet, enum_index):
+        self._sheet = sheet
+        self._enum_index = enum_index
+        self._col_count = sheet.ColCount()
+
+        # 所有属性, (属性名, 是否重复), 下标即slot
+        self._fields = []
+        self._slots = {}
+
+        # 正在读取的行, 只在报告错误时使用
+        self.row = 0
+        # 不认识的枚举名, (列, 枚举类型名, 枚举名) 到所在行的列表
+        self.unknown_enums = collections.OrderedDict()
+        # 不认识的枚举名出现的总次数
+        self.unknown_enum_count = 0
+
+        actions = []
+        col = 0
+        while col < self._col_count :
+            col = self._CompileField(col, actions)
+        self.actions = tuple(actions)
+        self.fields = tuple(self._fields)
+
+        self._sheet = None
+        self._enum_index = None
+
+    def ReadRow(self, row, row_values) :
+        """按计划读取一行, 返回每个属性的值, 重复的属性为列表, 没有值的为None"""
+        values = [[] if is_list else None for field_name, is_list in self.fields]
+        self.row = row
+
+        col = 0
+        try :
+            for kind, col, field_name, field_type, convert, count_col, max_repeated_num, slot in self.actions :
+                if kind == ColumnPlan.SCALAR :
+                    field_value = convert(row_values[col])
+                    # 有value才设值
+                    if field_value != None :
+                        values[slot] = field_value
+
+                elif kind == ColumnPlan.REPEATED :
+                    read = row_values[count_col]
+                    repeated_num = 0 if read == "" else int(read)
+                    if max_repeated_num == 0 :
+                        print("max repeated num shouldn't be 0")
+                        raise ValueError("max repeated num of col %d is 0" % count_col)
+                    if repeated_num > max_repeated_num :
+                        repeated_num = max_repeated_num
+                    # 重复次数列后面紧跟的是列表或者另一个重复次数列时, 本列只做检查
+                    if convert is None :
+                        continue
+                    field_list = values[slot]
+                    for col in range(col, col + repeated_num) :
+                        field_value = convert(row_values[col])
+                        # 有value才设值
+                        if field_value != None :
+                            field_list.append(field_value)
+
+                else :
+                    # 单列, 数值用分号相隔
+                    field_value_str = str(row_values[col])
+                    #增加长度判断
+                    if len(field_value_str) > 0:
+                        if field_value_str.find(";") > 0 :
+                            field_value_list = field_value_str.split(";")
+                        else :
+                            field_value_list = field_value_str.split("|")
+
+                        field_list = values[slot]
+                        for field_value in field_value_list :
+                            field_value = convert(field_value)
+                            # 不认识的枚举名不设值
+                            if field_value is not None :
+                                field_list.append(field_value)
+        #except BaseException, e :
+        except Exception as e:
+            print("parse cell(%u, %u) error, please check it, maybe type is wrong."%(row, col))
+            raise
+
+        return values
+
+    def Subset(self, field_names) :
+        """只读取部分属性的计划, 属性的下标不变, 其他属性的值为None或空列表"""
+        import copy
+        plan = copy.copy(self)
+        plan.actions = tuple([action for action in self.actions if action.field_name in field_names])
+        return plan
+
+    def AddUnknownEnum(self, col, enum_type_name, enum_name) :
+        """记录一个不认识的枚举名, 解析完后统一报告"""
+        self.unknown_enum_count += 1
+        key = (col, enum_type_name, enum_name)
+        rows = self.unknown_enums.get(key)
+        if rows is None :
+            rows = []
+            self.unknown_enums[key] = rows
+        rows.append(self.row)
+
+    def _Slot(self, field_name, is_list) :
+        """属性值的下标, 同名属性共用一个下标"""
+        slot = self._slots.get(field_name)
+        if slot is None :
+            slot = len(self._fields)
+            self._slots[field_name] = slot
+            self._fields.append((field_name, is_list))
+        elif self._fields[slot][1] != is_list :
+            raise ValueError("field %s is defined as both repeated and not repeated" % field_name)
+        return slot
+
+    def _CompileField(self, col, actions) :
+        """编译从col开始的一个属性, 返回下一个属性的列"""
+        field_rule = str(self._sheet.HeaderValue(FIELD_TYPE_ROW, col)).strip()
+
+        if field_rule.find('[]') == -1 :
+            field_type = field_rule
+            field_name = self._FieldName(col)
+            convert = self._Converter(col, field_type)
+            LOG_INFO("%d|%s|%s|%s", col, field_rule, field_type, field_name)
+            # 不认识的类型不取值
+            if convert is not None :
+                actions.append(ColumnAction(ColumnPlan.SCALAR, col, field_name, field_type, convert, -1, 0,
+                    self._Slot(field_name, False)))
+            return col + 1
+
+        # 若repeated第二行是类型定义，则表示当前字段是repeated，并且数据在单列用分号相隔
+        second_row = field_rule[0: len(field_rule) - 2]
+        # exel有可能有小数点
+        if second_row.isdigit() or second_row.find(".") != -1 :
+            # 后面一列是重复的属性, 最多占用max_repeated_num列
+            max_repeated_num = int(float(second_row))
+            count_col = col
+            col += 1
+            field_rule = str(self._sheet.HeaderValue(FIELD_TYPE_ROW, col)).strip()
+            LOG_INFO("%d|%s|%d", count_col, field_rule, max_repeated_num)
+            if field_rule.find('[]') != -1 :
+                # 后面不是普通属性, 重复次数不起作用, 只检查次数列
+                actions.append(ColumnAction(ColumnPlan.REPEATED, col, None, None, None,
+                    count_col, max_repeated_num, -1))
+                return col
+
+            field_type = field_rule
+            field_name = self._FieldName(col)
+            convert = self._Converter(col, field_type)
+            slot = -1 if convert is None else self._Slot(field_name, True)
+            actions.append(ColumnAction(ColumnPlan.REPEATED, col, field_name, field_type, convert,
+                count_col, max_repeated_num, slot))
+            return col + max_repeated_num
+
+        # 一般是简单的单字段，数值用分号相隔
+        field_type = second_row
+        field_name = str(self._sheet.HeaderValue(FIELD_NAME_ROW, col)).strip()
+        LOG_INFO("%d|%s|%s|%s", col, field_rule, field_type, field_name)
+        if field_type.find('enum-') == 0 :
+            convert = self._Converter(col, field_type)
+        elif field_type == "bytes" or field_type == "string":
+            convert = _ConvertListString
+        else :
+            convert = _ConvertListInt
+        actions.append(ColumnAction(ColumnPlan.LIST, col, field_name, field_type, convert, -1, 0,
+            self._Slot(field_name, True)))
+        return col + 1
+
+    def _FieldName(self, col) :
+        field_name = str(self._sheet.HeaderValue(FIELD_NAME_ROW, col)).strip()
+        if field_name.find('=') > 0 :
+            name_and_value = field_name.split('=')
+            field_name = str(name_and_value[0]).strip()
+        return field_name
+
+    def _Converter(self, col, field_type) :
+        if field_type.find('enum-') == 0 :
+            enum_type_name = field_type[len("enum-"):]
+            return _EnumConverter(self, col, enum_type_name, self._enum_index[enum_type_name])
+        return FIELD_CONVERTERS.get(field_type)
+
+class WireEncoder:
+    """不构造python的message对象, 直接按descriptor编码protobuf的二进制
+
+    每一行编码为<sheet>_array中的一个items, 拼接起来和SerializeToString的结果完全一致
+    """
+    def __init__(self, plan, message_descriptor):
+        from google.protobuf.internal import encoder
+        from google.protobuf.internal import type_checkers
+        from google.protobuf.internal import wire_format
+
+        self._varint_bytes = encoder._VarintBytes
+
+        fields = []
+        for slot, (field_name, is_list) in enumerate(plan.fields) :
+            field = message_descriptor.fields_by_name.get(field_name)
+            if field is None :
+                raise AttributeError("%s has no field %s" % (message_descriptor.full_name, field_name))
+            is_repeated = (field.label == field.LABEL_REPEATED)
+            if is_repeated != is_list :
+                raise AttributeError("field %s.%s is %srepeated in proto" % (message_descriptor.full_name,
+                    field_name, "" if is_repeated else "not "))
+
+            # 和python_message中的规则一致, proto3的数值数组默认packed
+            is_packed = False
+            if is_repeated and wire_format.IsTypePackable(field.type) :
+                if message_descriptor.syntax == "proto3" :
+                    is_packed = not (field.has_options and field.GetOptions().HasField("packed")
+                            and not field.GetOptions().packed)
+                else :
+                    is_packed = field.has_options and field.GetOptions().packed
+
+            encode = type_checkers.TYPE_TO_ENCODER[field.type](field.number, is_repeated, is_packed)
+            checker = type_checkers.GetTypeChecker(field)
+            fields.append((field.number, slot, is_repeated, checker.CheckValue, encode))
+
+        # 序列化时按field number的顺序输出
+        fields.sort(key=lambda field: field[0])
+        self._fields = [field[1:] for field in fields]
+
+    def EncodeRow(self, values) :
+        """编码一行的属性值, 返回一个完整的items(包括tag和长度)"""
+        pieces = []
+        write = pieces.append
+        for slot, is_repeated, check, encode in self._fields :
+            value = values[slot]
+            if is_repeated :
+                if value :
+                    encode(write, [check(element) for element in value], False)
+            elif value is not None :
+                # proto3 默认值不输出
+                value = check(value)
+                if value :
+                    encode(write, value, False)
+
+        data = b"".join(pieces)
+        return WireEncoder.ITEMS_TAG + self._varint_bytes(len(data)) + data
+
+# <sheet>_array 中 items 的tag, field number 1, length delimited
+WireEncoder.ITEMS_TAG = b"\x0a"
+
+def FillItem(plan, values, item) :
+    """将一行的属性值设置到message对象"""
+    for (field_name, is_list), value in zip(plan.fields, values) :
+        if is_list :
+            if value :
+                item.__getattribute__(field_name).extend(value)
+        elif value is not None :
+            item.__setattr__(field_name, value)
+
+def CheckEncoder(sheet_name, wire_data, message_data) :
+    """比较直接编码和message对象序列化的结果"""
+    if wire_data == message_data :
+        return
+    pos = 0
+    while pos < min(len(wire_data), len(message_data)) and wire_data[pos] == message_data[pos] :
+        pos += 1
+    raise ValueError("%s: wire encoder output(%d bytes) differs from message output(%d bytes) at byte %d"
+            % (sheet_name, len(wire_data), len(message_data), pos))
+
+def EncodeItems(sheet_name, plan, rows, array_class, wire_encoder, check_encoder, readable, profile) :
+    """将(行号, 属性值)编码为<sheet>_array, 返回序列化的数据和可读的文本
+
+    wire_encoder为None时通过message对象序列化, readable为False时不生成文本, 返回None
+    """
+    item_array = array_class()
+    if wire_encoder is not None :
+        wire_items = []
+
+    with profile.Phase("parse") :
+        for row, values in rows :
+            if wire_encoder is not None :
+                start = time.time()
+                wire_items.append(wire_encoder.EncodeRow(values))
+                profile.Accumulate("serialize", time.time() - start)
+                if not check_encoder :
+                    continue
+            FillItem(plan, values, item_array.items.add())
+
+    readable_data = None
+    with profile.Phase("serialize") :
+        if wire_encoder is not None :
+            data = b"".join(wire_items)
+            if check_encoder :
+                CheckEncoder(sheet_name, data, item_array.SerializeToString())
+            elif readable :
+                item_array.ParseFromString(data)
+        else :
+            data = item_array.SerializeToString()
+
+        if LogHelp.verbose >= LogHelp.VERBOSE_DETAIL :
+            LOG_DEBUG("parse result:\n%s", item_array)
+        if readable :
+            readable_data = str(item_array)
+    return data, readable_data
+
+class RowChunkEncoder:
+    """在进程池中编码一个sheet的一块数据行
+
+    只依赖表头和PB描述, 可以传给其他进程, 由各进程自己编译解析计划和构造message类
+    """
+    def __init__(self, header_sheet, file_descriptor_data, sheet_name, option):
+        from google.protobuf import descriptor_pb2
+
+        self._sheet_name = sheet_name
+        self._check_encoder = option.check_encoder
+        # 流式导出时只在readable选项打开时输出文本
+        self._readable = option.readable or not option.stream
+
+        file_descriptor = descriptor_pb2.FileDescriptorProto.FromString(file_descriptor_data)
+        message_class, self._array_class = LoadMessageClasses(file_descriptor, sheet_name)
+        self._plan = ColumnPlan(header_sheet, LoadEnumIndex())
+        self._wire_encoder = None
+        if option.encoder == "wire" or option.stream :
+            self._wire_encoder = WireEncoder(self._plan, message_class.DESCRIPTOR)
+
+    def Encode(self, chunk) :
+        """编码一块(行号, 单元格)
+
+        返回序列化的数据, 可读的文本(可能为None), 以及这一块中不认识的枚举名
+        """
+        plan = self._plan
+        rows = ((row, plan.ReadRow(row, row_values)) for row, row_values in chunk)
+        data, readable_data = EncodeItems(self._sheet_name, plan, rows, self._array_class,
+                self._wire_encoder, self._check_encoder, self._readable, SheetProfile())
+        if readable_data is not None :
+            readable_data = AtomicFile.Bytes(readable_data)
+        unknown_enums = list(plan.unknown_enums.items())
+        plan.unknown_enums.clear()
+        return data, readable_data, unknown_enums
+
+# 进程池中每个进程的RowChunkEncoder
+_row_chunk_encoder = None
+
+def _InitRowChunkWorker(header_sheet, file_descriptor_data, sheet_name, option) :
+    global _row_chunk_encoder
+    LogHelp.set_verbose(option.verbose)
+    _row_chunk_encoder = RowChunkEncoder(header_sheet, file_descriptor_data, sheet_name, option)
+
+def _EncodeRowChunk(chunk) :
+    return _row_chunk_encoder.Encode(chunk)
+
+# 检查规则, 文件名到 (修改时间, {sheet: 规则}), 常驻进程中文件被修改后重新加载
+_validate_rules_cache = {}
+
+def LoadValidateRules(file_name) :
+    """检查规则的json文件, 见 SheetValidator, 没有指定文件时只检查id唯一"""
+    if not file_name :
+        return {}
+    mtime = os.path.getmtime(file_name)
+    cached = _validate_rules_cache.get(file_name)
+    if cached is None or cached[0] != mtime :
+        rules_file = open(file_name, "r")
+        cached = (mtime, json.load(rules_file))
+        rules_file.close()
+        _validate_rules_cache[file_name] = cached
+    return cached[1]
+
+class SheetValidator:
+    """导出时逐行检查数据, 时间和行数成正比
+
+    id唯一和取值范围在读取每行时检查; 引用其他sheet的值只记录下来,
+    所有sheet导出后由 ValidateReferences 按其他sheet的id索引统一检查.
+    规则按sheet(PB的message名)配置, 例如:
+        {"example" : {"range" : {"type" : [0, 10], "relation" : [1, null]},
+                      "ref" : {"relation" : "example", "target" : {"sheet" : "item", "allow" : [0]}}}}
+    range 为 [最小值, 最大值], null表示不限; ref 的值必须是目标sheet的id, allow 中的值不检查.
+    数组属性检查其中的每个值, 枚举属性不能配置规则
+    """
+    # 每个sheet最多报告的错误数
+    MAX_ERRORS = 100
+
+    def __init__(self, sheet_name, plan, id_col, rules):
+        self._sheet_name = sheet_name
+        actions = {}
+        for action in plan.actions :
+            if action.field_name is not None :
+                actions.setdefault(action.field_name, action)
+
+        self._id_slot = -1
+        self._id_col = id_col
+        for action in plan.actions :
+            if action.kind == ColumnPlan.SCALAR and action.col == id_col :
+                self._id_slot = action.slot
+        field_names = set([plan.fields[self._id_slot][0]]) if self._id_slot >= 0 else set()
+
+        # slot 到 (属性名, 列, 最小值, 最大值)
+        self._ranges = []
+        for field_name, (min_value, max_value) in rules.get("range", {}).items() :
+            action = self._RuleAction(actions, field_name)
+            self._ranges.append((action.slot, field_name, action.col, min_value, max_value))
+            field_names.add(field_name)
+
+        # 属性名到引用的记录, 由 ValidateReferences 检查
+        self.refs = collections.OrderedDict()
+        self._refs = []
+        for field_name, target in rules.get("ref", {}).items() :
+            if not isinstance(target, dict) :
+                target = {"sheet" : target}
+            action = self._RuleAction(actions, field_name)
+            self.refs[field_name] = {"col" : action.col, "sheet" : target["sheet"], "rows" : [], "values" : []}
+            self._refs.append((action.slot, self.refs[field_name], set(target.get("allow", []))))
+            field_names.add(field_name)
+
+        # 只读取需要检查的属性
+        self._plan = plan.Subset(field_names)
+        # id 到第一次出现的行
+        self.ids = {}
+        # (行, 列, 说明)
+        self.errors = []
+        self.error_count = 0
+
+    def _RuleAction(self, actions, field_name) :
+        action = actions.get(field_name)
+        if action is None :
+            raise ValueError("validate rule of %s: field %s not found" % (self._sheet_name, field_name))
+        if action.field_type.find("enum-") == 0 :
+            raise ValueError("validate rule of %s: enum field %s can't be checked" % (self._sheet_name, field_name))
+        return action
+
+    def _AddError(self, row, col, message) :
+        self.error_count += 1
+        if len(self.errors) < SheetValidator.MAX_ERRORS :
+            self.errors.append((row, col, message))
+
+    def CheckRow(self, row, row_values) :
+        values = self._plan.ReadRow(row, row_values)
+
+        if self._id_slot >= 0 :
+            record_id = values[self._id_slot]
+            first_row = self.ids.get(record_id)
+            if first_row is None :
+                self.ids[record_id] = row
+            else :
+                self._AddError(row, self._id_col, "duplicated id %s, first defined in row %d" % (record_id, first_row))
+
+        for slot, field_name, col, min_value, max_value in self._ranges :
+            value = values[slot]
+            for value in (value if isinstance(value, list) else [value]) :
+                if value is None :
+                    continue
+                if (min_value is not None and value < min_value) or (max_value is not None and value > max_value) :
+                    self._AddError(row, col, "%s %s out of range [%s, %s]" % (field_name, value, min_value, max_value))
+
+        for slot, ref, allow in self._refs :
+            value = values[slot]
+            for value in (value if isinstance(value, list) else [value]) :
+                if value is None or value in allow :
+                    continue
+                ref["rows"].append(row)
+                ref["values"].append(value)
+
+    @staticmethod
+    def CheckFile(sheet_name) :
+        return "./build_out/check/" + sheet_name + ".json"
+
+    def Write(self, file_name) :
+        """id索引和引用的记录写到file_name, 跳过导出的sheet也可以参与引用检查"""
+        check_file = AtomicFile(file_name)
+        check_file.write(AtomicFile.Bytes(json.dumps({"ids" : list(self.ids.keys()), "refs" : self.refs})))
+        check_file.Commit()
+
+    def Report(self) :
+        """输出错误, 有错误时抛出异常, sheet导出失败"""
+        if self.error_count == 0 :
+            return
+        print("%s: %d validation errors" % (self._sheet_name, self.error_count))
+        for row, col, message in self.errors :
+            print("    row %d col %d: %s" % (row, col, message))
+            LOG_ERROR("%s|row %d|col %d|%s", self._sheet_name, row, col, message)
+        if self.error_count > len(self.errors) :
+            print("    ...")
+        raise ValueError("%d validation errors" % self.error_count)
+
+def ValidateReferences(results) :
+    """检查本次所有sheet引用的值都是目标sheet的id, 目标sheet的id索引从build_out/check中读取
+
+    引用错误的sheet记为失败, 返回错误数
+    """
+    checks = {}
+    def _LoadCheck(sheet_name) :
+        if sheet_name not in checks :
+            check = None
+            file_name = SheetValidator.CheckFile(sheet_name)
+            if os.path.exists(file_name) :
+                check_file = open(file_name, "r")
+                check = json.load(check_file)
+                check_file.close()
+                check["ids"] = set(check["ids"])
+            checks[sheet_name] = check
+        return checks[sheet_name]
+
+    error_count = 0
+    for result in results :
+        if not result.IsOk() or result.job.sheet_name is None :
+            continue
+        sheet_name = result.job.output_name
+        check = _LoadCheck(sheet_name)
+        if check is None :
+            continue
+
+        errors = []
+        for field_name, ref in check["refs"].items() :
+            target = _LoadCheck(ref["sheet"])
+            if target is None :
+                errors.append("%s refers to sheet %s which is not exported" % (field_name, ref["sheet"]))
+                continue
+            target_ids = target["ids"]
+            for row, value in zip(ref["rows"], ref["values"]) :
+                if value not in target_ids :
+                    errors.append("row %d col %d: %s %s not found in %s" % (row, ref["col"], field_name, value,
+                        ref["sheet"]))
+        if len(errors) == 0 :
+            continue
+
+        error_count += len(errors)
+        print("%s|%s %d reference errors" % (result.job.xls_file, result.job.sheet_name, len(errors)))
+        for error in errors[:SheetValidator.MAX_ERRORS] :
+            print("    " + error)
+            LOG_ERROR("%s|%s", sheet_name, error)
+        if len(errors) > SheetValidator.MAX_ERRORS :
+            print("    ...")
+        result.stage = "Validate"
+        result.error = "%d reference errors" % len(errors)
+    return error_count
+
+def ParsePartitionSpec(spec) :
+    """--partition 的参数 <struct>:<属性名>[:<边界>,<边界>...], 返回 (struct名, 属性名, 边界列表)
+
+    没有边界时按属性值分区, 边界列表为None
+    """
+    parts = spec.split(":")
+    if len(parts) not in (2, 3) or parts[0] == "" or parts[1] == "" :
+        raise ValueError("bad partition %s, expect <struct>:<field>[:<bound>,<bound>...]" % spec)
+    bounds = None
+    if len(parts) == 3 :
+        bounds = [float(bound) if bound.find(".") >= 0 else int(bound) for bound in parts[2].split(",")]
+        if bounds != sorted(set(bounds)) :
+            raise ValueError("bounds of partition %s must be increasing" % spec)
+    return parts[0], parts[1], bounds
+
+class PartitionRouter:
+    """导出时每行的记录同时写到所在的分区文件, 和bin文件在同一遍解析中完成
+
+    按属性值分区时每个值一个文件 build_out/part/<sheet>/<值>.bin, 只支持整数和枚举属性;
+    按边界 [b1, b2, ...] 分区时为N+1个文件 build_out/part/<sheet>/<序号>.bin,
+    序号为i的分区是 b(i) <= 值 < b(i+1). 属性为空的行按0分区.
+    分区的清单写到 build_out/part/<sheet>.json, 分区文件和bin的格式相同
+    """
+    def __init__(self, sheet_name, output_name, plan, field_name, bounds, open_file):
+        action = None
+        for action in plan.actions :
+            if action.field_name == field_name :
+                break
+        else :
+            raise ValueError("partition of %s: field %s not found" % (sheet_name, field_name))
+        if action.kind != ColumnPlan.SCALAR :
+            raise ValueError("partition of %s: field %s is repeated" % (sheet_name, field_name))
+        if bounds is None and action.convert is not _ConvertInt and action.field_type.find("enum-") != 0 :
+            raise ValueError("partition of %s: field %s is not an integer" % (sheet_name, field_name))
+        if bounds is not None and action.field_type in ("string", "bytes") :
+            raise ValueError("partition of %s: field %s is not a number" % (sheet_name, field_name))
+
+        self._sheet_name = sheet_name
+        self._field_name = field_name
+        self._bounds = bounds
+        self._slot = action.slot
+        self._plan = plan.Subset([field_name])
+        self._open_file = open_file
+        self._dir = "./build_out/part/" + output_name
+        self.manifest_file_name = "./build_out/part/" + output_name + ".json"
+        # 已经读取但还没有写入的行所在的分区, 和写入的items一一对应
+        self._pending = collections.deque()
+        # 分区到 (文件, 记录数)
+        self._files = {}
+
+    def CheckRow(self, row, row_values) :
+        value = self._plan.ReadRow(row, row_values)[self._slot]
+        if value is None :
+            value = 0
+        if self._bounds is not None :
+            value = bisect.bisect_right(self._bounds, value)
+        self._pending.append(value)
+
+    def Route(self, data) :
+        """data 为按行的顺序写入bin的若干个items"""
+        pos = 0
+        for record_id, start, length in record_file.SplitRecords(data, 0, record_file.ID_VARINT) :
+            key = self._pending.popleft()
+            part = self._files.get(key)
+            if part is None :
+                part = [self._open_file("%s/%s.bin" % (self._dir, key)), 0]
+                self._files[key] = part
+            part[0].write(data[pos:start + length])
+            part[1] += 1
+            pos = start + length
+
+    def Commit(self) :
+        """写完所有分区文件和清单, 删除上次导出留下的其他分区, 返回生成的文件列表"""
+        partitions = []
+        for key in sorted(self._files.keys()) :
+            part_file, count = self._files[key]
+            part_file.Commit()
+            partition = {"file" : os.path.basename(part_file.file_name), "count" : count}
+            if self._bounds is None :
+                partition["key"] = key
+            else :
+                partition["min"] = self._bounds[key - 1] if key > 0 else None
+                partition["max"] = self._bounds[key] if key < len(self._bounds) else None
+            partitions.append(partition)
+        output_files = [part_file.file_name for part_file, count in self._files.values()]
+
+        if os.path.isdir(self._dir) :
+            for file_name in os.listdir(self._dir) :
+                if "%s/%s" % (self._dir, file_name) not in output_files :
+                    os.remove(os.path.join(self._dir, file_name))
+
+        manifest_file = AtomicFile(self.manifest_file_name)
+        manifest_file.write(AtomicFile.Bytes(json.dumps({"sheet" : self._sheet_name, "field" : self._field_name,
+            "bounds" : self._bounds, "partitions" : partitions}, indent=1, sort_keys=True)))
+        manifest_file.Commit()
+        return output_files + [manifest_file.file_name]
+
+    def Abort(self) :
+        for part_file, count in self._files.values() :
+            part_file.Abort()
+        self._files.clear()
+
+class PartitionFile:
+    """输出的bin文件, 写入的数据同时按行分区, 见 PartitionRouter"""
+    def __init__(self, data_file, router):
+        self.file_name = data_file.file_name
+        self._data_file = data_file
+        self._router = router
+
+    def write(self, data) :
+        self._data_file.write(data)
+        self._router.Route(data)
+
+    def Commit(self) :
+        self._data_file.Commit()
+
+    def Abort(self) :
+        self._data_file.Abort()
+        self._router.Abort()
+
+class RowCache:
+    """行缓存: 每行单元格的hash到这一行编码后的items和可读文本, 重新导出时没有变化的行直接复制
+
+    每个sheet一个文件 build_out/rowcache/py<版本>/<sheet>.rows, marshal序列化后zlib压缩,
+    表头, 工具源码, enum.proto或者是否输出文本有变化时整个失效. 每次只保存本次导出的行,
+    所有sheet的总大小由 sheet_reader.TrimSnapshots 按最久没有使用淘汰.
+    有不认识的枚举名的行不缓存, 每次都重新转换并报告
+    """
+    DIR = "build_out/rowcache"
+    VERSION = 1
+
+    def __init__(self, output_name, fingerprint):
+        self.file_name = os.path.join(RowCache.DIR, "py%d" % sys.version_info[0], output_name + ".rows")
+        self._fingerprint = fingerprint
+        # 上次导出的行
+        self._rows = {}
+        # 本次导出的行
+        self._used = {}
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.exists(self.file_name) :
+            try :
+                cache_file = open(self.file_name, "rb")
+                version, cached_fingerprint, rows = marshal.loads(zlib.decompress(cache_file.read()))
+                cache_file.close()
+                if version == RowCache.VERSION and cached_fingerprint == fingerprint :
+                    self._rows = rows
+            except (ValueError, EOFError, TypeError, zlib.error) :
+                LOG_WARN("row cache %s is broken, ignore it", self.file_name)
+
+    @staticmethod
+    def Key(row_values) :
+        return hashlib.sha1(AtomicFile.Bytes(repr(row_values))).digest()
+
+    def Get(self, key) :
+        """返回 (items, 可读文本), 没有缓存时返回None"""
+        cached = self._rows.get(key)
+        if cached is None :
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used[key] = cached
+        return cached
+
+    def Put(self, key, data, readable_data) :
+        self._used[key] = (data, readable_data)
+
+    def Save(self) :
+        cache_file = AtomicFile(self.file_name)
+        cache_file.write(zlib.compress(marshal.dumps((RowCache.VERSION, self._fingerprint, self._used)), 1))
+        cache_file.Commit()
+
 class DataParser:
-    """解析excel的数据"""
-    def __init__(self, sheet, sheet_name):
+    """解析excel的数据
+
+    output_name 为输出文件名, 默认和sheet_name相同; shard 为True时是同名sheet的一个分片,
+    按id排序后输出到build_out/shard, 由 MergeShards 归并为最终的bin
+    """
+    def __init__(self, sheet, sheet_name, option=None, profile=None, file_descriptor=None, output_name=None,
+            shard=False):
         self._sheet_name = sheet_name
+        self._output_name = output_name if output_name is not None else sheet_name
+        self._shard = shard
         self._sheet = sheet
+        self._profile = profile if profile is not None else SheetProfile()
 
-        self._row_count = len(self._sheet.col_values(0))
-        self._col_count = len(self._sheet.row_values(0))
+        self._row_count = self._sheet.RowCount()
+        self._col_count = self._sheet.ColCount()
 
         self._row = FIELD_RULE_ROW
         self._col = 0
 
-        try:
-            self._module_name = self._sheet_name + "_pb2"
-            sys.path.append(os.getcwd() +"/build_out/py/")
-            exec('from '+self._module_name + ' import *');
-            self._module = sys.modules[self._module_name]
-        #except BaseException, e :
-        except Exception as e:
-            print("load module(%s) failed"%(self._module_name))
-            raise
-        
-        try:
-            self._enum_module_name = "enum_pb2"
-            sys.path.append(os.getcwd() +"/build_out/py/")
-            exec('from '+self._enum_module_name + ' import *');
-            self._enum_module = sys.modules[self._enum_module_name]
-        #except BaseException, e :
-        except Exception as e:
-            print("load module(%s) failed"%(self._enum_module))
-            raise
+        self._output_files = []
+        self._option = option if option is not None else DeployOption()
+
+        # 没有现成的描述时由表头生成, 不需要protoc和生成的py文件
+        if file_descriptor is None :
+            with self._profile.Phase("layout") :
+                tool = SheetInterpreter(sheet, sheet_name)
+                tool.Layout()
+                file_descriptor = tool.FileDescriptor()
+
+        self._file_descriptor = file_descriptor
+        with self._profile.Phase("import") :
+            self._enum_index = LoadEnumIndex()
+            self._message_class, self._array_class = LoadMessageClasses(file_descriptor, sheet_name)
+        self._validator = None
+        self._partition = None
 
     def Parse(self) :
         """对外的接口:解析数据"""
         LOG_INFO("begin parse, row_count = %d, col_count = %d", self._row_count, self._col_count)
 
-        item_array = getattr(self._module, self._sheet_name+'_array')()
+        # 表头只解释一次
+        with self._profile.Phase("parse") :
+            plan = ColumnPlan(self._sheet, self._enum_index)
+            if self._option.validate is not None :
+                rules = LoadValidateRules(self._option.validate).get(self._sheet_name, {})
+                self._validator = SheetValidator(self._sheet_name, plan, self._IdCol(), rules)
+            self._partition = self._PartitionRouter(plan)
+
+        if self._option.row_cache and not self._option.check_encoder :
+            self._ParseCached(plan)
+        elif self._RowWorkerNum() > 1 :
+            self._ParseParallel(plan)
+        elif self._option.stream :
+            self._ParseStream(plan)
+        else :
+            self._ParseArray(plan)
+        self._ReportUnknownEnums(plan)
+        if self._partition is not None :
+            self._output_files += self._partition.Commit()
+
+        if self._shard :
+            with self._profile.Phase("sort") :
+                self._SortShard(plan)
+        else :
+            self._WriteExtraFiles(plan)
+        if self._validator is not None :
+            with self._profile.Phase("validate") :
+                check_file_name = SheetValidator.CheckFile(self._output_name)
+                self._validator.Write(check_file_name)
+                self._output_files.append(check_file_name)
+
+        LogHelp.close()
 
-        # 先找到定义ID的列
+    def _WriteExtraFiles(self, plan) :
+        """由最终的bin生成的其他输出"""
+        if self._option.record_file :
+            with self._profile.Phase("record") :
+                self._WriteRecordFile(plan)
+        if self._option.patch :
+            with self._profile.Phase("patch") :
+                self._WritePatchFile(plan)
+        if self._option.column_file :
+            with self._profile.Phase("column") :
+                self._WriteColumnFile()
+        if self._option.string_pool == "sheet" :
+            with self._profile.Phase("string_pool") :
+                self._WriteStringPool()
+
+    def _IdCol(self) :
+        """定义ID的列, 即第一个有类型的列"""
         id_col = 0
         for id_col in range(0, self._col_count) :
-            info_id = str(self._sheet.cell_value(self._row, id_col))
+            info_id = str(self._sheet.HeaderValue(FIELD_RULE_ROW, id_col))
             if info_id == "" :
                 continue
             else :
                 break
+        return id_col
 
-        for self._row in range(3, self._row_count) :
+    def _IterDataRows(self) :
+        """逐行读取数据, 跳过id为空的行, 返回行号和这一行所有单元格的值"""
+        id_col = self._IdCol()
+        for self._row, row_values in self._sheet.IterRows(3) :
             # 如果 id 是 空 直接跳过改行
-            info_id = str(self._sheet.cell_value(self._row, id_col)).strip()
+            info_id = str(row_values[id_col]).strip()
             if info_id == "" :
                 LOG_WARN("%d is None", self._row)
                 continue
-            item = item_array.items.add()
-            self._ParseLine(item)
+            self._profile.rows += 1
+            self._profile.cells += len(row_values)
+            if self._validator is not None :
+                self._validator.CheckRow(self._row, row_values)
+            if self._partition is not None :
+                self._partition.CheckRow(self._row, row_values)
+            yield self._row, row_values
+
+    def _IterRows(self, plan) :
+        """逐行读取数据, 返回行号和按计划读取的属性值"""
+        for row, row_values in self._IterDataRows() :
+            values = plan.ReadRow(row, row_values)
+            if LogHelp.verbose >= LogHelp.VERBOSE_DETAIL :
+                LOG_DEBUG("%d|%s", row, values)
+            yield row, values
+
+    def _CheckRows(self) :
+        """所有行读取后, 提交输出文件之前报告id和取值范围的错误, 有错误时抛出异常, 不覆盖上次的输出"""
+        if self._validator is not None :
+            self._validator.Report()
+
+    def _ParseArray(self, plan) :
+        """整个<sheet>_array在内存中生成后再写文件"""
+        wire_encoder = None
+        if self._option.encoder == "wire" :
+            wire_encoder = WireEncoder(plan, self._message_class.DESCRIPTOR)
+
+        profile = self._profile
+        data, readable_data = EncodeItems(self._sheet_name, plan, self._IterRows(plan), self._array_class,
+                wire_encoder, self._option.check_encoder, True, profile)
+
+        self._CheckRows()
+        with profile.Phase("write") :
+            self._WriteReadableData2File(readable_data)
+            self._WriteData2File(data)
+
+    def _ParseStream(self, plan) :
+        """每行编码后直接追加到文件, 内存占用和行数无关
+
+        可读的文本只在readable选项打开时输出, 也是逐行追加
+        """
+        wire_encoder = WireEncoder(plan, self._message_class.DESCRIPTOR)
+
+        data_file = self._OpenDataFile()
+        readable_file = None
+        if self._option.readable :
+            readable_file = AtomicFile("./build_out/log/" + self._output_name + ".txt")
+            # 只含一个items的数组, 输出的文本和整个数组的文本逐段一致
+            item_array = self._array_class()
+
+        profile = self._profile
+        try :
+            with profile.Phase("parse") :
+                for row, values in self._IterRows(plan) :
+                    start = time.time()
+                    data = wire_encoder.EncodeRow(values)
+                    if readable_file is not None :
+                        item_array.ParseFromString(data)
+                        readable_data = AtomicFile.Bytes(str(item_array))
+                    encoded = time.time()
+                    profile.Accumulate("serialize", encoded - start)
+
+                    data_file.write(data)
+                    if readable_file is not None :
+                        readable_file.write(readable_data)
+                    profile.Accumulate("write", time.time() - encoded)
+            self._CheckRows()
+        except :
+            data_file.Abort()
+            if readable_file is not None :
+                readable_file.Abort()
+            raise
 
-        LOG_INFO("parse result:\n%s", item_array)
-        self._WriteReadableData2File(str(item_array))
+        with profile.Phase("write") :
+            data_file.Commit()
+            self._output_files.append(data_file.file_name)
+            if readable_file is not None :
+                readable_file.Commit()
+                self._output_files.append(readable_file.file_name)
+
+    def _ParseCached(self, plan) :
+        """逐行查找行缓存, 只有变化了的行才转换和编码, 见 RowCache
+
+        编码和流式导出一样逐行追加到文件, 输出和其他方式完全一致
+        """
+        wire_encoder = WireEncoder(plan, self._message_class.DESCRIPTOR)
+        readable = self._option.readable or not self._option.stream
+
+        profile = self._profile
+        with profile.Phase("row_cache") :
+            # 缓存的是编码结果, 编码的实现有变化时也失效
+            source_hash = _source_hash_cache.get(__file__)
+            if source_hash is None :
+                source_hash = BuildCache.FileHash(os.path.abspath(__file__))
+                _source_hash_cache[__file__] = source_hash
+            sha = hashlib.sha1()
+            sha.update(TOOL_VERSION.encode("utf-8"))
+            sha.update(source_hash.encode("utf-8"))
+            sha.update(SheetInterpreter.HeaderFingerprint(self._sheet, self._sheet_name).encode("utf-8"))
+            if os.path.exists(BuildCache.ENUM_PROTO_FILE) :
+                sha.update(BuildCache.FileHash(BuildCache.ENUM_PROTO_FILE).encode("utf-8"))
+            sha.update(b"readable" if readable else b"")
+            cache = RowCache(self._output_name, sha.hexdigest())
+
+        data_file = self._OpenDataFile()
+        readable_file = None
+        readable_data = None
+        if readable :
+            readable_file = AtomicFile("./build_out/log/" + self._output_name + ".txt")
+            item_array = self._array_class()
 
-        data = item_array.SerializeToString()
-        self._WriteData2File(data)
+        try :
+            with profile.Phase("parse") :
+                for row, row_values in self._IterDataRows() :
+                    key = RowCache.Key(row_values)
+                    cached = cache.Get(key)
+                    if cached is not None :
+                        data, readable_data = cached
+                    else :
+                        start = time.time()
+                        unknown_enum_count = plan.unknown_enum_count
+                        values = plan.ReadRow(row, row_values)
+                        data = wire_encoder.EncodeRow(values)
+                        if readable_file is not None :
+                            item_array.ParseFromString(data)
+                            readable_data = AtomicFile.Bytes(str(item_array))
+                        if plan.unknown_enum_count == unknown_enum_count :
+                            cache.Put(key, data, readable_data)
+                        profile.Accumulate("serialize", time.time() - start)
+
+                    data_file.write(data)
+                    if readable_file is not None :
+                        readable_file.write(readable_data)
+            self._CheckRows()
+        except :
+            data_file.Abort()
+            if readable_file is not None :
+                readable_file.Abort()
+            raise
 
+        with profile.Phase("write") :
+            data_file.Commit()
+            self._output_files.append(data_file.file_name)
+            if readable_file is not None :
+                readable_file.Commit()
+                self._output_files.append(readable_file.file_name)
+        with profile.Phase("row_cache") :
+            cache.Save()
+        LOG_INFO("%s|%d rows from row cache, %d rows encoded", self._output_name, cache.hits, cache.misses)
+
+    def _RowWorkerNum(self) :
+        """分块并行编码的进程数, 为1时不分块
+
+        进程池中的进程不能再创建进程池, 多个sheet并行导出时每个sheet仍然逐行编码
+        """
+        if self._option.row_chunk <= 0 or self._option.jobs <= 1 :
+            return 1
+        import multiprocessing
+        if multiprocessing.current_process().daemon :
+            return 1
+        row_count = self._sheet.RowCount()
+        if row_count >= 0 and row_count - 3 <= self._option.row_chunk :
+            return 1
+        return self._option.jobs
+
+    def _IterChunks(self) :
+        """数据行按row_chunk分块, 每块是(行号, 单元格)的列表"""
+        chunk = []
+        for row, row_values in self._IterDataRows() :
+            chunk.append((row, row_values))
+            if len(chunk) >= self._option.row_chunk :
+                yield chunk
+                chunk = []
+        if len(chunk) > 0 :
+            yield chunk
+
+    def _ParseParallel(self, plan) :
+        """数据行分块后在进程池中转换和编码, 按行的顺序拼接到文件
+
+        <sheet>_array只有一个repeated的items, 各块分别序列化后拼接和整体序列化的结果完全一致,
+        可读的文本也一样. 同时编码的块数有上限, 内存占用和行数无关
+        """
+        import multiprocessing
+
+        worker_num = self._RowWorkerNum()
+        readable = self._option.readable or not self._option.stream
+        data_file = self._OpenDataFile()
+        readable_file = AtomicFile("./build_out/log/" + self._output_name + ".txt") if readable else None
+
+        profile = self._profile
+        pool = multiprocessing.Pool(worker_num, _InitRowChunkWorker, (sheet_reader.HeaderSheet(self._sheet),
+                self._file_descriptor.SerializeToString(), self._sheet_name, self._option))
+        pending = collections.deque()
+
+        def _WriteChunk() :
+            start = time.time()
+            data, readable_data, unknown_enums = pending.popleft().get()
+            written = time.time()
+            profile.Accumulate("serialize", written - start)
+
+            data_file.write(data)
+            if readable_file is not None :
+                readable_file.write(readable_data)
+            for key, rows in unknown_enums :
+                plan.unknown_enums.setdefault(key, []).extend(rows)
+            profile.Accumulate("write", time.time() - written)
 
-        LogHelp.close()
+        try :
+            with profile.Phase("parse") :
+                for chunk in self._IterChunks() :
+                    pending.append(pool.apply_async(_EncodeRowChunk, (chunk,)))
+                    if len(pending) >= worker_num * 2 :
+                        _WriteChunk()
+                while len(pending) > 0 :
+                    _WriteChunk()
+            pool.close()
+            self._CheckRows()
+        except :
+            pool.terminate()
+            data_file.Abort()
+            if readable_file is not None :
+                readable_file.Abort()
+            raise
+        finally :
+            pool.join()
 
-    def _ParseLine(self, item) :
-        LOG_INFO("%d", self._row)
+        with profile.Phase("write") :
+            data_file.Commit()
+            self._output_files.append(data_file.file_name)
+            if readable_file is not None :
+                readable_file.Commit()
+                self._output_files.append(readable_file.file_name)
 
-        self._col = 0
-        while self._col < self._col_count :
-            self._ParseField(0, 0, item)
+    def OutputFiles(self) :
+        """生成的文件列表"""
+        return self._output_files
 
-    def _ParseField(self, max_repeated_num, repeated_num, item) :
-        field_rule = str(self._sheet.cell_value(FIELD_TYPE_ROW, self._col)).strip()
+    def FileDescriptor(self) :
+        return self._file_descriptor
 
-        if field_rule.find('[]') == -1 :
-            field_name = str(self._sheet.cell_value(2, self._col)).strip()
-            if field_name.find('=') > 0 :
-                name_and_value = field_name.split('=')
-                field_name = str(name_and_value[0]).strip()
-            field_type = str(self._sheet.cell_value(FIELD_TYPE_ROW, self._col)).strip()
-
-            LOG_INFO("%d|%d", self._row, self._col)
-            LOG_INFO("%s|%s|%s", field_rule, field_type, field_name)
-
-            if max_repeated_num == 0 :
-                field_value = self._GetFieldValue(field_type, self._row, self._col)
-                # 有value才设值
-                if field_value != None :
-                    item.__setattr__(field_name, field_value)
-                self._col += 1
-            else :
-                if repeated_num == 0 :
-                    if field_rule.find('[]') != -1 :
-                        print("required but repeated_num = 0")
-                        raise
-                else :
-                    for col in range(self._col, self._col + repeated_num):
-                        field_value = self._GetFieldValue(field_type, self._row, col)
-                        # 有value才设值
-                        if field_value != None :
-                            item.__getattribute__(field_name).append(field_value)
-                self._col += max_repeated_num
-
-        elif field_rule.find('[]') != -1 :
-            # 若repeated第二行是类型定义，则表示当前字段是repeated，并且数据在单列用分号相隔
-            second_row = str(self._sheet.cell_value(FIELD_TYPE_ROW, self._col)).strip()
-            second_row = second_row[0: len(second_row) - 2]
-            LOG_DEBUG("repeated|%s", second_row)
-            # exel有可能有小数点
-            if second_row.isdigit() or second_row.find(".") != -1 :
-                # 这里后面一般会是一个结构体
-                max_repeated_num = int(float(second_row))
-                read = self._sheet.cell_value(self._row, self._col)
-                repeated_num = 0 if read == "" else int(self._sheet.cell_value(self._row, self._col))
+    @staticmethod
+    def ShardFile(output_name) :
+        return "./build_out/shard/" + output_name + ".bin"
 
-                LOG_INFO("%s|%d|%d", field_rule, max_repeated_num, repeated_num)
+    @staticmethod
+    def BaseFile(output_name) :
+        """生成补丁时比较的基准"""
+        return "./build_out/base/" + output_name + ".bin"
+
+    def _BinFile(self) :
+        """输出的bin文件名, 分片输出到build_out/shard, 归并后才是最终的bin"""
+        if self._shard :
+            return DataParser.ShardFile(self._output_name)
+        return "./build_out/bin/" + self._output_name + ".bin"
+
+    def _OpenDataFile(self, file_name=None) :
+        """输出的bin文件, 选择了压缩方式时按块压缩, 分片归并前不压缩
+
+        file_name 为None时是sheet的bin文件, 有分区时写入的数据同时按行分区
+        """
+        data_file_name = self._BinFile() if file_name is None else file_name
+        if self._shard or self._option.codec == "none" :
+            data_file = AtomicFile(data_file_name)
+        else :
+            data_file = CompressedFile(data_file_name, self._option.codec, self._option.codec_level,
+                    self._option.block_size)
+        if file_name is None and self._partition is not None :
+            return PartitionFile(data_file, self._partition)
+        return data_file
+
+    def _PartitionRouter(self, plan) :
+        """--partition 中这个sheet的分区, 没有时返回None"""
+        for spec in self._option.partition :
+            struct_name, field_name, bounds = ParsePartitionSpec(spec)
+            if struct_name != self._sheet_name :
+                continue
+            if self._shard :
+                print("%s: partition is not supported for shards, ignored" % self._output_name)
+                return None
+            return PartitionRouter(self._sheet_name, self._output_name, plan, field_name, bounds,
+                    self._OpenDataFile)
+        return None
+
+    def _RemovePartition(self) :
+        """分片不支持分区, 删除没有分片时导出的分区和清单, 避免和归并后的bin不一致"""
+        import shutil
+        for spec in self._option.partition :
+            if ParsePartitionSpec(spec)[0] != self._sheet_name :
+                continue
+            part_dir = "./build_out/part/" + self._output_name
+            if os.path.isdir(part_dir) :
+                shutil.rmtree(part_dir)
+            if os.path.exists(part_dir + ".json") :
+                os.remove(part_dir + ".json")
+                LOG_INFO("%s|shards are not partitioned, remove the old partitions", self._output_name)
+
+    def _IdField(self, plan) :
+        """id列对应的整数属性, 不是整数时返回None"""
+        id_col = self._IdCol()
+        for action in plan.actions :
+            if action.kind == ColumnPlan.SCALAR and action.col == id_col :
+                id_field = self._message_class.DESCRIPTOR.fields_by_name[action.field_name]
+                if id_field.type in RECORD_ID_KINDS :
+                    return id_field
+                break
+        return None
 
-                if max_repeated_num == 0 :
-                    print("max repeated num shouldn't be 0")
-                    raise
+    @staticmethod
+    def _MapFile(data_file, file_name) :
+        """只读mmap整个文件, 空文件不能mmap, 返回空串; 压缩的bin解压后返回"""
+        if os.path.getsize(file_name) == 0 :
+            return b""
+        if block_codec.IsBlockFile(file_name) :
+            return block_codec.ReadData(file_name)
+        import mmap
+        return mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
 
-                if repeated_num > max_repeated_num :
-                    repeated_num = max_repeated_num
+    @staticmethod
+    def _CloseMapped(data) :
+        if hasattr(data, "close") :
+            data.close()
+
+    def _SortShard(self, plan) :
+        """分片的记录按id排序后写回, 相同id保持表中的顺序, 归并时只需要顺序读取"""
+        id_field = self._IdField(plan)
+        if id_field is None :
+            raise ValueError("id of col %d is not an integer, shards can't be merged" % self._IdCol())
+
+        bin_file_name = self._BinFile()
+        bin_file = open(bin_file_name, "rb")
+        data = bin_file.read()
+        bin_file.close()
+
+        records = record_file.SplitRecords(data, id_field.number, RECORD_ID_KINDS[id_field.type])
+        records.sort(key=lambda record: record[0])
+        sorted_file = AtomicFile(bin_file_name)
+        for record_id, start, length in records :
+            sorted_file.write(record_file.ItemHeader(length))
+            sorted_file.write(data[start:start + length])
+        sorted_file.Commit()
+
+    def MergeShards(self, shard_files) :
+        """将按id排序的分片k路归并为一个bin, 有重复id时抛出异常, 不输出任何文件
+
+        每个分片都mmap后顺序读取, 内存占用和分片的大小无关. 归并后的bin按id排序
+        """
+        plan = ColumnPlan(self._sheet, self._enum_index)
+        id_field = self._IdField(plan)
+        if id_field is None :
+            raise ValueError("id of col %d is not an integer, shards can't be merged" % self._IdCol())
+        id_kind = RECORD_ID_KINDS[id_field.type]
+
+        files = []
+        shards = []
+        data_file = self._OpenDataFile()
+        try :
+            for shard_file_name in shard_files :
+                files.append(open(shard_file_name, "rb"))
+                shards.append(DataParser._MapFile(files[-1], shard_file_name))
+
+            def _IterShard(shard_index) :
+                for record_id, start, length in record_file.SplitRecords(shards[shard_index], id_field.number,
+                        id_kind) :
+                    yield record_id, shard_index, start, length
+
+            ids = []
+            duplicated = []
+            for record_id, shard_index, start, length in heapq.merge(*[_IterShard(i) for i in range(len(shards))]) :
+                if len(ids) > 0 and ids[-1] == record_id :
+                    if len(duplicated) == 0 or duplicated[-1] != record_id :
+                        duplicated.append(record_id)
+                    continue
+                ids.append(record_id)
+                data_file.write(record_file.ItemHeader(length))
+                data_file.write(shards[shard_index][start:start + length])
+            if len(duplicated) > 0 :
+                raise ValueError("%d duplicated ids in shards: %s" % (len(duplicated),
+                    ", ".join([str(record_id) for record_id in duplicated[:10]])))
+        except :
+            data_file.Abort()
+            raise
+        finally :
+            for shard in shards :
+                DataParser._CloseMapped(shard)
+            for shard_file in files :
+                shard_file.close()
+        data_file.Commit()
+        self._output_files.append(data_file.file_name)
+        LOG_INFO("%s|%d records from %d shards", data_file.file_name, len(ids), len(shard_files))
+
+        self._WriteExtraFiles(plan)
+        self._RemovePartition()
+        # 其他sheet引用这个表时按归并后的id检查, 各分片自己的引用由分片的检查文件记录
+        if self._option.validate is not None :
+            check_file = AtomicFile(SheetValidator.CheckFile(self._output_name))
+            check_file.write(AtomicFile.Bytes(json.dumps({"ids" : ids, "refs" : {}})))
+            check_file.Commit()
+            self._output_files.append(check_file.file_name)
+
+    def _WriteRecordFile(self, plan) :
+        """由输出的bin文件生成按id索引的记录文件, 见record_file"""
+        id_field = self._IdField(plan)
+        if id_field is None :
+            print("%s: id of col %d is not an integer, record file is not generated" % (self._sheet_name,
+                self._IdCol()))
+            return
 
-                self._col += 1
-                self._ParseField(max_repeated_num, repeated_num, item)
+        bin_file_name = self._BinFile()
+        bin_file = open(bin_file_name, "rb")
+        data = DataParser._MapFile(bin_file, bin_file_name)
 
-            else :
-                # 一般是简单的单字段，数值用分号相隔
-                # 一般也只能是数字类型
-                field_type = second_row
-                field_name = str(self._sheet.cell_value(FIELD_NAME_ROW, self._col)).strip()
-                field_value_str = str(self._sheet.cell_value(self._row, self._col))
-                #field_value_str = str(self._sheet.cell_value(self._row, self._col)).strip()
-
-                # LOG_INFO("%d|%d|%s|%s|%s",
-                #         self._row, self._col, field_rule, field_type, field_name, field_value_str)
-                #增加长度判断
-                if len(field_value_str) > 0:
-                    if field_value_str.find(";") > 0 :
-                        field_value_list = field_value_str.split(";")
-                    else :
-                        field_value_list = field_value_str.split("|")
+        rec_file = AtomicFile("./build_out/rec/" + self._output_name + ".rec")
+        try :
+            count, duplicated = record_file.WriteRecordFile(data, rec_file, id_field.number,
+                    RECORD_ID_KINDS[id_field.type])
+        except :
+            rec_file.Abort()
+            raise
+        finally :
+            DataParser._CloseMapped(data)
+            bin_file.close()
+        rec_file.Commit()
+        self._output_files.append(rec_file.file_name)
+
+        LOG_INFO("%s|%d records", rec_file.file_name, count)
+        if len(duplicated) > 0 :
+            print("%s: %d duplicated ids in record file, lookup returns the first one: %s" % (self._sheet_name,
+                len(duplicated), ", ".join([str(record_id) for record_id in duplicated[:10]])))
+
+    def _WriteColumnFile(self) :
+        """由输出的bin文件按列输出, 见column_file"""
+        from google.protobuf import descriptor
+
+        fields = []
+        for field in self._message_class.DESCRIPTOR.fields :
+            fields.append((field.name, field.number, field.type, field.label == descriptor.FieldDescriptor.LABEL_REPEATED))
+
+        bin_file_name = self._BinFile()
+        bin_file = open(bin_file_name, "rb")
+        data = DataParser._MapFile(bin_file, bin_file_name)
+
+        col_file = AtomicFile("./build_out/col/" + self._output_name + ".col")
+        try :
+            records = (data[start:start + length] for record_id, start, length in
+                    record_file.SplitRecords(data, 0, record_file.ID_VARINT))
+            row_count = column_file.WriteColumnFile(records, fields, col_file)
+        except :
+            col_file.Abort()
+            raise
+        finally :
+            DataParser._CloseMapped(data)
+            bin_file.close()
+        col_file.Commit()
+        self._output_files.append(col_file.file_name)
+        LOG_INFO("%s|%d rows, %d columns", col_file.file_name, row_count, len(fields))
+
+    def _WriteStringPool(self) :
+        """由输出的bin生成这个sheet的字符串表和池化的bin, 见string_pool"""
+        bin_file_name = self._BinFile()
+        bin_file = open(bin_file_name, "rb")
+        data = DataParser._MapFile(bin_file, bin_file_name)
+
+        builder = string_pool.PoolBuilder()
+        pooled_file = self._OpenDataFile("./build_out/pool/" + self._output_name + ".bin")
+        try :
+            count = string_pool.WritePooledFile(data, string_pool.StringFields(self._message_class.DESCRIPTOR),
+                    builder, pooled_file)
+        except :
+            pooled_file.Abort()
+            raise
+        finally :
+            DataParser._CloseMapped(data)
+            bin_file.close()
+        pooled_file.Commit()
+
+        pool_file = AtomicFile("./build_out/pool/" + self._output_name + ".pool")
+        builder.Write(pool_file)
+        pool_file.Commit()
+        self._output_files += [pooled_file.file_name, pool_file.file_name]
+        LOG_INFO("%s|%d records, %d strings", pool_file.file_name, count, len(builder))
+
+    def _WritePatchFile(self, plan) :
+        """和上次导出的bin比较, 生成按id的补丁, 见record_patch
+
+        build_out/base下保存上次成功导出的bin, 作为比较的基准, 整个导出成功后才由 UpdatePatchBases 更新
+        """
+        id_field = self._IdField(plan)
+        if id_field is None :
+            print("%s: id of col %d is not an integer, patch file is not generated" % (self._sheet_name,
+                self._IdCol()))
+            return
 
-                    for field_value in field_value_list :
-                        if field_type == "bytes" or field_type == "string":
-                            item.__getattribute__(field_name).append(field_value.encode("utf8"))
-                        else:
-                            item.__getattribute__(field_name).append(int(float(field_value)))
+        bin_file_name = self._BinFile()
+        base_file_name = DataParser.BaseFile(self._output_name)
+        if os.path.exists(base_file_name) :
+            bin_file = open(bin_file_name, "rb")
+            base_file = open(base_file_name, "rb")
+            data = DataParser._MapFile(bin_file, bin_file_name)
+            base_data = DataParser._MapFile(base_file, base_file_name)
+
+            patch_file = AtomicFile("./build_out/patch/" + self._output_name + ".patch")
+            try :
+                counts = record_patch.WritePatchFile(base_data, data, patch_file, id_field.number,
+                        RECORD_ID_KINDS[id_field.type])
+            except :
+                patch_file.Abort()
+                raise
+            finally :
+                DataParser._CloseMapped(data)
+                DataParser._CloseMapped(base_data)
+                bin_file.close()
+                base_file.close()
+
+            if counts is None :
+                patch_file.Abort()
+                print("%s: duplicated ids, patch file is not generated, servers need a full reload" %
+                        self._sheet_name)
+            else :
+                patch_file.Commit()
+                self._output_files.append(patch_file.file_name)
+                LOG_INFO("%s|%d added, %d changed, %d removed", patch_file.file_name, counts[0], counts[1],
+                        counts[2])
+        else :
+            LOG_INFO("%s|no base data, patch file is not generated", self._sheet_name)
 
-                self._col += 1
+    def _ReportUnknownEnums(self, plan) :
+        """统一报告不认识的枚举名, 这些单元格没有设值"""
+        if len(plan.unknown_enums) == 0 :
+            return
+        print("%s: %d unknown enum names, these cells are left unset" % (self._sheet_name, len(plan.unknown_enums)))
+        for (col, enum_type_name, enum_name), rows in plan.unknown_enums.items() :
+            enum_name = sheet_reader._text_type(enum_name)
+            rows_str = ", ".join([str(row) for row in rows[:10]])
+            if len(rows) > 10 :
+                rows_str += ", ... (%d rows)" % len(rows)
+            line = u"    col %d %s: '%s' in rows %s" % (col, enum_type_name, enum_name, rows_str)
+            # python2的stdout可能是ascii, 统一输出utf-8
+            print(line if isinstance(line, str) else line.encode("utf-8"))
+            LOG_WARN(u"%s|col %d|%s|unknown enum name %s in rows %s", self._sheet_name, col, enum_type_name,
+                    enum_name, rows_str)
 
-        elif field_rule == "required_struct" or field_rule == "optional_struct":
-            field_num = int(self._sheet.cell_value(FIELD_TYPE_ROW, self._col))
-            struct_name = str(self._sheet.cell_value(FIELD_NAME_ROW, self._col)).strip()
-            field_name = unicode(self._sheet.cell_value(FIELD_COMMENT_ROW, self._col)).strip()
+    def _WriteData2File(self, data) :
+        # 读取配置的进程不会看到写了一半的文件
+        data_file = self._OpenDataFile()
+        data_file.write(data)
+        data_file.Commit()
+        self._output_files.append(data_file.file_name)
 
-            LOG_INFO("%s|%d|%s|%s", field_rule, field_num, struct_name, field_name)
+    def _WriteReadableData2File(self, data) :
+        readable_file = AtomicFile("./build_out/log/" + self._output_name + ".txt")
+        readable_file.write(AtomicFile.Bytes(data))
+        readable_file.Commit()
+        self._output_files.append(readable_file.file_name)
+
+
+
+class BuildCache:
+    """增量构建缓存
+
+    build_out下的manifest记录每个sheet单元格内容的hash, 以及上次生成的所有文件的hash,
+    工具版本, enum.proto, 影响输出的选项或者检查规则有变化时全部失效
+    """
+    MANIFEST_FILE = "build_out/build_manifest.json"
+    ENUM_PROTO_FILE = "protocol/enum.proto"
+    # 决定输出哪些文件以及文件格式的选项
+    OUTPUT_OPTIONS = ("stream", "readable", "record_file", "codec", "codec_level", "block_size", "column_file",
+            "patch", "validate", "partition", "string_pool")
+
+    def __init__(self, option):
+        self._force = option.force
+        self._inputs = BuildCache._InputsHash(option)
+        self._sheets = {}
+        # struct名到分片归并的记录
+        self._merges = {}
+        # struct名到所有分片的 [文件名, sheet名], 和输出无关, 不随输入失效
+        self._shards = {}
+
+        if os.path.exists(BuildCache.MANIFEST_FILE) :
+            try :
+                manifest_file = open(BuildCache.MANIFEST_FILE, "r")
+                manifest = json.load(manifest_file)
+                manifest_file.close()
+                self._shards = manifest.get("shards", {})
+                if manifest.get("inputs") == self._inputs :
+                    self._sheets = manifest.get("sheets", {})
+                    self._merges = manifest.get("merges", {})
+            except ValueError :
+                LOG_WARN("manifest %s is broken, ignore it", BuildCache.MANIFEST_FILE)
 
+    @staticmethod
+    def _InputsHash(option) :
+        """工具版本, 工具源码, enum.proto, 影响输出的选项和检查规则共同决定的hash"""
+        sha = hashlib.sha1()
+        sha.update(TOOL_VERSION.encode("utf-8"))
+        output_options = [(name, getattr(option, name)) for name in BuildCache.OUTPUT_OPTIONS]
+        sha.update(json.dumps(output_options).encode("utf-8"))
+        source_files = [os.path.abspath(__file__)]
+        for module in (sheet_reader, record_file, record_patch, block_codec, column_file, string_pool) :
+            source_files.append(os.path.splitext(module.__file__)[0] + ".py")
+        if option.validate :
+            source_files.append(option.validate)
+        for file_name in source_files + [BuildCache.ENUM_PROTO_FILE] :
+            if os.path.exists(file_name) :
+                sha.update(BuildCache.FileHash(file_name).encode("utf-8"))
+        return sha.hexdigest()
 
-            col_begin = self._col
+    @staticmethod
+    def FileHash(file_name) :
+        sha = hashlib.sha1()
+        hash_file = open(file_name, "rb")
+        while True :
+            block = hash_file.read(1 << 20)
+            if not block :
+                break
+            sha.update(block)
+        hash_file.close()
+        return sha.hexdigest()
 
-            # 至少循环一次
-            if max_repeated_num == 0 :
-                struct_item = item.__getattribute__(field_name)
-                self._ParseStruct(field_num, struct_item)
+    @staticmethod
+    def IsUpToDate(entry, op, sheet_hash) :
+        """sheet内容和上次一致, 并且上次的输出文件都没有被改动"""
+        if entry is None or entry.get("op") != op or entry.get("hash") != sheet_hash :
+            return False
+        return BuildCache.IsOutputsUpToDate(entry)
 
-            else :
-                if repeated_num == 0 :
-                    if field_rule == "required_struct" :
-                        print("required but repeated_num = 0")
-                        raise
-                    # 先读取再删除掉
-                    struct_item = item.__getattribute__(field_name).add()
-                    self._ParseStruct(field_num, struct_item)
-                    item.__getattribute__(field_name).__delitem__(-1)
+    @staticmethod
+    def IsOutputsUpToDate(entry) :
+        for file_name, file_hash in entry.get("outputs", {}).items() :
+            if not os.path.exists(file_name) or BuildCache.FileHash(file_name) != file_hash :
+                return False
+        return True
 
-                else :
-                    for num in range(0, repeated_num):
-                        struct_item = item.__getattribute__(field_name).add()
-                        self._ParseStruct(field_num, struct_item)
+    @staticmethod
+    def _Key(job) :
+        return os.path.normpath(job.xls_file) + "|" + job.sheet_name
+
+    def Lookup(self, job) :
+        if self._force :
+            return None
+        entry = self._sheets.get(BuildCache._Key(job))
+        # 分片的序号变化后输出文件名也变了, 必须重新导出
+        if entry is not None and entry.get("output_name") != job.output_name :
+            return None
+        return entry
+
+    def Entries(self) :
+        """上次构建记录的所有sheet, [(文件名, sheet名, 缓存记录)]"""
+        entries = []
+        for key, entry in self._sheets.items() :
+            xls_file, sheet_name = key.split("|", 1)
+            entries.append((xls_file, sheet_name, entry))
+        return entries
+
+    def ShardMembers(self, struct_name) :
+        """上次记录的struct的所有分片, [(文件名, sheet名)]"""
+        return [tuple(member) for member in self._shards.get(struct_name, [])]
+
+    def UpdateShards(self, struct_name, jobs) :
+        """记录struct的所有分片, 只有一个sheet时删除记录"""
+        if len(jobs) > 1 :
+            self._shards[struct_name] = [[job.xls_file, job.sheet_name] for job in jobs]
+        elif struct_name in self._shards :
+            del self._shards[struct_name]
+
+    def LookupMerge(self, struct_name) :
+        if self._force :
+            return None
+        return self._merges.get(struct_name)
+
+    def UpdateMerge(self, struct_name, entry) :
+        """entry 为None时删除记录, 下次必须重新归并"""
+        if entry is not None :
+            self._merges[struct_name] = entry
+        elif struct_name in self._merges :
+            del self._merges[struct_name]
+
+    def Update(self, results) :
+        """成功的结果写入缓存, 失败的sheet下次必须重新导出"""
+        for result in results :
+            if result.job.sheet_name is None :
+                continue
+            key = BuildCache._Key(result.job)
+            if result.IsOk() :
+                if result.cache_entry is not None :
+                    self._sheets[key] = result.cache_entry
+            elif key in self._sheets :
+                del self._sheets[key]
+
+    def Save(self) :
+        CheckAndCreateDir("build_out")
+        tmp_file_name = BuildCache.MANIFEST_FILE + ".tmp"
+        manifest_file = open(tmp_file_name, "w")
+        json.dump({"tool_version" : TOOL_VERSION, "inputs" : self._inputs, "sheets" : self._sheets,
+                "merges" : self._merges, "shards" : self._shards}, manifest_file, indent=1, sort_keys=True)
+        manifest_file.close()
+        if os.path.exists(BuildCache.MANIFEST_FILE) :
+            os.remove(BuildCache.MANIFEST_FILE)
+        os.rename(tmp_file_name, BuildCache.MANIFEST_FILE)
+
+class ProtoCodegen:
+    """批量调用protoc生成C++和python代码
+
+    所有sheet的PB定义生成之后统一调用, 一次传入多个proto文件.
+    build_out下的manifest记录上次生成时proto文件的hash, 只有变化了的proto才重新生成;
+    生成的文件和已有的完全一致时不覆盖, 保持修改时间, 避免服务器重新编译
+    """
+    MANIFEST_FILE = "build_out/codegen_manifest.json"
+    TMP_DIR = "build_out/codegen_tmp"
+    # 每次调用protoc的最多文件数, 避免命令行过长
+    CHUNK_SIZE = 100
+
+    def __init__(self, force):
+        self._force = force
+        self._protos = {}
+        # 本次实际更新了的文件
+        self.updated_files = []
+
+        if os.path.exists(ProtoCodegen.MANIFEST_FILE) :
+            try :
+                manifest_file = open(ProtoCodegen.MANIFEST_FILE, "r")
+                self._protos = json.load(manifest_file).get("protos", {})
+                manifest_file.close()
+            except ValueError :
+                LOG_WARN("manifest %s is broken, ignore it", ProtoCodegen.MANIFEST_FILE)
 
-            col_end = self._col
+    @staticmethod
+    def ProtocPath() :
+        return os.path.join(os.getcwd(), "deploy", "proto", "protoc")
 
-            max_repeated_num = 1 if (max_repeated_num == 0) else max_repeated_num
-            actual_repeated_num = 1 if (repeated_num==0) else repeated_num
-            self._col += (max_repeated_num - actual_repeated_num) * ((col_end-col_begin)/actual_repeated_num)
+    @staticmethod
+    def GeneratedFiles(proto_file) :
+        """proto文件对应的生成文件, (临时目录中的相对路径, 输出路径)"""
+        base_name = os.path.splitext(os.path.basename(proto_file))[0]
+        return [("cpp/" + base_name + ".pb.h", "build_out/cpp/" + base_name + ".pb.h"),
+                ("cpp/" + base_name + ".pb.cc", "build_out/cpp/" + base_name + ".pb.cc"),
+                ("py/" + base_name + "_pb2.py", "build_out/py/" + base_name + "_pb2.py")]
+
+    def _IsChanged(self, proto_file) :
+        if self._force or self._protos.get(proto_file) != BuildCache.FileHash(proto_file) :
+            return True
+        for tmp_file, file_name in ProtoCodegen.GeneratedFiles(proto_file) :
+            if not os.path.exists(file_name) :
+                return True
+        return False
 
-        else :
-            self._col += 1
+    def Run(self, proto_files) :
+        """生成有变化的proto, 返回失败的proto文件列表"""
+        changed = [proto_file for proto_file in proto_files if self._IsChanged(proto_file)]
+        failed = []
+        for begin in range(0, len(changed), ProtoCodegen.CHUNK_SIZE) :
+            chunk = changed[begin : begin + ProtoCodegen.CHUNK_SIZE]
+            if self._Protoc(chunk) :
+                continue
+            # 整批失败时protoc不输出任何文件, 逐个重试找出出错的proto
+            if len(chunk) == 1 :
+                failed += chunk
+                continue
+            for proto_file in chunk :
+                if not self._Protoc([proto_file]) :
+                    failed.append(proto_file)
+
+        for proto_file in failed :
+            if proto_file in self._protos :
+                del self._protos[proto_file]
+        self._Save()
+        return failed
+
+    def _Protoc(self, proto_files) :
+        import shutil
+        import subprocess
+
+        if os.path.exists(ProtoCodegen.TMP_DIR) :
+            shutil.rmtree(ProtoCodegen.TMP_DIR)
+        CheckAndCreateDir(ProtoCodegen.TMP_DIR + "/cpp")
+        CheckAndCreateDir(ProtoCodegen.TMP_DIR + "/py")
+
+        command = [ProtoCodegen.ProtocPath(), "-I=protocol",
+                "--cpp_out=" + ProtoCodegen.TMP_DIR + "/cpp",
+                "--python_out=" + ProtoCodegen.TMP_DIR + "/py"] + proto_files
+        LOG_INFO("%s", " ".join(command))
+        try :
+            ret = subprocess.call(command)
+        except OSError as e:
+            print("protoc failed! %s" % e)
+            return False
+        if ret != 0 :
+            print("protoc failed! %s" % " ".join(proto_files))
+            return False
+
+        for proto_file in proto_files :
+            for tmp_file, file_name in ProtoCodegen.GeneratedFiles(proto_file) :
+                self._Install(ProtoCodegen.TMP_DIR + "/" + tmp_file, file_name)
+            self._protos[proto_file] = BuildCache.FileHash(proto_file)
+        shutil.rmtree(ProtoCodegen.TMP_DIR)
+        return True
+
+    def _Install(self, tmp_file, file_name) :
+        """生成的文件有变化才替换"""
+        if not os.path.exists(tmp_file) :
             return
-
-    def _ParseStruct(self, field_num, struct_item) :
-        """嵌套结构数据读取"""
-
-        # 跳过结构体定义
-        self._col += 1
-        while field_num > 0 :
-            self._ParseField(0, 0, struct_item)
-            field_num -= 1
-
-    def _GetFieldValue(self, field_type, row, col) :
-        """将pb类型转换为python类型"""
-
-        field_value = self._sheet.cell_value(row, col)
-        LOG_INFO("%d|%d|%s|%s", row, col, field_type, field_value)
-
-        try:
-            if field_type == "int32" or field_type == "int64"\
-                    or  field_type == "uint32" or field_type == "uint64"\
-                    or field_type == "sint32" or field_type == "sint64"\
-                    or field_type == "fixed32" or field_type == "fixed64"\
-                    or field_type == "sfixed32" or field_type == "sfixed64" :
-                        if len(str(field_value).strip()) <=0 :
-                            return None
-                        else :
-                            return int(field_value)
-            elif field_type == "double" or field_type == "float" :
-                    if len(str(field_value).strip()) <=0 :
-                        return None
-                    else :
-                        return float(field_value)
-            elif field_type == "string" :
-                if len(field_value) <= 0 :
-                    return None
-                else :
-                    return field_value
-            elif field_type == "bytes" :
-                field_value = str(field_value).encode('utf-8')
-                if len(field_value) <= 0 :
-                    return None
+        if os.path.exists(file_name) and BuildCache.FileHash(file_name) == BuildCache.FileHash(tmp_file) :
+            return
+        CheckAndCreateDir(os.path.dirname(file_name))
+        if os.path.exists(file_name) :
+            os.remove(file_name)
+        os.rename(tmp_file, file_name)
+        self.updated_files.append(file_name)
+
+    def _Save(self) :
+        CheckAndCreateDir("build_out")
+        manifest_file = open(ProtoCodegen.MANIFEST_FILE, "w")
+        json.dump({"protos" : self._protos}, manifest_file, indent=1, sort_keys=True)
+        manifest_file.close()
+
+class DeployOption:
+    """导表选项, 命令行参数直接解析到这里, 默认值即属性的初始值"""
+    def __init__(self):
+        # 并行导表的进程数
+        self.jobs = 1
+        # 忽略增量构建缓存
+        self.force = False
+        # 数据的编码方式, message 通过python的message对象序列化, wire 直接编码
+        self.encoder = "message"
+        # wire编码时同时用message对象序列化并比较结果
+        self.check_encoder = False
+        # 流式导出, 逐行编码追加到文件, 只能使用wire编码
+        self.stream = False
+        # 流式导出时是否输出可读的文本
+        self.readable = False
+        # 日志详细程度, 见 LogHelp.VERBOSE_*
+        self.verbose = LogHelp.VERBOSE_INFO
+        # 统计每个sheet的内存峰值, 见 RunSheetJob
+        self.trace_memory = False
+        # 每个sheet输出一份cProfile数据到build_out/profile
+        self.profile = False
+        # 调用protoc生成C++和python代码
+        self.codegen = True
+        # 大于0时单个sheet的数据按这个行数分块, 在jobs个进程中并行编码
+        self.row_chunk = 0
+        # 额外输出按id索引的记录文件到build_out/rec
+        self.record_file = False
+        # bin文件的压缩方式, none为不压缩, 其他见block_codec.CODECS
+        self.codec = "none"
+        # 压缩级别, None为压缩方式的默认级别
+        self.codec_level = None
+        # 压缩时每块原始数据的大小
+        self.block_size = block_codec.DEFAULT_BLOCK_SIZE
+        # 额外按列输出到build_out/col
+        self.column_file = False
+        # 和上次导出的bin比较, 额外输出按id的补丁到build_out/patch
+        self.patch = False
+        # .xls的解析结果保存为快照, 文件没有变化时不再调用xlrd
+        self.snapshot = True
+        # 快照的总大小上限, MB
+        self.snapshot_size = 1024
+        # 检查数据的规则文件, 见 SheetValidator, 空字符串表示只检查id唯一, None为不检查
+        self.validate = None
+        # 按属性值或者边界分区输出, 见 ParsePartitionSpec
+        self.partition = []
+        # 导出模式, 见 DEPLOY_MODES
+        self.mode = "auto"
+        # 字符串表, sheet 每个sheet一个, build 所有sheet共用一个, None为不输出, 见string_pool
+        self.string_pool = None
+        # 行缓存, 重新导出时只编码变化了的行, 见 RowCache
+        self.row_cache = False
+        # 行缓存的总大小上限, MB
+        self.row_cache_size = 256
+        # 常驻进程, 定时检查文件并重新导出
+        self.watch = False
+        self.watch_interval = 0.5
+
+class SheetJob:
+    """导表任务: 一个workbook中的一个sheet"""
+    def __init__(self, xls_file, sheet_name, struct_name, op, option=None):
+        self.xls_file = xls_file
+        self.sheet_name = sheet_name
+        self.struct_name = struct_name
+        # 输出文件名, 多个sheet的struct名相同时为 <struct>@<分片序号>
+        self.output_name = struct_name
+        # 分片序号, 不是分片时为None
+        self.shard = None
+        # option 0 生成proto和data 1 只生成proto 2 只生成data 3 表头有变化时生成proto, 见 DEPLOY_MODES
+        self.op = op
+        self.option = option
+        # 上次构建的缓存记录, 为None时必须导出
+        self.cache_entry = None
+
+class SheetResult:
+    """导表任务的结果, 失败时记录出错的阶段和原因"""
+    def __init__(self, job):
+        self.job = job
+        self.stage = None
+        self.error = None
+        # 内容没有变化, 跳过了导出
+        self.skipped = False
+        # 本次构建的缓存记录
+        self.cache_entry = None
+        # 各阶段耗时等统计, 见 SheetProfile.Report
+        self.profile = None
+
+    def IsOk(self) :
+        return self.error is None
+
+# 每个进程只缓存最近打开的workbook, 同一workbook的任务是连续派发的
+# 文件名到 (修改时间, 大小, workbook), 常驻进程中文件被修改后重新打开
+_workbook_cache = {}
+
+# .xls的快照目录, 见 sheet_reader.SnapshotWorkbook
+SNAPSHOT_DIR = "build_out/snapshot"
+
+def _SnapshotDir(option) :
+    return SNAPSHOT_DIR if option.snapshot else None
+
+def _OpenWorkbook(xls_file, option) :
+    stat = os.stat(xls_file)
+    cached = _workbook_cache.get(xls_file)
+    if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size :
+        return cached[2]
+
+    for mtime, size, cached_wb in _workbook_cache.values() :
+        cached_wb.Release()
+    _workbook_cache.clear()
+    wb = sheet_reader.OpenWorkbook(xls_file, _SnapshotDir(option))
+    _workbook_cache[xls_file] = (stat.st_mtime, stat.st_size, wb)
+    return wb
+
+def _PeakRss() :
+    """进程的常驻内存峰值(字节), 没有resource模块(windows)时返回None"""
+    try :
+        import resource
+    except ImportError :
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # mac下单位为字节, linux下为KB
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def CanTraceMemory() :
+    """tracemalloc和resource至少有一个可用"""
+    try :
+        import tracemalloc
+        return True
+    except ImportError :
+        return _PeakRss() is not None
+
+def RunSheetJob(job) :
+    """执行一个导表任务, 异常不向外抛出, 记录到结果中
+
+    trace_memory 时用tracemalloc统计这个sheet的python内存峰值; 没有tracemalloc(python2)时
+    记录进程的常驻内存峰值ru_maxrss, 进程池中的进程会导出多个sheet, 这个值只增不减
+    """
+    option = job.option if job.option is not None else DeployOption()
+    LogHelp.set_verbose(option.verbose)
+
+    tracemalloc = None
+    if option.trace_memory :
+        try :
+            import tracemalloc
+            tracemalloc.start()
+        except ImportError :
+            tracemalloc = None
+
+    cprofile = None
+    if option.profile :
+        import cProfile
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
+    profile = SheetProfile()
+    result = _RunSheetJob(job, profile)
+
+    if cprofile is not None :
+        cprofile.disable()
+        if job.sheet_name is not None :
+            CheckAndCreateDir("build_out/profile")
+            cprofile.dump_stats("build_out/profile/%s.prof" % job.sheet_name)
+    if tracemalloc is not None :
+        profile.peak_memory = tracemalloc.get_traced_memory()[1]
+        profile.memory_source = "tracemalloc"
+        tracemalloc.stop()
+    elif option.trace_memory :
+        profile.peak_memory = _PeakRss()
+        profile.memory_source = "ru_maxrss"
+
+    result.profile = profile.Report()
+    return result
+
+def _RunSheetJob(job, profile) :
+    result = SheetResult(job)
+    try :
+        result.stage = "Open"
+        with profile.Phase("open") :
+            sheet = _OpenWorkbook(job.xls_file, job.option if job.option is not None else DeployOption()).Sheet(
+                    job.sheet_name)
+
+        with profile.Phase("hash") :
+            sheet_hash = sheet.ContentHash()
+            up_to_date = BuildCache.IsUpToDate(job.cache_entry, job.op, sheet_hash)
+        if up_to_date :
+            result.stage = None
+            result.skipped = True
+            result.cache_entry = job.cache_entry
+            return result
+
+        op = job.op
+        if op == 3 :
+            # 表头和已生成的PB定义一致时跳过SheetInterpreter, 也不需要protoc
+            with profile.Phase("layout") :
+                if SheetInterpreter.HeaderFingerprint(sheet, job.struct_name) == SheetInterpreter.ProtoFingerprint(
+                        job.struct_name) :
+                    op = 2
                 else :
-                    return field_value
-            elif field_type.find('enum-') == 0 :
-                enumTypeName = field_type[len("enum-"):]
-                for i in self._enum_module.DESCRIPTOR.enum_types_by_name[enumTypeName].values:
-                    if field_value == i.name:
-                        return i.number
+                    op = 0
+
+        output_files = []
+        file_descriptor = None
+        if op == 0 or op == 1:
+            result.stage = "Interpreter"
+            tool = SheetInterpreter(sheet, job.struct_name, profile)
+            # 同名的分片只由第一个输出PB定义, 避免并行导出时同时写一个文件
+            if job.shard is None or job.shard == 0 :
+                tool.Interpreter()
             else :
-                return None
-        #except BaseException, e :
-        except Exception as e:
-            print("parse cell(%u, %u) error, please check it, maybe type is wrong."%(row, col))
-            raise
-
-    def _WriteData2File(self, data) :
-        CheckAndCreateDir('build_out/bin')
-        file_name = "./build_out/bin/" + self._sheet_name + ".bin"
-        file = open(file_name, 'wb+')
-        file.write(data)
-        file.close()
-
-    def _WriteReadableData2File(self, data) :
-        CheckAndCreateDir('build_out/log')
-        file_name = "./build_out/log/" + self._sheet_name + ".txt"
-        file = open(file_name, 'wb+')
-        file.write(data)
-        file.close()
-
+                with profile.Phase("layout") :
+                    tool.Layout()
+            output_files += tool.OutputFiles()
+            file_descriptor = tool.FileDescriptor()
+
+        if op == 0 or op == 2:
+            result.stage = "Parse"
+            parser = DataParser(sheet, job.struct_name, job.option, profile, file_descriptor, job.output_name,
+                    job.shard is not None)
+            parser.Parse()
+            output_files += parser.OutputFiles()
+            file_descriptor = parser.FileDescriptor()
+
+        with profile.Phase("hash") :
+            result.cache_entry = {"op" : job.op, "hash" : sheet_hash, "output_name" : job.output_name,
+                    "outputs" : dict((file_name, BuildCache.FileHash(file_name)) for file_name in output_files)}
+            # 归并前检查所有分片的表头一致
+            if job.shard is not None :
+                result.cache_entry["schema"] = hashlib.sha1(file_descriptor.SerializeToString()).hexdigest()
+            # 整个构建共用字符串表时, 跳过导出的sheet也要用到
+            if op != 1 and job.option is not None and job.option.string_pool == "build" :
+                message_class = LoadMessageClasses(file_descriptor, job.struct_name)[0]
+                result.cache_entry["string_fields"] = string_pool.StringFields(message_class.DESCRIPTOR)
+    except Exception as e:
+        import traceback
+        LOG_ERROR("%s|%s|%s failed\n%s", job.xls_file, job.sheet_name, result.stage, traceback.format_exc())
+        result.error = "%s: %s" % (type(e).__name__, e)
+        return result
+
+    result.stage = None
+    return result
+
+def CollectXlsFiles(paths) :
+    """展开命令行参数, 目录取其下所有的表格文件(xls, xlsx, csv, tsv)"""
+    xls_files = []
+    for path in paths :
+        if os.path.isdir(path) :
+            for file_name in sorted(os.listdir(path)) :
+                file_path = os.path.join(path, file_name)
+                # ~$开头的是excel打开时的锁文件
+                if file_name.startswith("~$") :
+                    continue
+                if sheet_reader.IsWorkbookFile(file_name) and os.path.isfile(file_path) :
+                    xls_files.append(file_path)
+        else :
+            xls_files.append(path)
+    return xls_files
+
+def _CollectWorkbookJobs(xls_file, op, option, jobs, failed, struct_names=None) :
+    """列出一个workbook中的sheet, struct_names 不为None时只取这些struct的sheet"""
+    try :
+        wb = sheet_reader.OpenWorkbook(xls_file, _SnapshotDir(option))
+        sheet_names = wb.SheetNames()
+    except Exception as e:
+        result = SheetResult(SheetJob(xls_file, None, None, op, option))
+        result.stage = "Open"
+        result.error = "%s: %s" % (type(e).__name__, e)
+        _PrintResult(result)
+        failed.append(result)
+        return
+    for sheet_name in sheet_names :
+        struct_name = sheet_name
+        strlist = sheet_name.split('-')
+        if len(strlist) == 2:
+            struct_name = strlist[0]
+        else :
+            if struct_names is None :
+                print('sheet: ' + struct_name + "has no '-'")
+            continue
+        if struct_names is None or struct_name in struct_names :
+            jobs.append(SheetJob(xls_file, sheet_name, struct_name, op, option))
+    wb.Release()
+
+def CollectSheetJobs(xls_files, op, option, cache=None) :
+    """列出所有workbook中需要导出的sheet, 打不开的workbook直接记为失败
+
+    只导出部分文件(指定单个文件或者watch)时, 由cache中记录的分片补全同名struct在其他文件中的sheet,
+    这些sheet没有变化时跳过导出, 归并时使用已有的分片
+    """
+    jobs = []
+    failed = []
+    for xls_file in xls_files :
+        _CollectWorkbookJobs(xls_file, op, option, jobs, failed)
+
+    if cache is not None :
+        scanned = set(os.path.normpath(xls_file) for xls_file in xls_files)
+        struct_names = set(job.struct_name for job in jobs)
+        member_files = []
+        for struct_name in sorted(struct_names) :
+            for xls_file, sheet_name in cache.ShardMembers(struct_name) :
+                if os.path.normpath(xls_file) not in scanned and os.path.isfile(xls_file) :
+                    scanned.add(os.path.normpath(xls_file))
+                    member_files.append(xls_file)
+        for xls_file in member_files :
+            _CollectWorkbookJobs(xls_file, op, option, jobs, failed, struct_names)
+
+    # struct名相同的sheet作为一个表的分片, 按文件名和sheet的顺序编号, 和本次导出哪些文件无关
+    structs = collections.OrderedDict()
+    for job in sorted(jobs, key=lambda job: os.path.normpath(job.xls_file)) :
+        structs.setdefault(job.struct_name, []).append(job)
+    for struct_name, struct_jobs in structs.items() :
+        if len(struct_jobs) > 1 :
+            for shard, job in enumerate(struct_jobs) :
+                job.shard = shard
+                job.output_name = "%s@%d" % (struct_name, shard)
+        if cache is not None :
+            cache.UpdateShards(struct_name, struct_jobs)
+    return jobs, failed
+
+def MergeShards(results, cache) :
+    """所有分片导出后, 同一struct的分片按id归并为一个bin, 见 DataParser.MergeShards
+
+    分片的bin和上次归并时一致并且归并的输出没有被改动时跳过;
+    有分片失败, 分片的表头不一致或者有重复id时, 这个struct的所有分片都记为失败
+    """
+    shards = collections.OrderedDict()
+    for result in results :
+        if result.job.shard is not None and result.job.op != 1 :
+            shards.setdefault(result.job.struct_name, []).append(result)
+
+    for struct_name, shard_results in shards.items() :
+        shard_results.sort(key=lambda result: result.job.shard)
+        job = shard_results[0].job
+        shard_files = [DataParser.ShardFile(result.job.output_name) for result in shard_results]
+
+        error = None
+        failed = [result for result in shard_results if not result.IsOk()]
+        if len(failed) > 0 :
+            error = "shard %s|%s failed" % (failed[0].job.xls_file, failed[0].job.sheet_name)
+        elif len(set([result.cache_entry.get("schema") for result in shard_results])) > 1 :
+            error = "shards have different headers"
+        else :
+            shard_hashes = [result.cache_entry["outputs"].get(shard_file)
+                    for result, shard_file in zip(shard_results, shard_files)]
+            entry = cache.LookupMerge(struct_name)
+            if entry is not None and entry.get("shards") == shard_hashes and BuildCache.IsOutputsUpToDate(entry) :
+                continue
+            try :
+                sheet = _OpenWorkbook(job.xls_file, job.option).Sheet(job.sheet_name)
+                parser = DataParser(sheet, struct_name, job.option)
+                parser.MergeShards(shard_files)
+                cache.UpdateMerge(struct_name, {"shards" : shard_hashes, "outputs" : dict((file_name,
+                    BuildCache.FileHash(file_name)) for file_name in parser.OutputFiles())})
+                print("%s merged from %d shards" % (struct_name, len(shard_files)))
+                continue
+            except Exception as e:
+                import traceback
+                LOG_ERROR("%s|Merge failed\n%s", struct_name, traceback.format_exc())
+                error = "%s: %s" % (type(e).__name__, e)
+
+        print("%s Merge Failed!!!" % struct_name)
+        print(error)
+        cache.UpdateMerge(struct_name, None)
+        for result in shard_results :
+            if result.IsOk() :
+                result.stage = "Merge"
+                result.error = error
+                result.skipped = False
+
+def BatchDeploy(jobs, worker_num) :
+    """在进程池中执行所有导表任务, 返回全部结果"""
+    results = []
+    if worker_num <= 1 or len(jobs) <= 1 :
+        for job in jobs :
+            results.append(RunSheetJob(job))
+            _PrintResult(results[-1])
+        return results
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(worker_num, len(jobs)))
+    try :
+        for result in pool.imap_unordered(RunSheetJob, jobs) :
+            results.append(result)
+            _PrintResult(result)
+        pool.close()
+    except :
+        pool.terminate()
+        raise
+    finally :
+        pool.join()
+    return results
+
+def WriteReport(results, wall, stages, option) :
+    """将每个sheet的统计写成json报告"""
+    sheets = []
+    for result in results :
+        job = result.job
+        sheet = {"xls_file" : job.xls_file, "sheet_name" : job.sheet_name, "struct_name" : job.struct_name,
+                "output_name" : job.output_name, "skipped" : result.skipped, "error" : result.error}
+        if result.profile is not None :
+            sheet.update(result.profile)
+        sheets.append(sheet)
+
+    report = {"tool_version" : TOOL_VERSION, "jobs" : option.jobs, "wall" : wall, "stages" : stages,
+            "rows" : sum(sheet.get("rows", 0) for sheet in sheets),
+            "cells" : sum(sheet.get("cells", 0) for sheet in sheets),
+            "sheets" : sheets}
+    CheckAndCreateDir("build_out")
+    report_file = open(WriteReport.REPORT_FILE, "w")
+    json.dump(report, report_file, indent=1, sort_keys=True)
+    report_file.close()
+
+WriteReport.REPORT_FILE = "build_out/deploy_report.json"
+
+def WriteBuildStringPool(results, option, cache) :
+    """所有sheet共用一个字符串表 build_out/pool/strings.pool, 每个bin池化后输出到build_out/pool
+
+    字符串表包含cache中记录的所有表, 只导出部分文件时, 之前池化的bin中的下标仍然有效;
+    所有sheet都跳过了导出并且字符串表已经存在时不再生成; 失败时所有sheet都记为失败
+    """
+    pool_file_name = "./build_out/pool/strings.pool"
+    if os.path.exists(pool_file_name) and len([result for result in results if not result.skipped]) == 0 :
+        return
 
+    # 本次的结果覆盖缓存中的记录, 文件已经删除的sheet不再输出
+    entries = {}
+    for xls_file, sheet_name, entry in cache.Entries() :
+        if os.path.isfile(xls_file) :
+            entries[(os.path.normpath(xls_file), sheet_name)] = entry
+    for result in results :
+        job = result.job
+        if job.sheet_name is None :
+            continue
+        key = (os.path.normpath(job.xls_file), job.sheet_name)
+        if result.IsOk() and result.cache_entry is not None :
+            entries[key] = result.cache_entry
+        elif key in entries :
+            del entries[key]
+
+    # 输出名到需要池化的属性, 分片使用归并后的bin
+    tables = {}
+    for entry in entries.values() :
+        string_fields = entry.get("string_fields")
+        output_name = entry.get("output_name")
+        if string_fields is not None and output_name is not None :
+            tables[output_name.split("@")[0]] = string_fields
+
+    builder = string_pool.PoolBuilder()
+    try :
+        for output_name in sorted(tables.keys()) :
+            data = block_codec.ReadData("./build_out/bin/" + output_name + ".bin")
+            pooled_file_name = "./build_out/pool/" + output_name + ".bin"
+            if option.codec == "none" :
+                pooled_file = AtomicFile(pooled_file_name)
+            else :
+                pooled_file = CompressedFile(pooled_file_name, option.codec, option.codec_level, option.block_size)
+            try :
+                string_pool.WritePooledFile(data, tables[output_name], builder, pooled_file)
+            except :
+                pooled_file.Abort()
+                raise
+            pooled_file.Commit()
+
+        pool_file = AtomicFile(pool_file_name)
+        builder.Write(pool_file)
+        pool_file.Commit()
+        LOG_INFO("%s|%d tables, %d strings", pool_file_name, len(tables), len(builder))
+    except Exception as e:
+        import traceback
+        LOG_ERROR("string pool failed\n%s", traceback.format_exc())
+        error = "%s: %s" % (type(e).__name__, e)
+        print("string pool Failed!!!")
+        print(error)
+        for result in results :
+            if result.IsOk() and result.job.sheet_name is not None :
+                result.stage = "StringPool"
+                result.error = error
+                result.skipped = False
+
+def UpdatePatchBases(results) :
+    """整个导出成功后, 本次的bin作为下次生成补丁的基准, 见 DataParser._WritePatchFile
+
+    有任何失败时不调用, 下次的补丁仍然相对于上次成功导出的bin. 分片的基准是归并后的bin;
+    基准比bin新时不再复制, 跳过导出的sheet在上次导出失败时的基准也在这里更新
+    """
+    import shutil
+
+    output_names = set()
+    for result in results :
+        job = result.job
+        if job.sheet_name is not None and job.op != 1 :
+            output_names.add(job.struct_name if job.shard is not None else job.output_name)
+
+    for output_name in sorted(output_names) :
+        bin_file_name = "./build_out/bin/" + output_name + ".bin"
+        base_file_name = DataParser.BaseFile(output_name)
+        if not os.path.exists(bin_file_name) :
+            continue
+        bin_stat = os.stat(bin_file_name)
+        if os.path.exists(base_file_name) :
+            base_stat = os.stat(base_file_name)
+            if base_stat.st_mtime >= bin_stat.st_mtime and base_stat.st_size == bin_stat.st_size :
+                continue
+        base_file = AtomicFile(base_file_name)
+        bin_file = open(bin_file_name, "rb")
+        shutil.copyfileobj(bin_file, base_file)
+        bin_file.close()
+        base_file.Commit()
+        LOG_INFO("%s|patch base updated", base_file_name)
+
+def _PrintResult(result) :
+    job = result.job
+    if result.skipped :
+        print("%s|%s Up To Date" % (job.xls_file, job.sheet_name))
+    elif result.IsOk() :
+        print("%s|%s Success!!!" % (job.xls_file, job.sheet_name))
+    else :
+        print("%s|%s %s Failed!!!" % (job.xls_file, job.sheet_name, result.stage))
+        print(result.error)
+
+def Deploy(paths, op, option) :
+    """完整导出一次: 生成enum的代码, 导出所有sheet, 统一生成PB的代码, 更新缓存并输出报告
+
+    返回所有sheet的结果和生成代码失败的proto文件
+    """
+    start = time.time()
+
+    stages = collections.OrderedDict()
+    codegen = ProtoCodegen(option.force)
+    failed_protos = []
+    # 导数据需要enum_pb2, 先于所有sheet生成
+    if option.codegen :
+        stage_start = time.time()
+        failed_protos += codegen.Run([BuildCache.ENUM_PROTO_FILE])
+        stages["codegen_enum"] = time.time() - stage_start
+
+    stage_start = time.time()
+    cache = BuildCache(option)
+    jobs, results = CollectSheetJobs(CollectXlsFiles(paths), op, option, cache)
+    for job in jobs :
+        job.cache_entry = cache.Lookup(job)
+    results += BatchDeploy(jobs, option.jobs)
+    stages["sheets"] = time.time() - stage_start
+
+    if len([job for job in jobs if job.shard is not None]) > 0 :
+        stage_start = time.time()
+        MergeShards(results, cache)
+        stages["merge"] = time.time() - stage_start
+
+    if option.string_pool == "build" and op != 1 :
+        stage_start = time.time()
+        WriteBuildStringPool(results, option, cache)
+        stages["string_pool"] = time.time() - stage_start
+
+    if option.validate is not None :
+        stage_start = time.time()
+        ValidateReferences(results)
+        stages["validate"] = time.time() - stage_start
+
+    # 所有sheet的PB定义生成后, 统一生成代码, proto没有变化时不调用protoc
+    if option.codegen and op != 2 :
+        stage_start = time.time()
+        proto_files = set()
+        for result in results :
+            if result.IsOk() and result.job.sheet_name is not None :
+                proto_files.add("protocol/" + result.job.struct_name + ".proto")
+        failed_protos += codegen.Run(sorted(proto_files))
+        stages["codegen"] = time.time() - stage_start
+    for file_name in codegen.updated_files :
+        print("generate %s" % file_name)
+
+    if option.patch and op != 1 and len(failed_protos) == 0 and len([result for result in results
+            if not result.IsOk()]) == 0 :
+        UpdatePatchBases(results)
+
+    cache.Update(results)
+    cache.Save()
+    if option.snapshot :
+        removed = sheet_reader.TrimSnapshots(SNAPSHOT_DIR, option.snapshot_size << 20)
+        if removed > 0 :
+            LOG_INFO("remove %d snapshots", removed)
+    if option.row_cache :
+        removed = sheet_reader.TrimSnapshots(RowCache.DIR, option.row_cache_size << 20)
+        if removed > 0 :
+            LOG_INFO("remove %d row caches", removed)
+    WriteReport(results, time.time() - start, stages, option)
+    return results, failed_protos
+
+def _PrintSummary(results, failed_protos) :
+    """输出导出结果的汇总, 返回进程的退出码"""
+    failed = [result for result in results if not result.IsOk()]
+    skipped = [result for result in results if result.skipped]
+    print("total %d sheets, %d up to date, %d failed" % (len(results), len(skipped), len(failed)))
+    for result in failed :
+        print("    %s|%s %s: %s" % (result.job.xls_file, result.job.sheet_name, result.stage, result.error))
+    for proto_file in failed_protos :
+        print("    %s Codegen failed" % proto_file)
+
+    if len([result for result in failed if result.stage == "Interpreter"]) > 0 or len(failed_protos) > 0 :
+        return -3
+    if len(failed) > 0 :
+        return -4
+    return 0
+
+def _WatchSnapshot(paths) :
+    """所有表格文件和enum.proto的 {文件名: (修改时间, 大小)}"""
+    snapshot = {}
+    for file_name in CollectXlsFiles(paths) + [BuildCache.ENUM_PROTO_FILE] :
+        try :
+            stat = os.stat(file_name)
+        except OSError :
+            continue
+        snapshot[file_name] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+def _ReadCommands(commands) :
+    """从标准输入读取命令, 输入结束后不再读取, 常驻进程继续运行"""
+    while True :
+        line = sys.stdin.readline()
+        if not line :
+            return
+        line = line.strip()
+        if line :
+            commands.put(line)
+
+def _ReloadEnumModule() :
+    """enum.proto变化后, 重新加载enum的描述和用到它的message类
+
+    默认的descriptor pool中已经有旧的enum.proto, 不能再import新生成的enum_pb2,
+    由protoc输出描述后加载到独立的pool中, 代替enum_pb2模块
+    """
+    import subprocess
+    from google.protobuf import descriptor_pb2
+    from google.protobuf import descriptor_pool
+
+    _enum_module_cache.clear()
+    _enum_index_cache.clear()
+    _message_class_cache.clear()
+
+    CheckAndCreateDir("build_out")
+    descriptor_file = "build_out/enum.desc"
+    command = [ProtoCodegen.ProtocPath(), "-I=protocol", "--descriptor_set_out=" + descriptor_file,
+            BuildCache.ENUM_PROTO_FILE]
+    LOG_INFO("%s", " ".join(command))
+    try :
+        ret = subprocess.call(command)
+    except OSError as e:
+        print("protoc failed! %s" % e)
+        return
+    if ret != 0 :
+        print("protoc failed! %s" % BuildCache.ENUM_PROTO_FILE)
+        return
 
-if __name__ == '__main__' :
+    descriptor_set = descriptor_pb2.FileDescriptorSet()
+    with open(descriptor_file, "rb") as f :
+        descriptor_set.ParseFromString(f.read())
+    os.remove(descriptor_file)
+    pool = descriptor_pool.DescriptorPool()
+    for file_proto in descriptor_set.file :
+        pool.AddSerializedFile(file_proto.SerializeToString())
+    _enum_module_cache["enum_pb2"] = _EnumModule(pool.FindFileByName(descriptor_set.file[-1].name))
+
+def Watch(paths, op, option) :
+    """常驻进程: 定时检查表格文件, 只重新导出有变化的文件
+
+    模块, enum索引, message类和打开的workbook都保留在进程中, 单个sheet的修改不需要重新启动工具.
+    标准输入的命令:
+        build   立即检查一次
+        force   忽略缓存重新导出所有文件
+        status  输出上一次导出的结果
+        quit    退出
+    """
+    import threading
+    try :
+        import queue
+    except ImportError :
+        import Queue as queue
+
+    commands = queue.Queue()
+    reader = threading.Thread(target=_ReadCommands, args=(commands,))
+    reader.daemon = True
+    reader.start()
+
+    print("watching %s, poll every %.1fs, commands: build force status quit" % (" ".join(paths),
+        option.watch_interval))
+    snapshot = {}
+    status = "no build yet"
+    while True :
+        try :
+            command = commands.get(timeout=option.watch_interval)
+        except queue.Empty :
+            command = "build"
+        except KeyboardInterrupt :
+            command = "quit"
+
+        if command == "quit" :
+            break
+        elif command == "status" :
+            print(status)
+            continue
+        elif command not in ("build", "force") :
+            print("unknown command %s, commands: build force status quit" % command)
+            continue
+
+        new_snapshot = _WatchSnapshot(paths)
+        if command == "force" :
+            changed = sorted(new_snapshot.keys())
+        else :
+            changed = sorted([file_name for file_name, stat in new_snapshot.items() if snapshot.get(file_name) != stat])
+        if len(changed) == 0 :
+            continue
+        # 文件可能还在写, 等大小和修改时间稳定后再导出
+        time.sleep(0.1)
+        if _WatchSnapshot(paths) != new_snapshot :
+            continue
+
+        start = time.time()
+        xls_files = [file_name for file_name in changed if file_name != BuildCache.ENUM_PROTO_FILE]
+        # enum.proto变化时所有sheet的缓存都会失效, 需要全部重新导出
+        if BuildCache.ENUM_PROTO_FILE in changed and len(snapshot) > 0 :
+            _ReloadEnumModule()
+            xls_files = CollectXlsFiles(paths)
+
+        force = option.force
+        option.force = (command == "force")
+        try :
+            results, failed_protos = Deploy(xls_files, op, option)
+        except Exception as e :
+            import traceback
+            LOG_ERROR("deploy failed\n%s", traceback.format_exc())
+            print("deploy failed: %s: %s" % (type(e).__name__, e))
+            snapshot = new_snapshot
+            continue
+        finally :
+            option.force = force
+        snapshot = new_snapshot
+
+        failed = [result for result in results if not result.IsOk()]
+        exported = [result for result in results if result.IsOk() and not result.skipped]
+        status = "[%s] %d files, %d sheets exported, %d failed, %d protos failed, %.3fs" % (
+                time.strftime("%H:%M:%S"), len(xls_files), len(exported), len(failed), len(failed_protos),
+                time.time() - start)
+        _PrintSummary(results, failed_protos)
+        print(status)
+        sys.stdout.flush()
+
+    LogHelp.set_close_flag(True)
+    LogHelp.close()
+    return 0
+
+def main(argv) :
     """入口"""
-    if len(sys.argv) < 2 :
-        print("Usage: %s sheet_name(should be upper) xls_file" %(sys.argv[0]))
-        sys.exit(-1)
-
-# option 0 生成proto和data 1 只生成proto 2 只生成data
-op = 0
-        
-xls_file_path =  sys.argv[1]
-wb = xlrd.open_workbook(xls_file_path)
-
-#获取workbook中所有的表格
-sheets = wb.sheet_names()
-#print(sheets)
-
-#循环遍历所有sheet
-for i in range(len(sheets)):
-    sheet_name = sheets[i]
-    struct_name = sheet_name
-    strlist = sheet_name.split('-')
-    if len(strlist) == 2:
-        struct_name = strlist[0]
-    else :
-        print('sheet: ' + struct_name + "has no '-'")
-        continue
+    import argparse
+    import multiprocessing
+
+    option = DeployOption()
+    option.jobs = multiprocessing.cpu_count()
+
+    arg_parser = argparse.ArgumentParser(description="xls 配置导表工具")
+    arg_parser.add_argument("paths", nargs="+", metavar="xls_file",
+            help="xls文件或者xls所在的目录, 可以有多个")
+    arg_parser.add_argument("--mode", choices=list(DEPLOY_MODES.keys()),
+            help="导出模式: all 生成proto和数据, schema 只生成proto, data 只导出数据, "
+            "auto 表头和已生成的proto一致时只导出数据(默认)")
+    arg_parser.add_argument("-j", "--jobs", type=int,
+            help="并行导表的进程数, 默认为cpu核数")
+    arg_parser.add_argument("--force", action="store_true",
+            help="忽略增量构建缓存, 重新导出所有sheet")
+    arg_parser.add_argument("--encoder", choices=["message", "wire"],
+            help="数据编码方式: message 通过message对象序列化(默认), wire 按descriptor直接编码, "
+            "纯python实现的protobuf下wire更快")
+    arg_parser.add_argument("--check-encoder", action="store_true",
+            help="wire编码时同时用message对象序列化, 结果不一致则导表失败")
+    arg_parser.add_argument("--stream", action="store_true",
+            help="流式导出: 逐行wire编码并追加到bin文件, 内存占用不随行数增长")
+    arg_parser.add_argument("--readable", action="store_true",
+            help="流式导出时同时输出可读的文本到build_out/log/<sheet>.txt")
+    arg_parser.add_argument("-v", "--verbose", type=int, choices=[0, 1, 2],
+            help="日志详细程度: 0 警告和错误, 1 sheet和表头信息(默认), 2 每行数据")
+    arg_parser.add_argument("--trace-memory", action="store_true",
+            help="统计每个sheet的内存峰值: python3用tracemalloc, 会明显变慢; "
+            "python2记录进程的常驻内存峰值ru_maxrss")
+    arg_parser.add_argument("--profile", action="store_true",
+            help="每个sheet输出cProfile数据到build_out/profile/<sheet>.prof")
+    arg_parser.add_argument("--no-codegen", dest="codegen", action="store_false",
+            help="不调用protoc生成C++和python代码")
+    arg_parser.add_argument("--row-chunk", type=int, metavar="ROWS",
+            help="单个sheet的数据按ROWS行分块, 在-j个进程中并行编码, 输出和逐行编码完全一致; "
+            "只对单独导出的sheet生效, 多个sheet并行导出时仍逐行编码")
+    arg_parser.add_argument("--watch", action="store_true",
+            help="常驻进程, 定时检查表格文件, 有变化时只重新导出变化的文件, 从标准输入接收命令")
+    arg_parser.add_argument("--watch-interval", type=float, metavar="SECONDS",
+            help="常驻进程检查文件的间隔, 默认0.5秒")
+    arg_parser.add_argument("--record-file", action="store_true",
+            help="额外输出按id索引的记录文件到build_out/rec/<sheet>.rec, 可以用record_file.RecordFile按id按需读取")
+    arg_parser.add_argument("--no-snapshot", dest="snapshot", action="store_false",
+            help="不使用.xls的快照, 每次都用xlrd解析")
+    arg_parser.add_argument("--snapshot-size", type=int, metavar="MB",
+            help="%s下快照的总大小上限, 超过时删除最久没有使用的快照, 默认1024MB" % SNAPSHOT_DIR)
+    arg_parser.add_argument("--validate", action="store_const", const="",
+            help="检查数据: id唯一, 有错误时导表失败")
+    arg_parser.add_argument("--validate-rules", metavar="RULES",
+            help="检查数据: id唯一, RULES文件中配置的取值范围和对其他sheet id的引用, 有错误时导表失败; "
+            "包含--validate")
+    arg_parser.add_argument("--column-file", action="store_true",
+            help="额外按列输出到build_out/col/<sheet>.col, 可以用column_file.ColumnFile直接mmap为NumPy数组")
+    arg_parser.add_argument("--codec", choices=["none"] + list(block_codec.CODECS.keys()),
+            help="bin文件按块压缩, 每块可以单独解压, 用block_codec读取; 默认none不压缩")
+    arg_parser.add_argument("--codec-level", type=int, metavar="LEVEL",
+            help="压缩级别, 默认为压缩方式的默认级别")
+    arg_parser.add_argument("--block-size", type=int, metavar="BYTES",
+            help="压缩时每块原始数据的大小, 默认%d" % block_codec.DEFAULT_BLOCK_SIZE)
+    arg_parser.add_argument("--patch", action="store_true",
+            help="和上次导出的bin比较, 额外输出按id的新增, 修改和删除的记录到build_out/patch/<sheet>.patch, "
+            "可以用record_patch.ApplyPatch应用到上次的bin")
+    arg_parser.add_argument("--string-pool", choices=["sheet", "build"],
+            help="额外输出去重的字符串表和string属性改为字符串表下标的bin到build_out/pool, "
+            "sheet 每个sheet一个字符串表<sheet>.pool, build 所有sheet共用strings.pool; 用string_pool.StringPool读取")
+    arg_parser.add_argument("--row-cache", action="store_true",
+            help="缓存每行编码的结果到%s, 重新导出时只转换和编码变化了的行, 输出不变" % RowCache.DIR)
+    arg_parser.add_argument("--row-cache-size", type=int, metavar="MB",
+            help="行缓存的总大小上限, 超过时删除最久没有使用的sheet的缓存, 默认256MB")
+    arg_parser.add_argument("--partition", action="append", metavar="STRUCT:FIELD[:BOUNDS]",
+            help="额外按属性分区输出到build_out/part/<sheet>/, 清单为build_out/part/<sheet>.json; "
+            "没有BOUNDS时每个属性值一个分区, 如 monster:map; BOUNDS为逗号相隔的递增边界, 如 monster:id:1000,2000; "
+            "可以指定多次")
+    args = arg_parser.parse_args(argv[1:], namespace=option)
+    if option.validate_rules is not None :
+        option.validate = option.validate_rules
+    del option.validate_rules
+    if option.trace_memory and not CanTraceMemory() :
+        arg_parser.error("--trace-memory needs tracemalloc or resource, neither is available")
+    for spec in option.partition :
+        try :
+            ParsePartitionSpec(spec)
+        except ValueError as e:
+            arg_parser.error(str(e))
 
-    sheet = wb.sheet_by_name(sheet_name)
+    op = DEPLOY_MODES[option.mode]
 
-    if op == 0 or op == 1:
-        try :
-            tool = SheetInterpreter(sheet, struct_name)
-            tool.Interpreter()
-        #except BaseException, e :
-        except Exception as e:
-            print("Interpreter Failed!!!")
-            print(e)
-            sys.exit(-3)
+    # 所有sheet在同一进程内处理, 日志不能每个sheet关闭一次
+    LogHelp.set_close_flag(False)
+    LogHelp.set_verbose(option.verbose)
 
-        print("Interpreter Success!!!")
+    if option.watch :
+        return Watch(args.paths, op, option)
 
-    if op == 0 or op == 2:
-        try :
-            parser = DataParser(sheet, struct_name)
-            parser.Parse()
-        #except BaseException, e :
-        except Exception as e:
-            print("Parse Failed!!!")
-            print(e)
-            sys.exit(-4)
+    results, failed_protos = Deploy(args.paths, op, option)
+
+    LogHelp.set_close_flag(True)
+    LogHelp.close()
 
-        print("Parse Success!!!")
+    return _PrintSummary(results, failed_protos)
 
+if __name__ == '__main__' :
+    sys.exit(main(sys.argv))
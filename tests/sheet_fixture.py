@@ -0,0 +1,101 @@
+#coding=utf-8
+
+##
+# @file:   sheet_fixture.py
+# @brief:  测试用的内存中的sheet和enum描述, 不需要excel文件和protoc
+
+# 说明:
+#   1 xls_deploy 导入时在当前目录下创建build_out/log, 测试都在临时目录中运行
+#   2 enum.proto 直接由描述构造, 代替protoc生成的enum_pb2
+#   3 EncodeRecord/EncodeArray 只用标准库编码bin, 测试record_file等文件格式时不需要protobuf
+##
+
+import atexit
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+DEPLOY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "deploy")
+if DEPLOY_DIR not in sys.path :
+    sys.path.insert(0, DEPLOY_DIR)
+
+WORK_DIR = tempfile.mkdtemp(prefix="xls_deploy_test_")
+os.chdir(WORK_DIR)
+atexit.register(shutil.rmtree, WORK_DIR, True)
+
+import sheet_reader
+import xls_deploy
+
+# 所有sheet在同一进程内处理, 日志不能每个sheet关闭一次
+xls_deploy.LogHelp.set_close_flag(False)
+
+ENUM_VALUES = (("EXAMPLE_NONE", 0), ("EXAMPLE_A", 1), ("EXAMPLE_B", 2))
+
+# 覆盖各种属性: 标量, 负数, 浮点, 字符串, 枚举, 重复次数列, 单列数组, 枚举数组, 字符串数组
+HEADER = [
+    [u"ID", u"LEVEL", u"OFFSET", u"BIG", u"RATE", u"NAME", u"TYPE", u"COUNT", u"REP", u"REP",
+        u"LIST", u"TYPES", u"NAMES"],
+    [u"uint32", u"int32", u"sint32", u"int64", u"float", u"string", u"enum-exampleType", u"2[]", u"int32", u"int32",
+        u"int32[]", u"enum-exampleType[]", u"string[]"],
+    [u"id", u"level", u"offset", u"big", u"rate", u"name", u"type", u"", u"rep", u"rep",
+        u"list", u"types", u"names"],
+]
+
+def InstallEnum() :
+    """用描述构造enum.proto, 放到xls_deploy的缓存中"""
+    from google.protobuf import descriptor_pb2
+    from google.protobuf import descriptor_pool
+
+    file_proto = descriptor_pb2.FileDescriptorProto()
+    file_proto.name = "enum.proto"
+    file_proto.package = xls_deploy.PROTO_PACKAGE
+    file_proto.syntax = "proto3"
+    enum_proto = file_proto.enum_type.add()
+    enum_proto.name = "exampleType"
+    for name, number in ENUM_VALUES :
+        value = enum_proto.value.add()
+        value.name = name
+        value.number = number
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.AddSerializedFile(file_proto.SerializeToString())
+    xls_deploy._enum_index_cache.clear()
+    xls_deploy._message_class_cache.clear()
+    xls_deploy._enum_module_cache["enum_pb2"] = xls_deploy._EnumModule(pool.FindFileByName("enum.proto"))
+
+def DataRow(i) :
+    """第i行数据, 数值有xlrd的float, 也有csv的字符串"""
+    return [float(i), u"%d" % (i * 7 - 50), -i, -(1 << 40) * i, i * 0.5, u"名字%d" % (i % 5) if i % 3 else u"",
+        ENUM_VALUES[i % 3][0], float(i % 3), i, -i, u"%d;%d;-%d" % (i, i + 1, i) if i % 4 else u"",
+        u"EXAMPLE_A|EXAMPLE_B" if i % 2 else u"EXAMPLE_NONE", u"a;b%d" % i]
+
+def MakeSheet(name, row_count) :
+    """表头加row_count行数据的sheet"""
+    rows = [list(row) for row in HEADER] + [DataRow(i) for i in range(1, row_count + 1)]
+    return sheet_reader.SnapshotSheet(name, len(HEADER[0]), rows, name)
+
+def _Varint(value) :
+    data = bytearray()
+    while True :
+        byte = value & 0x7f
+        value >>= 7
+        if value :
+            data.append(byte | 0x80)
+        else :
+            data.append(byte)
+            return bytes(data)
+
+def EncodeRecord(record_id, name, fixed64=False) :
+    """不依赖protobuf, 编码 {id = 1; name = 2} 的一个记录, id为uint64或者fixed64"""
+    if fixed64 :
+        data = b"\x09" + struct.pack("<Q", record_id)
+    else :
+        data = b"\x08" + _Varint(record_id)
+    name = name.encode("utf-8")
+    return data + b"\x12" + _Varint(len(name)) + name
+
+def EncodeArray(records) :
+    """若干个记录拼成<sheet>_array序列化的数据"""
+    return b"".join([b"\x0a" + _Varint(len(record)) + record for record in records])
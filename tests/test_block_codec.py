@@ -0,0 +1,73 @@
+#coding=utf-8
+
+##
+# @file:   test_block_codec.py
+# @brief:  分块压缩的bin解压后和原始数据一致, 每块都是完整的items, 只依赖标准库
+##
+
+import io
+import os
+import unittest
+
+# sheet_fixture 把deploy目录加入sys.path
+from sheet_fixture import EncodeArray, EncodeRecord
+import block_codec
+
+class BlockCodecTest(unittest.TestCase):
+    def _Write(self, file_name, data, codec, block_size, piece_size) :
+        out_file = open(file_name, "wb")
+        writer = block_codec.BlockWriter(out_file, codec, None, block_size)
+        # 分多次写入, 写入的边界和items无关
+        for pos in range(0, len(data), piece_size) :
+            writer.write(data[pos:pos + piece_size])
+        writer.Finish()
+        out_file.close()
+        self.addCleanup(os.remove, file_name)
+
+    def testRoundTrip(self) :
+        records = [EncodeRecord(i, u"名字%d" % (i % 7) * (i % 5 + 1)) for i in range(500)]
+        # 超过块大小的单个items独占一块
+        records.append(EncodeRecord(1000, u"x" * 3000))
+        data = EncodeArray(records)
+        for codec in block_codec.CODECS.keys() :
+            file_name = "test_%s.bin" % codec
+            self._Write(file_name, data, codec, 1024, 37)
+            self.assertTrue(block_codec.IsBlockFile(file_name))
+            self.assertEqual(block_codec.ReadData(file_name), data)
+
+            blocks = block_codec.BlockFile(file_name)
+            try :
+                self.assertEqual(blocks.codec, codec)
+                self.assertTrue(len(blocks) > 1)
+                pieces = []
+                for i in range(len(blocks)) :
+                    block = blocks.ReadBlock(i)
+                    # 每块单独解压后由完整的items组成
+                    self.assertEqual(block[0:1], b"\x0a")
+                    self.assertEqual(blocks.blocks[i][1], sum([len(piece) for piece in pieces]))
+                    pieces.append(block)
+                self.assertEqual(b"".join(pieces), data)
+            finally :
+                blocks.Close()
+
+    def testEmpty(self) :
+        self._Write("test_empty.bin", b"", "zlib", 1024, 1)
+        self.assertEqual(block_codec.ReadData("test_empty.bin"), b"")
+
+    def testIncompleteItems(self) :
+        data = EncodeArray([EncodeRecord(1, u"a")])
+        writer = block_codec.BlockWriter(io.BytesIO(), "zlib")
+        writer.write(data[:-1])
+        self.assertRaises(ValueError, writer.Finish)
+
+    def testPlainFile(self) :
+        data = EncodeArray([EncodeRecord(1, u"a")])
+        plain_file = open("test_plain.bin", "wb")
+        plain_file.write(data)
+        plain_file.close()
+        self.addCleanup(os.remove, "test_plain.bin")
+        self.assertFalse(block_codec.IsBlockFile("test_plain.bin"))
+        self.assertEqual(block_codec.ReadData("test_plain.bin"), data)
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,57 @@
+#coding=utf-8
+
+##
+# @file:   test_parallel_encode.py
+# @brief:  同一个sheet逐行编码和分块并行编码, 输出的bin和可读文本逐字节一致
+##
+
+import unittest
+
+from sheet_fixture import InstallEnum, MakeSheet, xls_deploy
+
+ROW_COUNT = 200
+
+class ParallelEncodeTest(unittest.TestCase):
+    def setUp(self) :
+        InstallEnum()
+        self.sheet = MakeSheet("wire", ROW_COUNT)
+
+    def _Export(self, output_name, jobs, **options) :
+        option = xls_deploy.DeployOption()
+        option.jobs = jobs
+        option.row_chunk = 10 if jobs > 1 else 0
+        for name, value in options.items() :
+            setattr(option, name, value)
+        parser = xls_deploy.DataParser(self.sheet, "wire", option, output_name=output_name)
+        self.assertEqual(parser._RowWorkerNum(), jobs)
+        parser.Parse()
+
+        data_file = open("./build_out/bin/%s.bin" % output_name, "rb")
+        data = data_file.read()
+        data_file.close()
+        text_file = open("./build_out/log/%s.txt" % output_name, "rb")
+        text = text_file.read()
+        text_file.close()
+        return data, text
+
+    def _Check(self, prefix, **options) :
+        seq_data, seq_text = self._Export(prefix + "_seq", 1, **options)
+        par_data, par_text = self._Export(prefix + "_par", 3, **options)
+        self.assertEqual(par_data, seq_data)
+        self.assertEqual(par_text, seq_text)
+        return seq_data
+
+    def testMessageEncoder(self) :
+        data = self._Check("message")
+        _, array_class = xls_deploy.LoadMessageClasses(xls_deploy.DataParser(self.sheet, "wire").FileDescriptor(),
+                "wire")
+        self.assertEqual(len(array_class.FromString(data).items), ROW_COUNT)
+
+    def testWireEncoder(self) :
+        self._Check("wire", encoder="wire")
+
+    def testStream(self) :
+        self._Check("stream", stream=True, readable=True)
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,64 @@
+#coding=utf-8
+
+##
+# @file:   test_record_file.py
+# @brief:  记录文件按id查找, 以及超出int64的无符号id, 只依赖标准库
+##
+
+import io
+import os
+import unittest
+
+# sheet_fixture 把deploy目录加入sys.path
+from sheet_fixture import EncodeArray, EncodeRecord
+import record_file
+
+class RecordFileTest(unittest.TestCase):
+    def _Write(self, data, id_kind) :
+        out_file = io.BytesIO()
+        result = record_file.WriteRecordFile(data, out_file, 1, id_kind)
+        file_name = "test_%d.rec" % id_kind
+        rec_file = open(file_name, "wb")
+        rec_file.write(out_file.getvalue())
+        rec_file.close()
+        self.addCleanup(os.remove, file_name)
+        return result, file_name
+
+    def testGet(self) :
+        ids = [30, 10, 1 << 40, 20, 10]
+        data = EncodeArray([EncodeRecord(record_id, u"名字%d" % i) for i, record_id in enumerate(ids)])
+        (count, duplicated), file_name = self._Write(data, record_file.ID_UVARINT)
+        self.assertEqual(count, 5)
+        self.assertEqual(duplicated, [10])
+
+        records = record_file.RecordFile(file_name)
+        try :
+            self.assertEqual(list(records.Ids()), [10, 10, 20, 30, 1 << 40])
+            self.assertEqual(bytes(records.Get(30)), EncodeRecord(30, u"名字0"))
+            # 重复的id返回表中的第一个
+            self.assertEqual(bytes(records.Get(10)), EncodeRecord(10, u"名字1"))
+            self.assertEqual(bytes(records.Get(1 << 40)), EncodeRecord(1 << 40, u"名字2"))
+            self.assertTrue(20 in records)
+            self.assertIsNone(records.Get(11))
+        finally :
+            records.Close()
+
+    def testInt64Max(self) :
+        for id_kind, fixed64 in ((record_file.ID_UVARINT, False), (record_file.ID_FIXED64, True)) :
+            data = EncodeArray([EncodeRecord(record_file.INT64_MAX, u"max", fixed64)])
+            (count, duplicated), file_name = self._Write(data, id_kind)
+            records = record_file.RecordFile(file_name)
+            try :
+                self.assertEqual(list(records.Ids()), [record_file.INT64_MAX])
+            finally :
+                records.Close()
+
+    def testUnsignedIdOutOfRange(self) :
+        # 大于int64最大值的uint64和fixed64 id明确报错, 不能按有符号数保存
+        for id_kind, fixed64 in ((record_file.ID_UVARINT, False), (record_file.ID_FIXED64, True)) :
+            data = EncodeArray([EncodeRecord(1 << 63, u"big", fixed64)])
+            self.assertRaises(ValueError, record_file.SplitRecords, data, 1, id_kind)
+            self.assertRaises(ValueError, record_file.WriteRecordFile, data, io.BytesIO(), 1, id_kind)
+
+if __name__ == "__main__" :
+    unittest.main()
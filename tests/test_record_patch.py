@@ -0,0 +1,71 @@
+#coding=utf-8
+
+##
+# @file:   test_record_patch.py
+# @brief:  补丁应用到旧bin后和新bin逐字节一致, 只依赖标准库
+##
+
+import io
+import unittest
+
+# sheet_fixture 把deploy目录加入sys.path
+from sheet_fixture import EncodeArray, EncodeRecord
+import record_file
+import record_patch
+
+def _Array(records) :
+    return EncodeArray([EncodeRecord(record_id, name) for record_id, name in records])
+
+class RecordPatchTest(unittest.TestCase):
+    def _Patch(self, old_data, new_data) :
+        out_file = io.BytesIO()
+        counts = record_patch.WritePatchFile(old_data, new_data, out_file, 1, record_file.ID_UVARINT)
+        return counts, out_file.getvalue()
+
+    def testRoundTrip(self) :
+        old_data = _Array([(1, u"a"), (2, u"b"), (3, u"c"), (4, u"d")])
+        # 修改2, 删除3, 新增5和6
+        new_data = _Array([(1, u"a"), (2, u"bb"), (4, u"d"), (5, u"e"), (6, u"名字")])
+        counts, patch_data = self._Patch(old_data, new_data)
+        self.assertEqual(counts, (2, 1, 1))
+
+        patch = record_patch.RecordPatch(patch_data)
+        self.assertEqual(list(patch.added.keys()), [5, 6])
+        self.assertEqual(list(patch.changed.keys()), [2])
+        self.assertEqual(patch.removed, [3])
+        self.assertIsNone(patch.order)
+        self.assertEqual(record_patch.ApplyPatch(old_data, patch_data), new_data)
+
+    def testReorder(self) :
+        old_data = _Array([(1, u"a"), (2, u"b"), (3, u"c")])
+        # 新增的记录不在最后, 保留的记录顺序也变了, 需要顺序表
+        new_data = _Array([(3, u"c"), (9, u"z"), (1, u"a"), (2, u"b")])
+        counts, patch_data = self._Patch(old_data, new_data)
+        self.assertEqual(counts, (1, 0, 0))
+        self.assertEqual(record_patch.RecordPatch(patch_data).order, [3, 9, 1, 2])
+        self.assertEqual(record_patch.ApplyPatch(old_data, patch_data), new_data)
+
+    def testUnchanged(self) :
+        data = _Array([(1, u"a"), (2, u"b")])
+        counts, patch_data = self._Patch(data, data)
+        self.assertEqual(counts, (0, 0, 0))
+        self.assertTrue(record_patch.RecordPatch(patch_data).IsEmpty())
+        self.assertEqual(record_patch.ApplyPatch(data, patch_data), data)
+
+    def testBaseMismatch(self) :
+        old_data = _Array([(1, u"a"), (2, u"b")])
+        new_data = _Array([(1, u"a"), (2, u"c")])
+        counts, patch_data = self._Patch(old_data, new_data)
+        other_data = _Array([(1, u"x"), (2, u"b")])
+        self.assertRaises(ValueError, record_patch.ApplyPatch, other_data, patch_data)
+
+    def testDuplicatedIds(self) :
+        old_data = _Array([(1, u"a"), (2, u"b")])
+        new_data = _Array([(1, u"a"), (1, u"b")])
+        out_file = io.BytesIO()
+        self.assertIsNone(record_patch.WritePatchFile(old_data, new_data, out_file, 1, record_file.ID_UVARINT))
+        self.assertIsNone(record_patch.WritePatchFile(new_data, old_data, out_file, 1, record_file.ID_UVARINT))
+        self.assertEqual(out_file.getvalue(), b"")
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,63 @@
+#coding=utf-8
+
+##
+# @file:   test_string_pool.py
+# @brief:  池化的bin中的下标由字符串表还原为原来的字符串, 只依赖标准库
+##
+
+import io
+import os
+import unittest
+
+# sheet_fixture 把deploy目录加入sys.path
+from sheet_fixture import EncodeArray, EncodeRecord, _Varint
+import string_pool
+
+class StringPoolTest(unittest.TestCase):
+    def testRoundTrip(self) :
+        names = [u"a", u"", u"名字", u"a", u"b" * 300]
+        data = EncodeArray([EncodeRecord(i + 1, name) for i, name in enumerate(names)])
+
+        builder = string_pool.PoolBuilder()
+        pooled_file = io.BytesIO()
+        # {id = 1; name = 2}, 反序列化后属性编号为字符串
+        count = string_pool.WritePooledFile(data, {"2" : 0}, builder, pooled_file)
+        self.assertEqual(count, 5)
+        # 空字符串固定为0, 重复的字符串只保存一次
+        self.assertEqual(len(builder), 4)
+
+        pool_file = open("test.pool", "wb")
+        builder.Write(pool_file)
+        pool_file.close()
+        self.addCleanup(os.remove, "test.pool")
+
+        # 池化的记录中name为字符串表的下标
+        expected = EncodeArray([b"\x08" + _Varint(i + 1) + b"\x10" + _Varint(index)
+            for i, index in enumerate([1, 0, 2, 1, 3])])
+        self.assertEqual(pooled_file.getvalue(), expected)
+
+        pool = string_pool.StringPool("test.pool")
+        try :
+            self.assertEqual(len(pool), 4)
+            self.assertEqual([pool.Get(index) for index in range(4)], [u"", u"a", u"名字", u"b" * 300])
+            self.assertRaises(IndexError, pool.Get, 4)
+        finally :
+            pool.Close()
+
+    def testNestedFields(self) :
+        # 结构3中的string属性1也池化, 结构外的bytes不变
+        inner = b"\x0a\x01x"
+        record = b"\x08\x01" + b"\x1a" + _Varint(len(inner)) + inner + b"\x22\x01y"
+        builder = string_pool.PoolBuilder()
+        pooled = string_pool.PoolRecord(bytearray(record), {3 : {1 : 0}}, builder)
+        self.assertEqual(pooled, b"\x08\x01" + b"\x1a\x02\x08\x01" + b"\x22\x01y")
+
+    def testNotPool(self) :
+        not_pool = open("test_not.pool", "wb")
+        not_pool.write(b"XREC" + b"\x00" * 12)
+        not_pool.close()
+        self.addCleanup(os.remove, "test_not.pool")
+        self.assertRaises(ValueError, string_pool.StringPool, "test_not.pool")
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,53 @@
+#coding=utf-8
+
+##
+# @file:   test_wire_encoder.py
+# @brief:  WireEncoder 直接编码的结果和message对象SerializeToString的结果逐字节一致
+##
+
+import unittest
+
+from sheet_fixture import InstallEnum, MakeSheet, xls_deploy
+
+class WireEncoderTest(unittest.TestCase):
+    def setUp(self) :
+        InstallEnum()
+        self.sheet = MakeSheet("wire", 40)
+        self.plan = xls_deploy.ColumnPlan(self.sheet, xls_deploy.LoadEnumIndex())
+        tool = xls_deploy.SheetInterpreter(self.sheet, "wire")
+        tool.Layout()
+        self.message_class, self.array_class = xls_deploy.LoadMessageClasses(tool.FileDescriptor(), "wire")
+        self.encoder = xls_deploy.WireEncoder(self.plan, self.message_class.DESCRIPTOR)
+
+    def _Rows(self) :
+        for row, row_values in self.sheet.IterRows(3) :
+            yield row, self.plan.ReadRow(row, row_values)
+
+    def testEncodeRow(self) :
+        for row, values in self._Rows() :
+            item_array = self.array_class()
+            xls_deploy.FillItem(self.plan, values, item_array.items.add())
+            self.assertEqual(self.encoder.EncodeRow(values), item_array.SerializeToString(), "row %d" % row)
+
+    def testEncodeItems(self) :
+        profile = xls_deploy.SheetProfile()
+        message_data, message_text = xls_deploy.EncodeItems("wire", self.plan, self._Rows(), self.array_class,
+                None, False, True, profile)
+        wire_data, wire_text = xls_deploy.EncodeItems("wire", self.plan, self._Rows(), self.array_class,
+                self.encoder, True, True, profile)
+        self.assertEqual(wire_data, message_data)
+        self.assertEqual(wire_text, message_text)
+
+        # 确认各种属性都有值, 负数没有被截断
+        items = self.array_class.FromString(wire_data).items
+        self.assertEqual(len(items), 40)
+        self.assertEqual(items[0].level, -43)
+        self.assertEqual(items[0].big, -(1 << 40))
+        self.assertEqual(list(items[0].rep), [1])
+        self.assertEqual(list(items[1].rep), [2, -2])
+        self.assertEqual(list(items[0].list), [1, 2, -1])
+        self.assertEqual(list(items[0].types), [1, 2])
+        self.assertEqual(items[0].type, 1)
+
+if __name__ == "__main__" :
+    unittest.main()
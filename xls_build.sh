@@ -8,18 +8,11 @@ if [ ! -d "$CUR_PATH/build_out/cpp/" ];then
 mkdir $CUR_PATH/build_out/cpp/
 fi
 
-$CUR_PATH/deploy/proto/protoc -I=$CUR_PATH/protocol/ --cpp_out=$CUR_PATH/build_out/cpp/ $CUR_PATH/protocol/enum.proto
-
 if [ ! -d "$CUR_PATH/build_out/py/" ];then
 mkdir $CUR_PATH/build_out/py/
 fi
 
-$CUR_PATH/deploy/proto/protoc -I=$CUR_PATH/protocol/ --python_out=$CUR_PATH/build_out/py/ $CUR_PATH/protocol/enum.proto
-
-for file in $CUR_PATH/xls/*.xls
-do
-    if test -f $file
-    then
-        python -B $CUR_PATH/deploy/xls_deploy.py $file
-    fi
-done
\ No newline at end of file
+# enum.proto 和所有sheet的PB定义由导表工具统一调用protoc生成代码
+# 所有xls在同一个进程里导出, sheet分散到进程池, JOBS 可指定进程数
+# 其余参数透传给导表工具, 放在xls目录之后, 如 --force 忽略增量构建缓存, --validate-rules rules.json 检查数据
+python -B $CUR_PATH/deploy/xls_deploy.py $CUR_PATH/xls/ ${JOBS:+-j $JOBS} "$@"
\ No newline at end of file